@@ -0,0 +1,124 @@
+import argparse
+import os
+import sys
+import tempfile
+from datetime import datetime
+
+from main import EXPORT_TYPES, INDICATOR_CLASSES, missing_input_columns, run_matrix
+from pipeline import ingest_data, read_input_columns
+from template_renderer import DEFAULT_RENDER_WORKERS
+
+# Les chemins des références et des templates (./Ref 2, ./Livrable/Templates) sont relatifs au dépôt
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_args(argv=None):
+    """
+    Arguments du traitement en ligne de commande (équivalents des paramètres de la barre latérale).
+
+    :param argv: Arguments (par défaut : sys.argv).
+    :return: Namespace argparse.
+    """
+    parser = argparse.ArgumentParser(
+        prog="hibiscus",
+        description="Génère les rapports HIBISCUS sans interface et écrit le ZIP de résultats sur disque.",
+    )
+    parser.add_argument("input", help="Fichier importé (.xlsx, .csv, .parquet, .arrow ou .feather).")
+    parser.add_argument("-o", "--output", required=True, help="Chemin du ZIP de résultats.")
+    parser.add_argument("--export-type", nargs="+", choices=EXPORT_TYPES, default=["ALL"],
+                        help="Type(s) d'export (défaut : ALL). Plusieurs types sont produits dans le même ZIP, "
+                             "à partir d'un seul prétraitement.")
+    parser.add_argument("--entity", nargs="+", default=["ALL"],
+                        help="Entité(s) (GRAN uniquement, défaut : ALL). Chaque indicateur est calculé une seule "
+                             "fois par devise et par vue, puis découpé en un fichier par entité.")
+    parser.add_argument("--currency", nargs="+", choices=["ALL", "EUR", "USD"], default=["ALL"],
+                        help="Devise(s) spécifique(s) (GRAN uniquement, défaut : ALL).")
+    parser.add_argument("--view", choices=["ALL", "BILAN", "CONSO"], default="ALL",
+                        help="Vue (GRAN uniquement, défaut : ALL).")
+    parser.add_argument("--indicators", nargs="+", choices=["ALL"] + list(INDICATOR_CLASSES), default=["ALL"],
+                        help="Indicateurs à exécuter (défaut : ALL).")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Nombre d'indicateurs exécutés en parallèle (défaut : 1, exécution séquentielle).")
+    parser.add_argument("--render-workers", type=int, default=DEFAULT_RENDER_WORKERS,
+                        help="Workers pour le rendu des rapports par entité.")
+    parser.add_argument("--categorical", action="store_true", help="Encodage catégoriel des dimensions.")
+    parser.add_argument("--streaming", action="store_true", help="Lecture du fichier par blocs (fichiers volumineux).")
+    args = parser.parse_args(argv)
+    if args.jobs < 1:
+        parser.error("--jobs doit être supérieur ou égal à 1.")
+    return args
+
+
+def run(argv=None) -> int:
+    """
+    Point d'entrée en ligne de commande : même traitement que le bouton « Lancer le traitement » de
+    l'application (run_matrix). Le ZIP est écrit dans un fichier temporaire à côté de la sortie puis
+    renommé, pour qu'un traitement interrompu ne laisse pas d'archive partielle.
+
+    :param argv: Arguments (par défaut : sys.argv).
+    :return: Code de sortie (0 : succès, 1 : erreur d'un indicateur ou du traitement, 2 : fichier non conforme).
+    """
+    args = parse_args(argv)
+    input_path = os.path.abspath(args.input)
+    output_path = os.path.abspath(args.output)
+    os.chdir(REPO_DIR)
+
+    selected_processes = "ALL" if "ALL" in args.indicators else args.indicators
+    run_timestamp = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
+
+    try:
+        if args.streaming:
+            uploaded_data, uploaded_columns = None, read_input_columns(input_path)
+        else:
+            uploaded_data = ingest_data(input_path)
+            uploaded_columns = uploaded_data.columns
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    missing_columns = missing_input_columns(uploaded_columns)
+    if missing_columns:
+        print(f"Colonnes attendues manquantes dans le fichier : {', '.join(missing_columns)}", file=sys.stderr)
+        return 2
+
+    def print_progress(text, percent):
+        if text is not None:
+            print(text)
+        if percent is not None:
+            print(f"Progression : {percent} %")
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    partial_path = f"{output_path}.part"
+    if os.path.exists(partial_path):
+        # Reste d'un traitement interrompu : le ZIP est ouvert en ajout, il doit repartir de zéro
+        os.remove(partial_path)
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            process_errors = run_matrix(
+                input_path, args.export_type, partial_path, temp_dir, run_timestamp,
+                currencies=args.currency,
+                entity=args.entity,
+                indicator=args.view,
+                selected_processes=selected_processes,
+                run_in_parallel=args.jobs > 1,
+                max_workers=args.jobs,
+                categorical_mode=args.categorical,
+                streaming_mode=args.streaming,
+                render_workers=args.render_workers,
+                uploaded_data=uploaded_data,
+                progress_callback=print_progress,
+            )
+        os.replace(partial_path, output_path)
+    except Exception as e:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        print(f"Une erreur est survenue : {e}", file=sys.stderr)
+        return 1
+
+    print(f"Résultats écrits dans : {output_path}")
+    for func_name, error in process_errors.items():
+        print(f"Erreur dans {func_name} : {error}", file=sys.stderr)
+    return 1 if process_errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
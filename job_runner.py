@@ -0,0 +1,159 @@
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# États d'un traitement
+PENDING, RUNNING, DONE, FAILED = "en attente", "en cours", "terminé", "échec"
+
+
+class Job:
+    """
+    État d'un traitement soumis à JobRunner, mis à jour par le traitement et lu par les pages qui le suivent.
+    """
+
+    def __init__(self, job_id: str, label: str):
+        self.job_id = job_id
+        self.label = label
+        self.status = PENDING
+        self.stage = None
+        self.percent = 0
+        self.stats = {}
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def progress(self, text=None, percent=None):
+        """
+        Callback de progression (texte de l'étape, pourcentage), au format de run_matrix.
+        """
+        with self._lock:
+            if text is not None:
+                self.stage = text
+            if percent is not None:
+                self.percent = percent
+
+    def update_stats(self, stats: dict):
+        """
+        Callback des compteurs (lignes lues, indicateurs exécutés, fichiers écrits), au format de run_matrix.
+        """
+        with self._lock:
+            self.stats = dict(stats)
+
+    def snapshot(self) -> dict:
+        """
+        Copie cohérente de l'état du traitement.
+
+        :return: Dictionnaire {"job_id", "label", "status", "stage", "percent", "stats", "result", "error", "elapsed"}.
+        """
+        with self._lock:
+            end = self.finished_at or time.time()
+            return {
+                "job_id": self.job_id,
+                "label": self.label,
+                "status": self.status,
+                "stage": self.stage,
+                "percent": self.percent,
+                "stats": dict(self.stats),
+                "result": self.result,
+                "error": self.error,
+                "elapsed": end - self.submitted_at,
+            }
+
+
+class JobRunner:
+    """
+    Exécute les traitements en tâche de fond, hors du thread de la session Streamlit : la page ne fait que
+    soumettre le traitement puis lire son état par son identifiant. Un pool borné de threads est partagé
+    par toutes les sessions ; les traitements au-delà de `max_workers` attendent leur tour, dans l'ordre
+    de soumission (leur rang dans la file est donné par get).
+    """
+
+    def __init__(self, max_workers: int = 2, max_jobs: int = 64):
+        """
+        :param max_workers: Nombre de traitements exécutés simultanément.
+        :param max_jobs: Nombre maximal de traitements suivis (les plus anciens terminés sont oubliés).
+        """
+        self.max_jobs = max_jobs
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hibiscus-job")
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _run(self, job: Job, func, args, kwargs):
+        with job._lock:
+            job.status = RUNNING
+        try:
+            result = func(job, *args, **kwargs)
+        except Exception as e:
+            print(f"Erreur dans le traitement {job.job_id} : {e}")
+            with job._lock:
+                job.status, job.error = FAILED, f"{e}\n\n{traceback.format_exc()}"
+        else:
+            with job._lock:
+                job.status, job.result, job.percent = DONE, result, 100
+        finally:
+            with job._lock:
+                job.finished_at = time.time()
+
+    def submit(self, func, *args, label: str = "", **kwargs) -> str:
+        """
+        Soumet un traitement. `func` est appelée avec le Job en premier argument, pour publier sa
+        progression (job.progress, job.update_stats) ; sa valeur de retour devient job.result.
+
+        :param func: Fonction du traitement.
+        :param label: Libellé affiché pour le traitement.
+        :return: Identifiant du traitement.
+        """
+        job = Job(uuid.uuid4().hex, label)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            finished = [job_id for job_id, known in self._jobs.items() if known.status in (DONE, FAILED)]
+            while len(self._jobs) > self.max_jobs and finished:
+                self._jobs.pop(finished.pop(0))
+        self._executor.submit(self._run, job, func, args, kwargs)
+        return job.job_id
+
+    def get(self, job_id):
+        """
+        État d'un traitement, ou None s'il est inconnu (identifiant absent ou oublié). Pour un traitement
+        en attente, "position" est son rang dans la file (1 = prochain à démarrer), sinon None.
+
+        :param job_id: Identifiant retourné par submit.
+        :return: Dictionnaire (voir Job.snapshot, plus "position") ou None.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            position = None
+            if job.status == PENDING:
+                # Le pool démarre les traitements dans l'ordre de soumission, qui est celui de self._jobs
+                position = 1
+                for known in self._jobs.values():
+                    if known is job:
+                        break
+                    if known.status == PENDING:
+                        position += 1
+        snapshot = job.snapshot()
+        snapshot["position"] = position if snapshot["status"] == PENDING else None
+        return snapshot
+
+    def release(self, job_id):
+        """
+        Oublie un traitement terminé dont le résultat a été repris par l'appelant : JobRunner ne retient plus
+        ce résultat (archive, cube...). Sans effet sur un traitement en attente ou en cours.
+
+        :param job_id: Identifiant retourné par submit.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job.status in (DONE, FAILED):
+                del self._jobs[job_id]
+
+
+# Pool unique pour tout le processus (toutes les sessions Streamlit)
+JOB_RUNNER = JobRunner()
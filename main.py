@@ -1,21 +1,40 @@
 import pandas as pd
 import os
+import sys
 import io
+import hashlib
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from LCR import LCR
 from NSFR import NSFR
 from AER import AER
 from ALMM import ALMM
 from QIS import QIS
+from pipeline import (
+    build_cubes, build_shared_prefixes, split_by_entity, select_entities, entity_list, ingest_data,
+    encode_dimensions, project_columns, required_columns, INPUT_COLUMNS, INPUT_FORMATS, read_input, read_input_columns,
+    stream_cubes, apply_column_types, remove_blank_rows, partition_data,
+)
+from ref_catalog import REF_CATALOG
+from result_cube import ResultCube, filter_view
+from run_cache import RUN_CACHE
+from job_runner import JOB_RUNNER, PENDING, RUNNING, FAILED
+from zip_sink import ZipSink, open_zip_writer, run_named_process
+from template_renderer import TEMPLATE_RENDERER, DEFAULT_RENDER_WORKERS, render_reports
 from datetime import datetime
 import streamlit as st
 import shutil
 import tempfile
 import zipfile
+import numpy as np
+import xlsxwriter
 from openpyxl import load_workbook
 from io import BytesIO
 
 Entity_List = ['BANCO SOCIETE GENERALE BRASIL SA','BPCE LEASE','FRAER LEASING SPA','FRANFINANCE','FRANFINANCE LOCATION','GEFA BANK GMBH','GERMAN NEWCO','GERMAN NEWCO','MILLA','PHILIPS MEDICAL CAPITAL FRANCE','SG EQUIPMENT FINANCE BENELUX BV','SG EQUIPMENT FINANCE CZECH REPUBLIC','SG EQUIPMENT FINANCE GMBH','SG EQUIPMENT FINANCE IBERIA','SG EQUIPMENT FINANCE ITALY SPA','SG EQUIPMENT FINANCE SCHWEIZ AG','SG EQUIPMENT FINANCE USA CORP','SG EQUIPMENT LEASING POLSKA SP ZO','SG EQUIPMENT LEASING POLSKA SP ZO','SG LEASING SPA','SGEF SA','SGEF SA ARRENDAMENTO MERCANTIL','SOCIETE GENERALE EQUIPMENT FINANCE Brazil','SOCIETE GENERALE EQUIPMENT FINANCE UK','SOCIETE GENERALE LEASING AND RENTING China']
+# Classes des indicateurs, pour retrouver les colonnes qu'ils déclarent (REQUIRED_COLUMNS)
+INDICATOR_CLASSES = {"NSFR": NSFR, "LCR": LCR, "QIS": QIS, "ALMM": ALMM, "AER": AER}
+# Types d'export, dans l'ordre de production d'un traitement multi-exports (run_matrix)
+EXPORT_TYPES = ["ALL", "BILAN", "CONSO", "GRAN"]
 expected_columns = [
     "D_CA", "D_DP", "D_ZTFTR", "D_PE", "D_RU", "D_ORU", "D_AC", "D_FL", "D_AU", 
     "D_T1", "D_T2", "D_CU", "D_TO", "D_GO", "D_LE", "D_NU", "D_DEST", "D_ZONE", 
@@ -27,11 +46,20 @@ def preprocess_all_data(data_path, ref_entite_path, ref_transfo_path, ref_lcr_pa
                         input_excel_path, run_timestamp, export_type, currency="ALL"):
     """
     Prétraitement des données pour tous les types d'export (ALL, BILAN, CONSO, GRAN).
+
+    Pour ALL, BILAN et CONSO, retourne les partitions typées {(vue, devise): DataFrame} gardées en mémoire
+    et utilisées directement par les process_*. Les fichiers IMPORT_*.xlsx du ZIP sont écrits à part
+    (generate_import_files).
+
+    `data_path` peut aussi être le DataFrame déjà produit par pipeline.ingest_data : le fichier n'est
+    alors pas relu.
     """
-    try:
-        data_import = pd.read_excel(data_path, engine="openpyxl")
-    except Exception as e:
-        raise ValueError(f"Erreur lors du chargement des données principales : {e}")
+    typed = isinstance(data_path, pd.DataFrame)
+    if typed:
+        data_import = data_path
+    else:
+        # Excel, CSV, Parquet ou Arrow/Feather selon l'extension
+        data_import = read_input(data_path)
 
     # Vérifier les colonnes essentielles
     required_columns = ["D_CU", "D_T1", "D_ENTITE", "D_PE"]
@@ -39,17 +67,8 @@ def preprocess_all_data(data_path, ref_entite_path, ref_transfo_path, ref_lcr_pa
     if missing_columns:
         raise ValueError(f"Les colonnes suivantes sont manquantes dans les données : {', '.join(missing_columns)}")
 
-    # Initialiser le processeur LCR
-    lcr_processor = LCR(
-        data_import=data_import,
-        ref_entite_path=ref_entite_path,
-        ref_transfo_path=ref_transfo_path,
-        ref_lcr_path=ref_lcr_path,
-        ref_adf_lcr_path=ref_adf_lcr_path,
-        input_excel_path=input_excel_path,
-        run_timestamp=run_timestamp,
-        export_type=export_type
-    )
+    # Les indicateurs ne lisent que les dimensions du cube et P_AMOUNT
+    data_import = project_columns(data_import, INPUT_COLUMNS)
 
     # Prétraitement des données
     if export_type == "GRAN":
@@ -68,68 +87,124 @@ def preprocess_all_data(data_path, ref_entite_path, ref_transfo_path, ref_lcr_pa
         return {"filtered_data": filtered_data}
     else:
         # Prétraitement standard pour ALL, BILAN, et CONSO
-        preprocessed_data = lcr_processor.preprocess_data(export_type=export_type, currency=currency)
+        if not typed:
+            # Suppression des lignes totalement vides et définition des types de colonnes
+            data_import = apply_column_types(remove_blank_rows(data_import))
+        return partition_data(data_import)
 
-        if isinstance(preprocessed_data, dict):
-            return preprocessed_data
-        else:
-            raise ValueError("Le prétraitement des données a échoué pour les exports standard.")
+def gran_view_data(preprocessed_data, currency, view):
+    """
+    GRAN : données d'une devise et d'une vue après le préfixe commun, avec le même filtre que la
+    consultation GRAN (voir ResultCube) : un rapport rendu depuis la consultation est identique au
+    fichier de même nom de l'export GRAN.
+
+    :param preprocessed_data: {"filtered_data": DataFrame} (voir run_matrix) ou DataFrame.
+    :param currency: Devise ("ALL" pour toutes).
+    :param view: Vue (ALL, BILAN ou CONSO).
+    :return: Données filtrées (jamais vides).
+    """
+    if isinstance(preprocessed_data, dict):
+        if "filtered_data" not in preprocessed_data:
+            raise ValueError("La clé 'filtered_data' est absente dans preprocessed_data.")
+        preprocessed_data = preprocessed_data["filtered_data"]
+    elif not isinstance(preprocessed_data, pd.DataFrame):
+        raise TypeError("preprocessed_data doit être un DataFrame ou un dictionnaire.")
+    if "D_CU" not in preprocessed_data.columns:
+        raise KeyError("La colonne 'D_CU' est absente dans les données prétraitées pour GRAN.")
+
+    data = preprocessed_data if currency == "ALL" else preprocessed_data[preprocessed_data["D_CU"] == currency]
+    if data.empty:
+        raise ValueError(f"Aucune donnée trouvée pour la devise '{currency}' dans l'export GRAN.")
+    data = filter_view(data, view or "ALL")
+    if data.empty:
+        raise ValueError(f"Aucune donnée trouvée pour l'indicateur '{view}'.")
+    return data
+
+def indicator_chain(name, processor, data):
+    """
+    Étapes propres à un indicateur (jointures, agrégation et montants ajustés) sur des données après le
+    préfixe commun. Seul enchaînement utilisé par les exports GRAN et par la consultation GRAN.
+
+    :param name: Nom de l'indicateur (NSFR, LCR, QIS, ALMM, AER).
+    :param processor: Moteur de l'indicateur.
+    :param data: Données après le préfixe commun (voir build_shared_prefixes).
+    :return: Résultat final de l'indicateur.
+    """
+    if name == "NSFR":
+        result = processor.aggregate_by_bucket(processor.join_with_ref_nsfr(data))
+        return processor.add_adjusted_amounts(processor.join_with_ref_adf_nsfr(result))
+    if name == "LCR":
+        result = processor.add_unadjusted_p_amount(processor.join_with_ref_lcr(data))
+        return processor.add_adjusted_amount(processor.join_with_ref_adf_lcr(processor.group_and_sum(result)))
+    if name == "QIS":
+        result = processor.aggregate_by_bucket(processor.join_with_ref_qis(data))
+        return processor.add_adjusted_amounts(processor.join_with_ref_adf_qis(result))
+    if name == "ALMM":
+        result = processor.aggregate_by_bucket(processor.join_with_ref_almm(data))
+        return processor.add_adjusted_amounts(processor.join_with_ref_adf_almm(result))
+    if name == "AER":
+        result = processor.group_and_join_ref_adf_aer(processor.join_with_ref_aer(data))
+        return processor.add_adjusted_amount(result)
+    raise ValueError(f"Indicateur non pris en charge : {name}.")
+
+def gran_report_jobs(final_result, entity, base_folder, currency, indicator, template_path):
+    """
+    GRAN : travaux de rendu d'un indicateur, un fichier par entité demandée à partir du même résultat.
+    Une entité sans données n'a pas de fichier.
+
+    :param final_result: Résultat final de l'indicateur pour la devise.
+    :param entity: Entité, liste d'entités ou "ALL".
+    :param base_folder: Dossier du run dans le ZIP.
+    :param currency: Devise.
+    :param indicator: Nom de l'indicateur (préfixe des fichiers).
+    :param template_path: Template Excel, ou None (pandas.to_excel).
+    :return: Liste de tuples (chemin dans le ZIP, données de l'entité, template) pour render_reports.
+    """
+    jobs = []
+    for entity_name, entity_data in select_entities(final_result, entity):
+        if entity_data.empty:
+            print(f"Aucune donnée à exporter pour l'entité '{entity_name}' et la devise '{currency}'.")
+            continue
+        jobs.append((
+            f"{base_folder}/{currency}/Reports_by_entity/{entity_name}/{indicator}_GRAN_{currency}_{entity_name}.xlsx",
+            entity_data, template_path,
+        ))
+    return jobs
+
+def select_partitions(partitions, view):
+    """
+    Sélectionne les partitions en mémoire d'une vue, indexées par devise.
+
+    :param partitions: Partitions {(vue, devise): DataFrame} retournées par preprocess_all_data.
+    :param view: Vue à sélectionner (ALL, BILAN, CONSO).
+    :return: Dictionnaire {devise: DataFrame}.
+    """
+    return {
+        currency: data
+        for (partition_view, currency), data in partitions.items()
+        if partition_view == view
+    }
 
 def process_aer(preprocessed_data,
                 data_path, ref_entite_path, ref_transfo_path, ref_aer_path, ref_adf_aer_path,
                 input_excel_path, run_timestamp, export_type, zip_buffer,
-                entity=None, currency=None, indicator="ALL"):
+                entity=None, currency=None, indicator="ALL", render_workers=None):
     """
     Processus pour traiter les données AER avec gestion spécifique des exports dans un ZIP,
     incluant la transition des données vers un fichier template.
     """
     base_folder = f"RUN_{run_timestamp}_{export_type}"  # Dossier racine dans le ZIP
 
-    with zipfile.ZipFile(zip_buffer, 'a') as zipf:
+    with open_zip_writer(zip_buffer) as zipf:
         if export_type == "GRAN":
 
             if not entity or not currency:
                 raise ValueError("Pour un export de type GRAN, une entité et une devise spécifiques doivent être fournies.")
 
-            print(f"Traitement GRAN pour l'entité '{entity}' et la devise '{currency}'...")
+            print(f"Traitement GRAN pour l'entité '{', '.join(entity_list(entity))}' et la devise '{currency}'...")
 
-            # Filtrer les données pour GRAN
-            if isinstance(preprocessed_data, pd.DataFrame):
-                if "D_CU" not in preprocessed_data.columns:
-                    raise KeyError("La colonne 'D_CU' est absente dans les données prétraitées pour GRAN.")
-                if currency == "ALL":
-                    filtered_data = preprocessed_data
-                else:
-                    filtered_data = preprocessed_data[preprocessed_data["D_CU"] == currency]
-            elif isinstance(preprocessed_data, dict):
-                if "filtered_data" in preprocessed_data:
-                    filtered_data = preprocessed_data["filtered_data"]
-                    if "D_CU" not in filtered_data.columns:
-                        raise KeyError("La colonne 'D_CU' est absente dans les données prétraitées pour GRAN.")
-                    if currency == "ALL":
-                        filtered_data = filtered_data
-                    else:
-                        filtered_data = filtered_data[filtered_data["D_CU"] == currency]
-                else:
-                    raise ValueError("La clé 'filtered_data' est absente dans preprocessed_data.")
-            else:
-                raise TypeError("preprocessed_data doit être un DataFrame ou un dictionnaire.")
-
-            if filtered_data.empty:
-                raise ValueError(f"Aucune donnée trouvée pour la devise '{currency}' dans l'export GRAN.")
-
-            # Étape 2 : Filtrer par indicateur
-            if indicator == "BILAN":
-                filtered_data = filtered_data[filtered_data["D_T1"] == "INTER"]
-            elif indicator == "CONSO":
-                filtered_data = filtered_data[filtered_data["D_T1"] != "INTER"]
-            elif indicator == "ALL":
-                pass  # Ne rien filtrer
-            else:
-                raise ValueError("Indicateur non pris en charge. Choisissez parmi ALL, BILAN, ou CONSO.")
-
-            if filtered_data.empty:
-                raise ValueError(f"Aucune donnée trouvée pour l'indicateur '{indicator}'.")
+            # Données de la devise et de la vue, comme dans la consultation GRAN
+            filtered_data = gran_view_data(preprocessed_data, currency, indicator)
 
             # Initialiser la classe AER
             aer_processor = AER(
@@ -142,36 +217,15 @@ def process_aer(preprocessed_data,
                 export_type=export_type,
             )
 
-            # Appliquer les transformations
-            result_after_entite = aer_processor.filter_and_join_ref_entite(filtered_data)
-            result_after_transfo = aer_processor.join_with_ref_transfo(result_after_entite)
-            result_with_aer = aer_processor.join_with_ref_aer(result_after_transfo)
-            grouped_result = aer_processor.group_and_join_ref_adf_aer(result_with_aer)
-            final_result = aer_processor.add_adjusted_amount(grouped_result)
-
-            # Filtrer par entité
-            final_result = final_result[final_result["Ref_Entite.entité"] == entity]
-
-            # Transition vers le fichier template
-            buffer = apply_to_template(final_result, input_excel_path)
+            final_result = indicator_chain("AER", aer_processor, filtered_data)
 
-            # Ajouter au ZIP
-            folder_path = f"{base_folder}/{currency}/Reports_by_entity/{entity}"
-            file_name = f"{folder_path}/AER_GRAN_{currency}_{entity}.xlsx"
-            zipf.writestr(file_name, buffer.getvalue())
+            # Un fichier par entité demandée, à partir du même résultat
+            jobs = gran_report_jobs(final_result, entity, base_folder, currency, "AER", input_excel_path)
+            for file_name, content in render_reports(jobs, render_workers):
+                zipf.writestr(file_name, content)
 
         else:  # Cas ALL, BILAN, CONSO
-            for currency, file_path in preprocessed_data.items():
-                if not os.path.exists(file_path):
-                    print(f"Le fichier {file_path} n'existe pas. Aucun traitement pour cette devise.")
-                    continue
-
-                try:
-                    data_import_filtered = pd.read_excel(file_path, engine="openpyxl")
-                except Exception as e:
-                    print(f"Erreur lors de la lecture du fichier {file_path}: {e}")
-                    continue
-
+            for currency, data_import_filtered in select_partitions(preprocessed_data, export_type).items():
                 if data_import_filtered.empty:
                     continue
 
@@ -189,14 +243,12 @@ def process_aer(preprocessed_data,
                 )
 
                 # Appliquer les transformations
-                result_after_entite = aer_processor.filter_and_join_ref_entite(data_import_filtered)
-                result_after_transfo = aer_processor.join_with_ref_transfo(result_after_entite)
-                result_with_aer = aer_processor.join_with_ref_aer(result_after_transfo)
+                result_with_aer = aer_processor.join_with_ref_aer(data_import_filtered)
                 grouped_result = aer_processor.group_and_join_ref_adf_aer(result_with_aer)
                 final_result = aer_processor.add_adjusted_amount(grouped_result)
 
                 # Transition vers le fichier template
-                buffer = apply_to_template(final_result, input_excel_path)
+                buffer = apply_to_template(final_result, input_excel_path, streaming=True)
 
                 # Ajouter au ZIP
                 folder_path_global = f"{base_folder}/{currency}/Reports_all_entities"
@@ -208,14 +260,13 @@ def process_aer(preprocessed_data,
                     continue
                 else:
                     # Sauvegarder les fichiers par entité
-                    for entity in final_result["Ref_Entite.entité"].unique():
-                        entity_data = final_result[final_result["Ref_Entite.entité"] == entity]
-                        if entity_data.empty:
-                            continue
-                        buffer_entity = apply_to_template(entity_data, input_excel_path)
-                        folder_path_entity = f"{base_folder}/{currency}/Reports_by_entity/{entity}"
-                        file_name_entity = f"{folder_path_entity}/AER_{export_type}_{currency}_{entity}.xlsx"
-                        zipf.writestr(file_name_entity, buffer_entity.getvalue())
+                    # Rendu des fichiers par entité sur le pool de workers
+                    jobs = [
+                        (f"{base_folder}/{currency}/Reports_by_entity/{entity}/AER_{export_type}_{currency}_{entity}.xlsx", entity_data, input_excel_path)
+                        for entity, entity_data in split_by_entity(final_result)
+                    ]
+                    for file_name_entity, content in render_reports(jobs, render_workers):
+                        zipf.writestr(file_name_entity, content)
 
     print("Tous les fichiers AER ont été ajoutés au ZIP.")
 
@@ -234,7 +285,8 @@ def process_qis(
     zip_buffer,
     entity=None,
     currency=None,
-    indicator="ALL"
+    indicator="ALL",
+    render_workers=None
 ):
     """
     Processus pour traiter les données QIS avec gestion spécifique des exports dans un ZIP,
@@ -242,26 +294,15 @@ def process_qis(
     """
     base_folder = f"RUN_{run_timestamp}_{export_type}"  # Dossier racine dans le ZIP
 
-    with zipfile.ZipFile(zip_buffer, 'a') as zipf:
+    with open_zip_writer(zip_buffer) as zipf:
         if export_type == "GRAN":
             if not entity or not currency:
                 raise ValueError("Pour un export de type GRAN, une entité et une devise spécifiques doivent être fournies.")
 
-            print(f"Traitement GRAN pour l'entité '{entity}' et la devise '{currency}'...")
-
-            # Filtrer les données pour GRAN
-            if isinstance(preprocessed_data, pd.DataFrame):
-                if "D_CU" not in preprocessed_data.columns:
-                    raise KeyError("La colonne 'D_CU' est absente dans les données prétraitées pour GRAN.")
-                if currency == "ALL":
-                    filtered_data = preprocessed_data
-                else:
-                    filtered_data = preprocessed_data[preprocessed_data["D_CU"] == currency]
-            else:
-                raise TypeError("preprocessed_data doit être un DataFrame pour un export de type GRAN.")
+            print(f"Traitement GRAN pour l'entité '{', '.join(entity_list(entity))}' et la devise '{currency}'...")
 
-            if filtered_data.empty:
-                raise ValueError(f"Aucune donnée trouvée pour la devise '{currency}' dans l'export GRAN.")
+            # Données de la devise et de la vue, comme dans la consultation GRAN
+            filtered_data = gran_view_data(preprocessed_data, currency, indicator)
 
             # Initialiser la classe QIS
             qis_processor = QIS(
@@ -275,36 +316,15 @@ def process_qis(
                 export_type=export_type,
             )
 
-            # Appliquer les transformations
-            result_after_entite = qis_processor.filter_and_join_ref_entite(filtered_data)
-            result_after_transfo = qis_processor.join_with_ref_transfo(result_after_entite)
-            result_with_qis = qis_processor.join_with_ref_qis(result_after_transfo)
-            grouped_result = qis_processor.group_and_join_ref_adf_qis(result_with_qis)
-            final_result = qis_processor.add_adjusted_amount(grouped_result)
-
-            # Filtrer par entité
-            final_result = final_result[final_result["Ref_Entite.entité"] == entity]
-
-            # Transition vers le fichier template
-            buffer = apply_to_template(final_result, input_excel_path)
+            final_result = indicator_chain("QIS", qis_processor, filtered_data)
 
-            # Ajouter au ZIP
-            folder_path = f"{base_folder}/{currency}/Reports_by_entity/{entity}"
-            file_name = f"{folder_path}/QIS_GRAN_{currency}_{entity}.xlsx"
-            zipf.writestr(file_name, buffer.getvalue())
+            # Un fichier par entité demandée, à partir du même résultat
+            jobs = gran_report_jobs(final_result, entity, base_folder, currency, "QIS", input_excel_path)
+            for file_name, content in render_reports(jobs, render_workers):
+                zipf.writestr(file_name, content)
 
         else:  # Cas ALL, BILAN, CONSO
-            for currency, file_path in preprocessed_data.items():
-                if not os.path.exists(file_path):
-                    print(f"Le fichier {file_path} n'existe pas. Aucun traitement pour cette devise.")
-                    continue
-
-                try:
-                    data_import_filtered = pd.read_excel(file_path, engine="openpyxl")
-                except Exception as e:
-                    print(f"Erreur lors de la lecture du fichier {file_path}: {e}")
-                    continue
-
+            for currency, data_import_filtered in select_partitions(preprocessed_data, export_type).items():
                 if data_import_filtered.empty:
                     continue
 
@@ -322,17 +342,13 @@ def process_qis(
                     export_type=export_type,
                 )
 
-                result_after_entite = qis_processor.filter_and_join_ref_entite(data_import_filtered)
-                result_after_transfo = qis_processor.join_with_ref_transfo(result_after_entite)
-                result_with_dzone_qis = qis_processor.join_with_ref_dzone_qis(result_after_transfo)
-                result_with_qis = qis_processor.join_with_ref_qis(result_with_dzone_qis)
-                grouped_result = qis_processor.group_and_sum_unadjusted_p_amount(result_with_qis)
-                pivoted_and_reordered_result = qis_processor.pivot_and_reorder(grouped_result)
+                result_with_qis = qis_processor.join_with_ref_qis(data_import_filtered)
+                pivoted_and_reordered_result = qis_processor.aggregate_by_bucket(result_with_qis)
                 final_result_with_adf_qis = qis_processor.join_with_ref_adf_qis(pivoted_and_reordered_result)
                 final_result = qis_processor.add_adjusted_amounts(final_result_with_adf_qis)
 
                 # Transition vers le fichier template
-                buffer = apply_to_template(final_result, input_excel_path)
+                buffer = apply_to_template(final_result, input_excel_path, streaming=True)
 
                 # Ajouter au ZIP
                 folder_path_global = f"{base_folder}/{currency}/Reports_all_entities"
@@ -344,74 +360,34 @@ def process_qis(
                     continue
                 else:
                     # Sauvegarder les fichiers par entité
-                    for entity in final_result["Ref_Entite.entité"].unique():
-                        entity_data = final_result[final_result["Ref_Entite.entité"] == entity]
-                        if entity_data.empty:
-                            continue
-                        buffer_entity = apply_to_template(entity_data, input_excel_path)
-                        folder_path_entity = f"{base_folder}/{currency}/Reports_by_entity/{entity}"
-                        file_name_entity = f"{folder_path_entity}/QIS_{export_type}_{currency}_{entity}.xlsx"
-                        zipf.writestr(file_name_entity, buffer_entity.getvalue())
+                    # Rendu des fichiers par entité sur le pool de workers
+                    jobs = [
+                        (f"{base_folder}/{currency}/Reports_by_entity/{entity}/QIS_{export_type}_{currency}_{entity}.xlsx", entity_data, input_excel_path)
+                        for entity, entity_data in split_by_entity(final_result)
+                    ]
+                    for file_name_entity, content in render_reports(jobs, render_workers):
+                        zipf.writestr(file_name_entity, content)
 
     print("Tous les fichiers QIS ont été ajoutés au ZIP.")
 
 def process_almm(preprocessed_data,
     data_path, ref_entite_path, ref_transfo_path, ref_almm_path, ref_adf_almm_path,
-    ref_dzone_almm_path, input_excel_path, run_timestamp, export_type, zip_buffer, entity=None, currency=None, indicator="ALL"
+    ref_dzone_almm_path, input_excel_path, run_timestamp, export_type, zip_buffer, entity=None, currency=None, indicator="ALL", render_workers=None
 ):
     """
     Processus pour traiter les données ALMM avec gestion spécifique des exports dans un ZIP.
     """
     base_folder = f"RUN_{run_timestamp}_{export_type}"  # Dossier racine dans le ZIP
 
-    with zipfile.ZipFile(zip_buffer, 'a') as zipf:
+    with open_zip_writer(zip_buffer) as zipf:
         if export_type == "GRAN":
             if not entity or not currency:
                 raise ValueError("Pour un export de type GRAN, une entité et une devise spécifiques doivent être fournies.")
 
-            print(f"Traitement GRAN pour l'entité '{entity}' et la devise '{currency}'...")
-
-            # Filtrer les données pour GRAN
-            if isinstance(preprocessed_data, pd.DataFrame):
-                # Si c'est un DataFrame, afficher ses colonnes
-                if "D_CU" not in preprocessed_data.columns:
-                    raise KeyError("La colonne 'D_CU' est absente dans les données prétraitées pour GRAN.")
-                if currency == "ALL":
-                    filtered_data = preprocessed_data
-                else:
-                    filtered_data = preprocessed_data[preprocessed_data["D_CU"] == currency]
-            elif isinstance(preprocessed_data, dict):
-                # Si c'est un dictionnaire, accéder à la clé "filtered_data"
-                if "filtered_data" in preprocessed_data:
-                    filtered_data = preprocessed_data["filtered_data"]
-                    if "D_CU" not in filtered_data.columns:
-                        raise KeyError("La colonne 'D_CU' est absente dans les données prétraitées pour GRAN.")
-                    if currency == "ALL":
-                        filtered_data = filtered_data
-                    else:
-                        filtered_data = filtered_data[filtered_data["D_CU"] == currency]
-                else:
-                    raise ValueError("La clé 'filtered_data' est absente dans preprocessed_lcr_data.")
-            else:
-                raise TypeError("preprocessed_lcr_data doit être un DataFrame ou un dictionnaire.")
-
-            # Vérifier si 'filtered_data' est valide
-            if filtered_data.empty:
-                st.error(f"Aucune donnée trouvée pour la devise '{currency}' dans l'export GRAN.")
+            print(f"Traitement GRAN pour l'entité '{', '.join(entity_list(entity))}' et la devise '{currency}'...")
 
-
-            # Étape 2 : Filtrer par indicateur
-            if indicator == "BILAN":
-                filtered_data = filtered_data[filtered_data["D_T1"] == "INTER"]
-            elif indicator == "CONSO":
-                filtered_data = filtered_data[filtered_data["D_T1"] != "INTER"]
-            elif indicator == "ALL":
-                filtered_data = filtered_data
-            else:
-                raise ValueError("Indicateur non pris en charge. Choisissez parmi ALL, BILAN, ou CONSO.")
-
-            if filtered_data.empty:
-                raise ValueError(f"Aucune donnée trouvée pour l'indicateur '{indicator}'.")
+            # Données de la devise et de la vue, comme dans la consultation GRAN
+            filtered_data = gran_view_data(preprocessed_data, currency, indicator)
 
             # Initialiser la classe ALMM
             almm_processor = ALMM(
@@ -425,44 +401,15 @@ def process_almm(preprocessed_data,
                 export_type=export_type,
             )
 
-            # Appliquer les transformations
-            result_after_entite = almm_processor.filter_and_join_ref_entite(filtered_data)
-            result_after_transfo = almm_processor.join_with_ref_transfo(result_after_entite)
-            result_with_dzone_almm = almm_processor.join_with_ref_dzone_almm(result_after_transfo)
-            result_with_almm = almm_processor.join_with_ref_almm(result_with_dzone_almm)
-            grouped_result = almm_processor.group_and_sum_unadjusted_p_amount(result_with_almm)
-            pivoted_and_reordered_result = almm_processor.pivot_and_reorder(grouped_result)
-            final_result_with_adf_almm = almm_processor.join_with_ref_adf_almm(pivoted_and_reordered_result)
-            final_result = almm_processor.add_adjusted_amounts(final_result_with_adf_almm)
-
-            # Filtrer par entité
-            final_result = final_result[final_result["Ref_Entite.entité"] == entity]
-
-            # Sauvegarder dans le ZIP
-            folder_path = f"{base_folder}/{currency}/Reports_by_entity/{entity}"
-            file_name = f"{folder_path}/ALMM_GRAN_{currency}_{entity}.xlsx"
-            with tempfile.TemporaryDirectory() as temp_dir:
-                temp_file_path = os.path.join(temp_dir, "temp_output.xlsx")
-                try:
-                    final_result.to_excel(temp_file_path, index=False, engine="xlsxwriter")
-                    zipf.write(temp_file_path, arcname=file_name)
-                except PermissionError as e:
-                    print(f"Erreur de permission lors de la création du fichier : {e}")
-                except Exception as e:
-                    print(f"Une erreur inattendue s'est produite : {e}")
+            final_result = indicator_chain("ALMM", almm_processor, filtered_data)
 
-        else:  # Cas ALL, BILAN, CONSO
-            for currency, file_path in preprocessed_data.items():
-                if not os.path.exists(file_path):
-                    print(f"Le fichier {file_path} n'existe pas. Aucun traitement pour cette devise.")
-                    continue
-
-                try:
-                    data_import_filtered = pd.read_excel(file_path, engine="openpyxl")
-                except Exception as e:
-                    print(f"Erreur lors de la lecture du fichier {file_path}: {e}")
-                    continue
+            # Un fichier par entité demandée, à partir du même résultat (sans template : pandas.to_excel)
+            jobs = gran_report_jobs(final_result, entity, base_folder, currency, "ALMM", None)
+            for file_name, content in render_reports(jobs, render_workers):
+                zipf.writestr(file_name, content)
 
+        else:  # Cas ALL, BILAN, CONSO
+            for currency, data_import_filtered in select_partitions(preprocessed_data, export_type).items():
                 if data_import_filtered.empty:
                     continue
 
@@ -481,43 +428,37 @@ def process_almm(preprocessed_data,
                 )
 
                 # Appliquer les transformations
-                result_after_entite = almm_processor.filter_and_join_ref_entite(data_import_filtered)
-                result_after_transfo = almm_processor.join_with_ref_transfo(result_after_entite)
-                result_with_dzone_almm = almm_processor.join_with_ref_dzone_almm(result_after_transfo)
-                result_with_almm = almm_processor.join_with_ref_almm(result_with_dzone_almm)
-                grouped_result = almm_processor.group_and_sum_unadjusted_p_amount(result_with_almm)
-                pivoted_and_reordered_result = almm_processor.pivot_and_reorder(grouped_result)
+                result_with_almm = almm_processor.join_with_ref_almm(data_import_filtered)
+                pivoted_and_reordered_result = almm_processor.aggregate_by_bucket(result_with_almm)
                 final_result_with_adf_almm = almm_processor.join_with_ref_adf_almm(pivoted_and_reordered_result)
                 final_result = almm_processor.add_adjusted_amounts(final_result_with_adf_almm)
 
                 # Sauvegarder le fichier global
                 folder_path_global = f"{base_folder}/{currency}/Reports_all_entities"
                 file_name_global = f"{folder_path_global}/ALMM_{export_type}_{currency}_All_Entities.xlsx"
-                with tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False) as temp_file:
-                    final_result.to_excel(temp_file.name, index=False, engine="xlsxwriter")
-                    zipf.write(temp_file.name, arcname=file_name_global)
+                # Écriture en flux (même contenu que to_excel avec xlsxwriter)
+                buffer = TEMPLATE_RENDERER.stream_dataframe(final_result)
+                zipf.writestr(file_name_global, buffer.getvalue())
                 
                 # Ne générer que les rapports globaux si export_type == 'ALL'
                 if export_type == 'ALL':
                     continue
                 else:
                     # Sauvegarder les fichiers par entité
-                    for entity in final_result["Ref_Entite.entité"].unique():
-                        entity_data = final_result[final_result["Ref_Entite.entité"] == entity]
-                        if entity_data.empty:
-                            continue
-                        folder_path_entity = f"{base_folder}/{currency}/Reports_by_entity/{entity}"
-                        file_name_entity = f"{folder_path_entity}/ALMM_{export_type}_{currency}_{entity}.xlsx"
-                        with tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False) as temp_file:
-                            entity_data.to_excel(temp_file.name, index=False, engine="xlsxwriter")
-                            zipf.write(temp_file.name, arcname=file_name_entity)
+                    # Rendu des fichiers par entité sur le pool de workers
+                    jobs = [
+                        (f"{base_folder}/{currency}/Reports_by_entity/{entity}/ALMM_{export_type}_{currency}_{entity}.xlsx", entity_data, None)
+                        for entity, entity_data in split_by_entity(final_result)
+                    ]
+                    for file_name_entity, content in render_reports(jobs, render_workers):
+                        zipf.writestr(file_name_entity, content)
 
     print("Tous les fichiers ALMM ont été ajoutés au ZIP.")
 
 
 def process_nsfr(preprocessed_data,
                  data_path, ref_entite_path, ref_transfo_path, ref_nsfr_path, ref_adf_nsfr_path, ref_dzone_nsfr_path,
-                 input_excel_path, run_timestamp, export_type, zip_buffer, entity=None, currency=None, indicator="ALL"):
+                 input_excel_path, run_timestamp, export_type, zip_buffer, entity=None, currency=None, indicator="ALL", render_workers=None):
     """
     Processus de traitement des données NSFR avec intégration des résultats dans un fichier template
     et gestion des exports structurés dans un ZIP.
@@ -527,48 +468,15 @@ def process_nsfr(preprocessed_data,
 
     base_folder = f"RUN_{run_timestamp}_{export_type}"  # Dossier racine dans le ZIP
 
-    with zipfile.ZipFile(zip_buffer, 'a') as zipf:
+    with open_zip_writer(zip_buffer) as zipf:
         if export_type == "GRAN":
             if not entity or not currency:
                 raise ValueError("Pour un export de type GRAN, une entité et une devise spécifiques doivent être fournies.")
 
-            print(f"Traitement GRAN pour l'entité '{entity}' et la devise '{currency}'...")
-
-            # Filtrer les données pour GRAN
-            if isinstance(preprocessed_data, pd.DataFrame):
-                if "D_CU" not in preprocessed_data.columns:
-                    raise KeyError("La colonne 'D_CU' est absente dans les données prétraitées pour GRAN.")
-                if currency == "ALL":
-                    filtered_data = preprocessed_data
-                else:
-                    filtered_data = preprocessed_data[preprocessed_data["D_CU"] == currency]
-            elif isinstance(preprocessed_data, dict):
-                if "filtered_data" in preprocessed_data:
-                    filtered_data = preprocessed_data["filtered_data"]
-                    if "D_CU" not in filtered_data.columns:
-                        raise KeyError("La colonne 'D_CU' est absente dans les données prétraitées pour GRAN.")
-                    if currency == "ALL":
-                        filtered_data = filtered_data
-                    else:
-                        filtered_data = filtered_data[filtered_data["D_CU"] == currency]
-                else:
-                    raise ValueError("La clé 'filtered_data' est absente dans preprocessed_data.")
-            else:
-                raise TypeError("preprocessed_data doit être un DataFrame ou un dictionnaire.")
+            print(f"Traitement GRAN pour l'entité '{', '.join(entity_list(entity))}' et la devise '{currency}'...")
 
-            if filtered_data.empty:
-                raise ValueError(f"Aucune donnée trouvée pour la devise '{currency}' dans l'export GRAN.")
-
-            # Étape 2 : Filtrer par indicateur
-            if indicator == "BILAN":
-                filtered_data = filtered_data[filtered_data["D_T1"] == "INTER"]
-            elif indicator == "CONSO":
-                filtered_data = filtered_data[filtered_data["D_T1"] != "INTER"]
-            elif indicator != "ALL":
-                raise ValueError("Indicateur non pris en charge. Choisissez parmi ALL, BILAN, ou CONSO.")
-
-            if filtered_data.empty:
-                raise ValueError(f"Aucune donnée trouvée pour l'indicateur '{indicator}'.")
+            # Données de la devise et de la vue, comme dans la consultation GRAN
+            filtered_data = gran_view_data(preprocessed_data, currency, indicator)
 
             # Initialiser le processeur NSFR
             nsfr_processor = NSFR(
@@ -582,39 +490,15 @@ def process_nsfr(preprocessed_data,
                 export_type=export_type,
             )
 
-            # Étapes de transformation
-            result_after_entite = nsfr_processor.filter_and_join_ref_entite(filtered_data)
-            result_after_transfo = nsfr_processor.join_with_ref_transfo(result_after_entite)
-            result_with_dzone_nsfr = nsfr_processor.join_with_ref_dzone_nsfr(result_after_transfo)
-            result_with_nsfr = nsfr_processor.join_with_ref_nsfr(result_with_dzone_nsfr)
-            grouped_result = nsfr_processor.group_and_sum_unadjusted_p_amount(result_with_nsfr)
-            pivoted_and_reordered_result = nsfr_processor.pivot_and_reorder(grouped_result)
-            final_result_with_adf_nsfr = nsfr_processor.join_with_ref_adf_nsfr(pivoted_and_reordered_result)
-            final_result = nsfr_processor.add_adjusted_amounts(final_result_with_adf_nsfr)
-
-            # Filtrer par entité
-            final_result = final_result[final_result["Ref_Entite.entité"] == entity]
-
-            # Transition vers le fichier template
-            buffer = apply_to_template(final_result, input_excel_path)
+            final_result = indicator_chain("NSFR", nsfr_processor, filtered_data)
 
-            # Ajouter au ZIP
-            folder_path = f"{base_folder}/{currency}/Reports_by_entity/{entity}"
-            file_name = f"{folder_path}/NSFR_GRAN_{currency}_{entity}.xlsx"
-            zipf.writestr(file_name, buffer.getvalue())
+            # Un fichier par entité demandée, à partir du même résultat
+            jobs = gran_report_jobs(final_result, entity, base_folder, currency, "NSFR", input_excel_path)
+            for file_name, content in render_reports(jobs, render_workers):
+                zipf.writestr(file_name, content)
 
         else:  # Cas ALL, BILAN, CONSO
-            for currency, file_path in preprocessed_data.items():
-                if not os.path.exists(file_path):
-                    print(f"Le fichier {file_path} n'existe pas. Aucun traitement pour cette devise.")
-                    continue
-
-                try:
-                    data_import_filtered = pd.read_excel(file_path, engine="openpyxl")
-                except Exception as e:
-                    print(f"Erreur lors de la lecture du fichier {file_path}: {e}")
-                    continue
-
+            for currency, data_import_filtered in select_partitions(preprocessed_data, export_type).items():
                 if data_import_filtered.empty:
                     continue
 
@@ -632,17 +516,13 @@ def process_nsfr(preprocessed_data,
                 )
 
                 # Étapes de transformation
-                result_after_entite = nsfr_processor.filter_and_join_ref_entite(data_import_filtered)
-                result_after_transfo = nsfr_processor.join_with_ref_transfo(result_after_entite)
-                result_with_dzone_nsfr = nsfr_processor.join_with_ref_dzone_nsfr(result_after_transfo)
-                result_with_nsfr = nsfr_processor.join_with_ref_nsfr(result_with_dzone_nsfr)
-                grouped_result = nsfr_processor.group_and_sum_unadjusted_p_amount(result_with_nsfr)
-                pivoted_and_reordered_result = nsfr_processor.pivot_and_reorder(grouped_result)
+                result_with_nsfr = nsfr_processor.join_with_ref_nsfr(data_import_filtered)
+                pivoted_and_reordered_result = nsfr_processor.aggregate_by_bucket(result_with_nsfr)
                 final_result_with_adf_nsfr = nsfr_processor.join_with_ref_adf_nsfr(pivoted_and_reordered_result)
                 final_result = nsfr_processor.add_adjusted_amounts(final_result_with_adf_nsfr)
 
                 # Transition vers le fichier template global
-                buffer = apply_to_template(final_result, input_excel_path)
+                buffer = apply_to_template(final_result, input_excel_path, streaming=True)
 
                 # Ajouter au ZIP
                 folder_path = f"{base_folder}/{currency}/Reports_all_entities"
@@ -656,14 +536,13 @@ def process_nsfr(preprocessed_data,
                 
                 else:
                     # Sauvegarder les fichiers par entité
-                    for entity in final_result["Ref_Entite.entité"].unique():
-                        entity_data = final_result[final_result["Ref_Entite.entité"] == entity]
-                        if entity_data.empty:
-                            continue
-                        buffer_entity = apply_to_template(entity_data, input_excel_path)
-                        folder_path_entity = f"{base_folder}/{currency}/Reports_by_entity/{entity}"
-                        file_name_entity = f"{folder_path_entity}/NSFR_{export_type}_{currency}_{entity}.xlsx"
-                        zipf.writestr(file_name_entity, buffer_entity.getvalue())
+                    # Rendu des fichiers par entité sur le pool de workers
+                    jobs = [
+                        (f"{base_folder}/{currency}/Reports_by_entity/{entity}/NSFR_{export_type}_{currency}_{entity}.xlsx", entity_data, input_excel_path)
+                        for entity, entity_data in split_by_entity(final_result)
+                    ]
+                    for file_name_entity, content in render_reports(jobs, render_workers):
+                        zipf.writestr(file_name_entity, content)
 
     print("Tous les fichiers NSFR ont été ajoutés au ZIP.")
 
@@ -671,46 +550,22 @@ def process_nsfr(preprocessed_data,
 
 def process_lcr(preprocessed_lcr_data,
                 data_path, ref_entite_path, ref_transfo_path, ref_lcr_path, ref_adf_lcr_path,
-                input_excel_path, run_timestamp, export_type, zip_buffer, entity=None, currency=None, indicator="ALL"):
+                input_excel_path, run_timestamp, export_type, zip_buffer, entity=None, currency=None, indicator="ALL", render_workers=None):
     """
     Processus de traitement des données LCR avec transition directe des données dans un fichier template
     et stockage des fichiers générés dans un ZIP en mémoire.
     """
     base_folder = f"RUN_{run_timestamp}_{export_type}"  # Dossier racine dans le ZIP
 
-    with zipfile.ZipFile(zip_buffer, 'a') as zipf:
+    with open_zip_writer(zip_buffer) as zipf:
         if export_type == "GRAN":
             if not entity or not currency:
                 raise ValueError("Pour un export de type GRAN, une entité et une devise spécifiques doivent être fournies.")
 
-            print(f"Traitement GRAN pour l'entité '{entity}' et la devise '{currency}'...")
+            print(f"Traitement GRAN pour l'entité '{', '.join(entity_list(entity))}' et la devise '{currency}'...")
 
-            # Filtrer les données pour GRAN
-            if isinstance(preprocessed_lcr_data, pd.DataFrame):
-                if "D_CU" not in preprocessed_lcr_data.columns:
-                    raise KeyError("La colonne 'D_CU' est absente dans les données prétraitées pour GRAN.")
-                if currency == "ALL":
-                    filtered_data = preprocessed_lcr_data
-                else:
-                    filtered_data = preprocessed_lcr_data[preprocessed_lcr_data["D_CU"] == currency]
-            elif isinstance(preprocessed_lcr_data, dict):
-                if "filtered_data" in preprocessed_lcr_data:
-                    filtered_data = preprocessed_lcr_data["filtered_data"]
-                    if "D_CU" not in filtered_data.columns:
-                        raise KeyError("La colonne 'D_CU' est absente dans les données prétraitées pour GRAN.")
-                    if currency == "ALL":
-                        filtered_data = filtered_data
-                    else:
-                        filtered_data = filtered_data[filtered_data["D_CU"] == currency]
-                else:
-                    raise ValueError("La clé 'filtered_data' est absente dans preprocessed_lcr_data.")
-            else:
-                raise TypeError("preprocessed_lcr_data doit être un DataFrame ou un dictionnaire.")
-
-            # Vérification des données filtrées
-            if filtered_data.empty:
-                print(f"Attention : aucune donnée trouvée pour la devise '{currency}' avec export GRAN.")
-                return
+            # Données de la devise et de la vue, comme dans la consultation GRAN
+            filtered_data = gran_view_data(preprocessed_lcr_data, currency, indicator)
 
             # Initialiser le processeur LCR
             lcr_processor = LCR(
@@ -724,43 +579,16 @@ def process_lcr(preprocessed_lcr_data,
                 export_type=export_type,
             )
 
-            # Étapes de transformation
-            result_after_entite = lcr_processor.filter_and_join_ref_entite(filtered_data)
-            result_after_transfo = lcr_processor.join_with_ref_transfo(result_after_entite)
-            result_after_lcr = lcr_processor.join_with_ref_lcr(result_after_transfo)
-            result_with_amount = lcr_processor.add_unadjusted_p_amount(result_after_lcr)
-            grouped_result = lcr_processor.group_and_sum(result_with_amount)
-            result_with_adf = lcr_processor.join_with_ref_adf_lcr(grouped_result)
-            final_result = lcr_processor.add_adjusted_amount(result_with_adf)
-            final_result = final_result[final_result["Ref_Entite.entité"] == entity]
-
-            # Vérification des données finales
-            if final_result.empty:
-                print(f"Aucune donnée à exporter pour l'entité '{entity}' et la devise '{currency}'.")
-                return
-
-            # Transition vers le fichier template
-            buffer = apply_to_template(final_result, input_excel_path)
-
-            if buffer.getvalue() == b"":
-                print("Le buffer est vide ! Vérifiez la fonction apply_to_template.")
-                return
-
-            # Ajouter au ZIP
-            folder_path = f"{base_folder}/{currency}/Reports_by_entity/{entity}"
-            file_name = f"{folder_path}/LCR_GRAN_{currency}_{entity}.xlsx"
-            print(f"Écriture dans le ZIP : {file_name}")
-            zipf.writestr(file_name, buffer.getvalue())
+            final_result = indicator_chain("LCR", lcr_processor, filtered_data)
 
-        else:  # Pour ALL, BILAN, CONSO
-            for currency, filtered_data in preprocessed_lcr_data.items():
-                if isinstance(filtered_data, str):
-                    try:
-                        filtered_data = pd.read_excel(filtered_data, engine="openpyxl")
-                    except Exception as e:
-                        print(f"Erreur lors de la lecture du fichier {filtered_data}: {e}")
-                        continue
+            # Un fichier par entité demandée, à partir du même résultat ; pas de fichier sans données
+            jobs = gran_report_jobs(final_result, entity, base_folder, currency, "LCR", input_excel_path)
+            for file_name, content in render_reports(jobs, render_workers):
+                print(f"Écriture dans le ZIP : {file_name}")
+                zipf.writestr(file_name, content)
 
+        else:  # Pour ALL, BILAN, CONSO
+            for currency, filtered_data in select_partitions(preprocessed_lcr_data, export_type).items():
                 if filtered_data.empty:
                     continue
 
@@ -779,9 +607,7 @@ def process_lcr(preprocessed_lcr_data,
                 )
 
                 # Transformation des données
-                result_after_entite = lcr_processor.filter_and_join_ref_entite(filtered_data)
-                result_after_transfo = lcr_processor.join_with_ref_transfo(result_after_entite)
-                result_after_lcr = lcr_processor.join_with_ref_lcr(result_after_transfo)
+                result_after_lcr = lcr_processor.join_with_ref_lcr(filtered_data)
                 result_with_amount = lcr_processor.add_unadjusted_p_amount(result_after_lcr)
                 grouped_result = lcr_processor.group_and_sum(result_with_amount)
                 result_with_adf = lcr_processor.join_with_ref_adf_lcr(grouped_result)
@@ -789,59 +615,41 @@ def process_lcr(preprocessed_lcr_data,
 
 
                 # Transition vers le fichier template global
-                buffer = apply_to_template(final_result, input_excel_path)
+                buffer = apply_to_template(final_result, input_excel_path, streaming=True)
 
                 # Ajouter au ZIP
                 folder_path_global = f"{base_folder}/{currency}/Reports_all_entities"
                 file_name_global = f"{folder_path_global}/LCR_{export_type}_{currency}_All_Entities.xlsx"
-                with zipfile.ZipFile(zip_buffer, "a") as zipf:
-                    zipf.writestr(file_name_global, buffer.getvalue())
+                zipf.writestr(file_name_global, buffer.getvalue())
                     
                 # Ne générer que les rapports globaux si export_type == 'ALL'
                 if export_type == 'ALL':
                     continue
                 else:
                     # Sauvegarder les fichiers par entité
-                    for entity in final_result["Ref_Entite.entité"].unique():
-                        entity_data = final_result[final_result["Ref_Entite.entité"] == entity]
-                        if entity_data.empty:
-                            continue
-                        buffer_entity = apply_to_template(entity_data, input_excel_path)
-                        folder_path_entity = f"{base_folder}/{currency}/Reports_by_entity/{entity}"
-                        file_name_entity = f"{folder_path_entity}/LCR_{export_type}_{currency}_{entity}.xlsx"
-                        with zipfile.ZipFile(zip_buffer, "a") as zipf:
-                            zipf.writestr(file_name_entity, buffer_entity.getvalue())
+                    # Rendu des fichiers par entité sur le pool de workers
+                    jobs = [
+                        (f"{base_folder}/{currency}/Reports_by_entity/{entity}/LCR_{export_type}_{currency}_{entity}.xlsx", entity_data, input_excel_path)
+                        for entity, entity_data in split_by_entity(final_result)
+                    ]
+                    for file_name_entity, content in render_reports(jobs, render_workers):
+                        zipf.writestr(file_name_entity, content)
 
 
-def apply_to_template(dataframe, template_path):
+def apply_to_template(dataframe, template_path, streaming=False):
     """
     Applique les données d'un DataFrame dans un fichier de template.
     Les colonnes du DataFrame doivent correspondre exactement à celles du template.
+    Le template n'est chargé qu'une fois par processus (voir TemplateRenderer).
     
     :param dataframe: DataFrame contenant les données à insérer.
     :param template_path: Chemin du fichier Excel template.
+    :param streaming: Si True, écrit les lignes en flux dans le XML de la feuille (rapports All_Entities).
     :return: Un buffer contenant le fichier Excel modifié.
     """
-    buffer = BytesIO()
-    
-    # Charger le template
-    workbook = load_workbook(template_path)
-    sheet = workbook.active  # Utiliser la première feuille
-
-    # Effacer les données existantes dans la feuille (à partir de la 2e ligne)
-    for row in sheet.iter_rows(min_row=2, max_row=sheet.max_row, min_col=1, max_col=sheet.max_column):
-        for cell in row:
-            cell.value = None
-
-    # Insérer les données du DataFrame dans le template
-    for i, row in enumerate(dataframe.values, start=2):  # Commence à la ligne 2
-        for j, value in enumerate(row, start=1):  # Commence à la colonne 1
-            sheet.cell(row=i, column=j, value=value)
-
-    # Sauvegarder dans un buffer en mémoire
-    workbook.save(buffer)
-    buffer.seek(0)
-    return buffer
+    if streaming:
+        return TEMPLATE_RENDERER.stream(dataframe, template_path)
+    return TEMPLATE_RENDERER.render(dataframe, template_path)
 
 def add_file_to_zip(zip_buffer, file_path, arcname):
     """
@@ -857,6 +665,17 @@ def add_file_to_zip(zip_buffer, file_path, arcname):
     except Exception as e:
         raise RuntimeError(f"Erreur lors de l'ajout du fichier {file_path} au ZIP : {e}")
                             
+def count_zip_files(zip_buffer) -> int:
+    """
+    Nombre de fichiers déjà écrits dans le ZIP de sortie (lecture du répertoire central uniquement).
+
+    :param zip_buffer: Buffer ZIP (BytesIO) ou chemin du ZIP, fermé par ses écrivains.
+    :return: Nombre de fichiers.
+    """
+    with zipfile.ZipFile(zip_buffer) as zipf:
+        return len(zipf.namelist())
+
+
 def validate_zip_content(zip_buffer, expected_files):
     """
     Valide que tous les fichiers attendus sont dans le buffer ZIP.
@@ -871,26 +690,41 @@ def validate_zip_content(zip_buffer, expected_files):
             raise ValueError(f"Les fichiers suivants manquent dans le ZIP : {missing_files}")
 
 
-def execute_processes_in_parallel(processes):
+def execute_processes_in_parallel(processes, use_processes=False, max_workers=None, progress_callback=None):
     """
     Exécute plusieurs processus en parallèle.
 
+    Les process_* ne doivent pas ouvrir eux-mêmes un buffer ZIP partagé : leur passer le `writer`
+    d'un ZipSink, qui envoie les fichiers rendus à un unique thread d'écriture.
+
     :param processes: Liste de tuples contenant une fonction à exécuter et ses arguments.
     Format : [(fonction, (arg1, arg2, ...)), ...]
+    :param use_processes: Si True, utilise un pool de processus (travail pandas/openpyxl lié au CPU)
+        au lieu d'un pool de threads.
+    :param max_workers: Nombre maximal de workers (par défaut : valeur de concurrent.futures).
+    :param progress_callback: Fonction appelée avec (nom, nombre terminé, total) à la fin de chaque processus.
     :return: Résultats et erreurs des processus.
     """
-    from concurrent.futures import ThreadPoolExecutor, as_completed
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
     
     results = {}
     errors = {}
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
 
-    with ThreadPoolExecutor() as executor:
+    with executor_class(max_workers=max_workers) as executor:
         # Soumettre toutes les tâches
-        future_to_process = {
-            executor.submit(func, *args): func.__name__ for func, args in processes
-        }
+        future_to_process = {}
+        for func, args in processes:
+            if use_processes:
+                # Les workers retrouvent la fonction par le nom de son fichier (voir run_named_process)
+                module_file = sys.modules[func.__module__].__file__
+                module_name = os.path.splitext(os.path.basename(module_file))[0]
+                future = executor.submit(run_named_process, module_name, func.__name__, tuple(args))
+            else:
+                future = executor.submit(func, *args)
+            future_to_process[future] = func.__name__
 
-        for future in as_completed(future_to_process):
+        for done, future in enumerate(as_completed(future_to_process), start=1):
             func_name = future_to_process[future]
             try:
                 result = future.result()  # Récupérer le résultat de la fonction
@@ -898,6 +732,9 @@ def execute_processes_in_parallel(processes):
             except Exception as e:
                 errors[func_name] = str(e)  # Capturer l'exception
 
+            if progress_callback:
+                progress_callback(func_name, done, len(future_to_process))
+
     return results, errors
 
 
@@ -984,15 +821,19 @@ def remove_duplicate_xlsx_files(hierarchy_df: pd.DataFrame) -> pd.DataFrame:
 
     return hierarchy_df.loc[rows_to_keep].reset_index(drop=True)
 
-def extract_hierarchy_from_zip(zip_buffer):
+def extract_hierarchy_from_zip(zip_buffer, prefix=None):
     """
     Extrait la hiérarchie des fichiers d'un ZIP en mémoire et structure la sortie en niveaux,
     avec suppression des doublons pour chaque niveau, sauf pour le Level 1.
     :param zip_buffer: Le buffer ZIP en mémoire.
+    :param prefix: Si fourni, seuls les fichiers dont le chemin commence par ce préfixe (ou l'un de ces
+        préfixes, tuple) sont retenus, par exemple le dossier RUN d'un type d'export.
     :return: Un DataFrame représentant la hiérarchie des fichiers dans le ZIP.
     """
     with zipfile.ZipFile(zip_buffer, 'r') as zipf:
         file_list = zipf.namelist()  # Liste des fichiers dans le ZIP
+    if prefix is not None:
+        file_list = [file_path for file_path in file_list if file_path.startswith(prefix)]
 
     # Construire la hiérarchie
     hierarchy = {}
@@ -1279,7 +1120,8 @@ def save_excel_with_structure(
     st.success("Données sauvegardées avec succès dans le ZIP.")
 
 
-def generate_import_files(uploaded_data, run_timestamp, zip_buffer, import_folder):
+def generate_import_files(uploaded_data, run_timestamp, zip_buffer, import_folder, source_bytes=None,
+                          source_suffix=".xlsx"):
         """
         Génère les fichiers d'import BILAN et CONSO pour les devises ALL, EUR, et USD,
         et les ajoute dans un dossier compressé au sein du ZIP final.
@@ -1288,6 +1130,10 @@ def generate_import_files(uploaded_data, run_timestamp, zip_buffer, import_folde
         :param run_timestamp: Timestamp pour nommer le dossier d'import.
         :param zip_buffer: Buffer ZIP où les fichiers seront ajoutés.
         :param import_folder: Nom du dossier où placer les fichiers dans le ZIP.
+        :param source_bytes: Contenu brut du fichier téléchargé ; s'il est fourni, il est copié tel quel
+            dans IMPORT_SOURCE.xlsx au lieu de réécrire le DataFrame.
+        :param source_suffix: Extension du fichier téléchargé (.xlsx, .csv, .parquet, ...), reprise pour
+            IMPORT_SOURCE lorsque `source_bytes` est fourni.
         """
         # Filtrages
         bilan_data = uploaded_data[uploaded_data["D_T1"] == "INTER"]
@@ -1318,6 +1164,12 @@ def generate_import_files(uploaded_data, run_timestamp, zip_buffer, import_folde
 
         # Sauvegarder le fichier importé brut
         imported_file = f"{import_folder}/IMPORT_SOURCE.xlsx"
+        if source_bytes is not None:
+            with zipfile.ZipFile(zip_buffer, "a") as zipf:
+                zipf.writestr(f"{import_folder}/IMPORT_SOURCE{source_suffix}", source_bytes)
+            print(f"Fichiers d'import sauvegardés dans le dossier : {import_folder}")
+            return
+
         with tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx") as temp_imported_file:
             uploaded_data.to_excel(temp_imported_file.name, index=False, engine="xlsxwriter")
             with zipfile.ZipFile(zip_buffer, "a") as zipf:
@@ -1325,6 +1177,838 @@ def generate_import_files(uploaded_data, run_timestamp, zip_buffer, import_folde
 
         print(f"Fichiers d'import sauvegardés dans le dossier : {import_folder}")
 
+class StreamingImportFiles:
+    """
+    Équivalent de generate_import_files pour le mode streaming : les fichiers IMPORT_{vue}_{devise}.xlsx
+    sont écrits bloc par bloc au fil de la lecture (xlsxwriter en mémoire constante), puis ajoutés au ZIP.
+    """
+
+    def __init__(self, temp_dir):
+        """
+        :param temp_dir: Dossier temporaire où les fichiers sont écrits avant d'être ajoutés au ZIP.
+        """
+        self._files = {}
+        for curr in ["ALL", "EUR", "USD"]:
+            for view in ["BILAN", "CONSO"]:
+                path = os.path.join(temp_dir, f"IMPORT_{view}_{curr}.xlsx")
+                workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+                self._files[(view, curr)] = {"path": path, "workbook": workbook, "sheet": workbook.add_worksheet(), "row": 0}
+
+    def _write_rows(self, target, data):
+        sheet = target["sheet"]
+        if target["row"] == 0:
+            # En-têtes sans mise en forme, comme DataFrame.to_excel
+            for col, name in enumerate(data.columns):
+                sheet.write(0, col, name)
+            target["row"] = 1
+
+        for values in data.itertuples(index=False, name=None):
+            for col, value in enumerate(values):
+                # Cellules vides pour les valeurs manquantes (na_rep="" de to_excel)
+                if not pd.isna(value):
+                    sheet.write(target["row"], col, value.item() if isinstance(value, np.generic) else value)
+            target["row"] += 1
+
+    def write_chunk(self, chunk: pd.DataFrame):
+        """
+        Ajoute un bloc nettoyé et typé aux fichiers BILAN et CONSO de chaque devise.
+
+        :param chunk: Bloc de données (toutes les colonnes).
+        """
+        views = {"BILAN": chunk[chunk["D_T1"] == "INTER"], "CONSO": chunk[chunk["D_T1"] != "INTER"]}
+        for (view, curr), target in self._files.items():
+            data = views[view] if curr == "ALL" else views[view][views[view]["D_CU"] == curr]
+            self._write_rows(target, data)
+
+    def close(self, zip_buffer, import_folder, source_bytes, source_suffix=".xlsx"):
+        """
+        Termine les fichiers et les ajoute au ZIP, avec le fichier importé brut (IMPORT_SOURCE).
+
+        :param zip_buffer: Buffer ZIP où les fichiers seront ajoutés.
+        :param import_folder: Nom du dossier où placer les fichiers dans le ZIP.
+        :param source_bytes: Contenu brut du fichier téléchargé.
+        :param source_suffix: Extension du fichier téléchargé, reprise pour IMPORT_SOURCE.
+        """
+        with zipfile.ZipFile(zip_buffer, "a") as zipf:
+            for (view, curr), target in self._files.items():
+                target["workbook"].close()
+                zipf.write(target["path"], arcname=f"{import_folder}/IMPORT_{view}_{curr}.xlsx")
+            zipf.writestr(f"{import_folder}/IMPORT_SOURCE{source_suffix}", source_bytes)
+        print(f"Fichiers d'import sauvegardés dans le dossier : {import_folder}")
+
+def missing_input_columns(columns) -> list:
+    """
+    Colonnes attendues (expected_columns) absentes du fichier importé.
+
+    :param columns: Colonnes du fichier importé.
+    :return: Liste des colonnes manquantes (vide si le fichier est conforme).
+    """
+    return [col for col in expected_columns if col not in columns]
+
+
+def indicator_processes(preprocessed_data, input_file_path, run_timestamp, export_type, zip_buffer,
+                        entity=None, currency=None, indicator=None, render_workers=None) -> dict:
+    """
+    Fonctions process_* des indicateurs et leurs arguments pour un export.
+
+    :param preprocessed_data: Partitions {(vue, devise): DataFrame}, ou {"filtered_data": DataFrame} pour GRAN.
+    :param input_file_path: Chemin du fichier importé.
+    :param run_timestamp: Timestamp du traitement.
+    :param export_type: Type d'export (ALL, BILAN, CONSO, GRAN).
+    :param zip_buffer: Buffer ZIP (BytesIO) ou chemin du ZIP de sortie.
+    :param entity: Entité ou liste d'entités (GRAN uniquement, "ALL" pour toutes).
+    :param currency: Devise (GRAN uniquement).
+    :param indicator: Vue (GRAN uniquement).
+    :param render_workers: Nombre de workers pour le rendu des rapports par entité.
+    :return: Dictionnaire {indicateur: {"func": fonction, "args": liste d'arguments}}.
+    """
+    return {
+        "NSFR": {
+            "func": process_nsfr,
+            "args": [
+                preprocessed_data, input_file_path, "./Ref 2/ref_entite.xlsx",
+                "./Ref 2/ref_transfo_l1.xlsx", "./Ref 2/ref_nsfr.xlsx",
+                "./Ref 2/ref_nsfr_adf.xlsx", "./Ref 2/ref_dzone_nsfr.xlsx",
+                "./Livrable/Templates/NSFR_Template.xlsx", run_timestamp,
+                export_type, zip_buffer, entity, currency, indicator, render_workers
+            ],
+        },
+        "LCR": {
+            "func": process_lcr,
+            "args": [
+                preprocessed_data, input_file_path, "./Ref 2/ref_entite.xlsx",
+                "./Ref 2/ref_transfo_l1.xlsx", "./Ref 2/ref_lcr.xlsx",
+                "./Ref 2/ref_lcr_adf.xlsx", "./Livrable/Templates/LCR_Template.xlsx",
+                run_timestamp, export_type, zip_buffer, entity, currency, indicator, render_workers
+            ],
+        },
+        "QIS": {
+            "func": process_qis,
+            "args": [
+                preprocessed_data, input_file_path, "./Ref 2/ref_entite.xlsx",
+                "./Ref 2/ref_transfo_l1.xlsx", "./Ref 2/Ref_QIS.xlsx",
+                "./Ref 2/ref_nsfr_adf.xlsx", "./Ref 2/ref_dzone_nsfr.xlsx",
+                "./Livrable/Templates/QIS_Template.xlsx", run_timestamp,
+                export_type, zip_buffer, entity, currency, indicator, render_workers
+            ],
+        },
+        "ALMM": {
+            "func": process_almm,
+            "args": [
+                preprocessed_data, input_file_path, "./Ref 2/ref_entite.xlsx",
+                "./Ref 2/ref_transfo_l1.xlsx", "./Ref 2/ref_nsfr.xlsx",
+                "./Ref 2/ref_nsfr_adf.xlsx", "./Ref 2/ref_dzone_nsfr.xlsx",
+                "./Livrable/Templates/ALMM_Template.xlsx", run_timestamp,
+                export_type, zip_buffer, entity, currency, indicator, render_workers
+            ],
+        },
+        "AER": {
+            "func": process_aer,
+            "args": [
+                preprocessed_data, input_file_path, "./Ref 2/ref_entite.xlsx",
+                "./Ref 2/ref_transfo_l1.xlsx", "./Ref 2/ref_aer.xlsx",
+                "./Ref 2/ref_aer_adf.xlsx", "./Livrable/Templates/AER_Template.xlsx",
+                run_timestamp, export_type, zip_buffer, entity, currency, indicator, render_workers
+            ],
+        },
+    }
+
+
+# Templates des rapports GRAN par indicateur (ALMM est écrit sans template)
+GRAN_TEMPLATES = {
+    "NSFR": "./Livrable/Templates/NSFR_Template.xlsx",
+    "LCR": "./Livrable/Templates/LCR_Template.xlsx",
+    "QIS": "./Livrable/Templates/QIS_Template.xlsx",
+    "ALMM": None,
+    "AER": "./Livrable/Templates/AER_Template.xlsx",
+}
+
+
+def indicator_result(name, data, run_timestamp, export_type="GRAN") -> pd.DataFrame:
+    """
+    Résultat final d'un indicateur pour la consultation GRAN, sans rendu : mêmes références que les
+    process_* et même enchaînement (voir indicator_chain).
+
+    :param name: Nom de l'indicateur (NSFR, LCR, QIS, ALMM, AER).
+    :param data: Données après le préfixe commun (voir build_shared_prefixes).
+    :param run_timestamp: Timestamp du traitement.
+    :param export_type: Type d'export transmis au moteur de l'indicateur.
+    :return: Résultat final de l'indicateur.
+    """
+    if name == "NSFR":
+        processor = NSFR(data, "./Ref 2/ref_entite.xlsx", "./Ref 2/ref_transfo_l1.xlsx", "./Ref 2/ref_nsfr.xlsx",
+                         "./Ref 2/ref_nsfr_adf.xlsx", "./Ref 2/ref_dzone_nsfr.xlsx", run_timestamp, export_type)
+    elif name == "LCR":
+        processor = LCR(data, "./Ref 2/ref_entite.xlsx", "./Ref 2/ref_transfo_l1.xlsx", "./Ref 2/ref_lcr.xlsx",
+                        "./Ref 2/ref_lcr_adf.xlsx", GRAN_TEMPLATES["LCR"], run_timestamp, export_type)
+    elif name == "QIS":
+        processor = QIS(data, "./Ref 2/ref_entite.xlsx", "./Ref 2/ref_transfo_l1.xlsx", "./Ref 2/Ref_QIS.xlsx",
+                        "./Ref 2/ref_nsfr_adf.xlsx", "./Ref 2/ref_dzone_nsfr.xlsx", run_timestamp, export_type)
+    elif name == "ALMM":
+        processor = ALMM(data, "./Ref 2/ref_entite.xlsx", "./Ref 2/ref_transfo_l1.xlsx", "./Ref 2/ref_nsfr.xlsx",
+                         "./Ref 2/ref_nsfr_adf.xlsx", "./Ref 2/ref_dzone_nsfr.xlsx", run_timestamp, export_type)
+    elif name == "AER":
+        processor = AER(data, "./Ref 2/ref_entite.xlsx", "./Ref 2/ref_transfo_l1.xlsx", "./Ref 2/ref_aer.xlsx",
+                        "./Ref 2/ref_aer_adf.xlsx", run_timestamp, export_type)
+    else:
+        raise ValueError(f"Indicateur non pris en charge : {name}.")
+    return indicator_chain(name, processor, data)
+
+
+def build_result_cube(uploaded_data, run_timestamp, categorical_mode=False) -> ResultCube:
+    """
+    Prépare la consultation GRAN d'un fichier importé : prétraitement, cube et préfixe commun sont
+    calculés une seule fois, puis chaque résultat d'indicateur est conservé dans un ResultCube.
+
+    :param uploaded_data: DataFrame produit par ingest_data.
+    :param run_timestamp: Timestamp du traitement.
+    :param categorical_mode: Encodage catégoriel des dimensions (comme dans run_matrix).
+    :return: ResultCube dont les résultats sont calculés à la première demande (voir ResultCube.build).
+    """
+    partitions = preprocess_all_data(
+        data_path=uploaded_data,
+        ref_entite_path="./Ref 2/ref_entite.xlsx",
+        ref_transfo_path="./Ref 2/ref_transfo_l1.xlsx",
+        ref_lcr_path="./Ref 2/ref_lcr.xlsx",
+        ref_adf_lcr_path="./Ref 2/ref_lcr_adf.xlsx",
+        input_excel_path="./Livrable/Templates/LCR_Template.xlsx",
+        run_timestamp=run_timestamp,
+        export_type="ALL",
+    )
+    # Données GRAN d'une devise : partition (ALL, devise), comme dans run_matrix
+    partitions = select_partitions(partitions, "ALL")
+    if categorical_mode:
+        partitions = encode_dimensions(partitions, "./Ref 2/ref_entite.xlsx", "./Ref 2/ref_transfo_l1.xlsx")
+    partitions = build_shared_prefixes(
+        build_cubes(partitions), "./Ref 2/ref_entite.xlsx",
+        columns=required_columns(INDICATOR_CLASSES.values()),
+    )
+    return ResultCube(partitions, lambda name, data: indicator_result(name, data, run_timestamp))
+
+
+def write_kpi_file(zipf, temp_dir, export_type, hierarchy_df, arcname, entity=None, selected_processes="ALL"):
+    """
+    Ajoute au ZIP le fichier des occurrences (entités et indicateurs) d'un export BILAN, CONSO ou GRAN.
+
+    :param zipf: ZIP ouvert en ajout.
+    :param temp_dir: Dossier temporaire du traitement.
+    :param export_type: Type d'export (BILAN, CONSO ou GRAN).
+    :param hierarchy_df: Hiérarchie des fichiers de l'export.
+    :param arcname: Nom du fichier dans le ZIP.
+    :param entity: Entité ou liste d'entités choisies (GRAN uniquement, "ALL" pour toutes).
+    :param selected_processes: Indicateurs exécutés (GRAN uniquement).
+    """
+    if export_type == 'GRAN':
+        if "ALL" in entity_list(entity):
+            chosen_entities = Entity_List
+        else:
+            chosen_entities = entity_list(entity)
+
+        if "ALL" in selected_processes:
+            chosen_indicator = "ALL"
+        else:
+            # Concaténer les processus sélectionnés pour l'indicateur
+            chosen_indicator = ", ".join(selected_processes)
+
+        # Appel de la fonction pour GRAN
+        grouped_count_df, indicators_df = count_entity_occurrences_from_df(
+            export_type="GRAN",
+            hierarchy_df=hierarchy_df,
+            chosen_entities=chosen_entities,
+            chosen_indicator=chosen_indicator
+        )
+    else:
+        grouped_count_df, indicators_df = count_entity_occurrences_from_df(export_type, hierarchy_df)
+
+    # Ajouter les entités manquantes avec 0 occurrences au DataFrame des entités
+    all_entities = set(Entity_List)
+    existing_entities = set(grouped_count_df["Entités"])
+    missing_entities = all_entities - existing_entities
+
+    # Ajouter les entités manquantes au DataFrame
+    missing_df = pd.DataFrame({
+        "Entités": list(missing_entities),
+        "Nombre d'occurrences": [0] * len(missing_entities)
+    })
+    grouped_count_df = pd.concat([grouped_count_df, missing_df], ignore_index=True)
+
+    # Écrire les deux DataFrames dans un fichier Excel
+    count_file_path = os.path.join(temp_dir, f"count_{export_type.lower()}.xlsx")
+    with pd.ExcelWriter(count_file_path, engine='openpyxl') as writer:
+        # Écrire le DataFrame des entités
+        grouped_count_df.to_excel(writer, index=False, sheet_name="Résultats", startrow=0)
+
+        # Ajouter 5 lignes vides avant le DataFrame des indicateurs
+        start_row = len(grouped_count_df) + 6  # 1 ligne pour l'en-tête + 5 lignes vides
+        indicators_df.to_excel(writer, index=False, sheet_name="Résultats", startrow=start_row)
+
+    # Ajouter le fichier Excel dans le ZIP
+    zipf.write(count_file_path, arcname=arcname)
+
+
+def run_matrix(uploaded_file, export_types, zip_buffer, temp_dir, run_timestamp, currencies=("ALL",), entity=None,
+               indicator=None, selected_processes="ALL", run_in_parallel=False, max_workers=None,
+               categorical_mode=False, streaming_mode=False, render_workers=DEFAULT_RENDER_WORKERS,
+               uploaded_data=None, progress_callback=None, stats_callback=None):
+    """
+    Traitement complet d'un fichier importé pour un ou plusieurs types d'export, sans dépendance à
+    l'interface : fichiers d'import, prétraitement, indicateurs, hiérarchie et KPI sont écrits dans
+    `zip_buffer`. Utilisé par l'application Streamlit et par le point d'entrée en ligne de commande (cli.py).
+
+    Le fichier est lu, agrégé en cube et joint à Ref_Entite une seule fois : chaque vue (BILAN = D_T1
+    "INTER", CONSO = le reste) est une partition de ce résultat commun, et les données GRAN d'une
+    devise sont la partition (ALL, devise). Chaque type d'export a son dossier RUN_{timestamp}_{type}
+    dans le même ZIP ; les étapes des indicateurs déjà calculées sur les mêmes données sont reprises
+    du cache des étapes (stage_cache).
+
+    :param uploaded_file: Fichier téléversé (Streamlit) ou chemin du fichier importé.
+    :param export_types: Types d'export à produire (ALL, BILAN, CONSO, GRAN).
+    :param zip_buffer: Buffer ZIP (BytesIO) ou chemin du ZIP de sortie.
+    :param temp_dir: Dossier temporaire du traitement.
+    :param run_timestamp: Timestamp du traitement (nom des dossiers).
+    :param currencies: Devises des exports GRAN.
+    :param entity: Entité ou liste d'entités (GRAN uniquement, "ALL" pour toutes).
+    :param indicator: Vue (GRAN uniquement : ALL, BILAN, CONSO).
+    :param selected_processes: "ALL" ou liste des indicateurs à exécuter.
+    :param run_in_parallel: Exécute les indicateurs dans un pool de processus.
+    :param max_workers: Nombre de workers du pool (par défaut : valeur de concurrent.futures).
+    :param categorical_mode: Encodage catégoriel des dimensions.
+    :param streaming_mode: Lecture du fichier par blocs (fichiers volumineux).
+    :param render_workers: Nombre de workers pour le rendu des rapports par entité.
+    :param uploaded_data: DataFrame déjà produit par ingest_data (le fichier n'est alors pas relu).
+    :param progress_callback: Fonction appelée avec (texte, pourcentage) ; l'un des deux peut être None.
+    :param stats_callback: Fonction appelée avec les compteurs du traitement à chaque mise à jour :
+        {"rows": lignes lues, "indicators_done" / "indicators_total": indicateurs exécutés,
+        "files": fichiers écrits dans le ZIP}.
+    :return: Erreurs des indicateurs {nom: message}.
+    """
+    def report(text=None, percent=None):
+        if progress_callback:
+            progress_callback(text, percent)
+
+    stats = {"rows": 0, "indicators_done": 0, "indicators_total": 0, "files": 0}
+
+    def count(**values):
+        stats.update(values)
+        if stats_callback:
+            stats_callback(dict(stats))
+
+    export_types = [export_type for export_type in EXPORT_TYPES if export_type in export_types]
+    if not export_types:
+        raise ValueError(f"Aucun type d'export valide. Choisissez parmi {', '.join(EXPORT_TYPES)}.")
+    standard_types = [export_type for export_type in export_types if export_type != "GRAN"]
+    gran_currencies = list(dict.fromkeys(currencies)) if "GRAN" in export_types else []
+
+    import_folder = f"import_{run_timestamp}"
+    if isinstance(uploaded_file, (str, os.PathLike)):
+        input_file_path = str(uploaded_file)
+        with open(input_file_path, "rb") as f:
+            source_bytes = f.read()
+    else:
+        # Sauvegarder le fichier téléchargé
+        suffix = os.path.splitext(uploaded_file.name)[1].lower()
+        input_file_path = os.path.join(temp_dir, f"uploaded_hierarchy{suffix}")
+        source_bytes = uploaded_file.getvalue()
+        with open(input_file_path, "wb") as f:
+            f.write(source_bytes)
+    source_suffix = os.path.splitext(input_file_path)[1].lower()
+    if not streaming_mode and uploaded_data is None:
+        uploaded_data = ingest_data(uploaded_file)
+    if not streaming_mode:
+        count(rows=len(uploaded_data))
+
+    # Étape 1 : Prétraitement des données, commun à tous les types d'export (partitions par vue et devise)
+    report("Prétraitement des données...")
+    if streaming_mode:
+        # Cubes construits bloc par bloc ; les fichiers d'import sont écrits au fil de la lecture
+        import_files = StreamingImportFiles(temp_dir)
+        def write_chunk(chunk):
+            import_files.write_chunk(chunk)
+            count(rows=stats["rows"] + len(chunk))
+
+        preprocessed_data = stream_cubes(uploaded_file, "ALL", on_chunk=write_chunk)
+        import_files.close(zip_buffer, import_folder, source_bytes, source_suffix)
+    else:
+        generate_import_files(
+            uploaded_data, run_timestamp, zip_buffer, import_folder,
+            source_bytes=source_bytes, source_suffix=source_suffix,
+        )
+        preprocessed_data = preprocess_all_data(
+            data_path=uploaded_data,
+            ref_entite_path="./Ref 2/ref_entite.xlsx",
+            ref_transfo_path="./Ref 2/ref_transfo_l1.xlsx",
+            ref_lcr_path="./Ref 2/ref_lcr.xlsx",
+            ref_adf_lcr_path="./Ref 2/ref_lcr_adf.xlsx",
+            input_excel_path="./Livrable/Templates/LCR_Template.xlsx",
+            run_timestamp=run_timestamp,
+            export_type="ALL",
+        )
+
+    # Seules les partitions lues par les exports demandés sont conservées
+    preprocessed_data = {
+        (view, currency): data for (view, currency), data in preprocessed_data.items()
+        if view in standard_types or (view == "ALL" and currency in gran_currencies)
+    }
+    if categorical_mode:
+        preprocessed_data = encode_dimensions(
+            preprocessed_data, "./Ref 2/ref_entite.xlsx", "./Ref 2/ref_transfo_l1.xlsx"
+        )
+    if not streaming_mode:
+        # Agrégation en cube avant les jointures avec les références
+        preprocessed_data = build_cubes(preprocessed_data)
+    # Préfixe commun à tous les indicateurs, calculé une seule fois par partition et
+    # réduit aux colonnes déclarées par les indicateurs sélectionnés
+    if selected_processes == "ALL" or "ALL" in selected_processes:
+        selected_indicators = INDICATOR_CLASSES.values()
+    else:
+        selected_indicators = [
+            INDICATOR_CLASSES[name] for name in selected_processes if name in INDICATOR_CLASSES
+        ]
+    preprocessed_data = build_shared_prefixes(
+        preprocessed_data, "./Ref 2/ref_entite.xlsx",
+        columns=required_columns(selected_indicators),
+    )
+    count(files=count_zip_files(zip_buffer))
+    report(percent=20)
+
+    # Exports à exécuter : (type, devise GRAN, données)
+    runs = [(export_type, None, preprocessed_data) for export_type in standard_types]
+    process_errors = {}
+    for currency in gran_currencies:
+        if ("ALL", currency) in preprocessed_data:
+            runs.append(("GRAN", currency, {"filtered_data": preprocessed_data[("ALL", currency)]}))
+        else:
+            process_errors[f"GRAN {currency}"] = f"Aucune donnée trouvée pour la devise '{currency}' dans l'export GRAN."
+            print(f"Erreur dans GRAN {currency} : {process_errors[f'GRAN {currency}']}")
+    report(percent=40)
+
+    # Étape 2 : Exécution des processus
+    report("Exécution des processus...")
+    if selected_processes == "ALL":
+        selected_processes = list(INDICATOR_CLASSES)
+
+    step_progress = 40
+    step_count = max(1, len(runs) * len(selected_processes))
+    count(indicators_total=len(runs) * len(selected_processes))
+    # Nom des erreurs : indicateur seul pour un export unique, sinon suivi du type d'export (et de la devise GRAN)
+    run_label = (lambda export_type, currency: "") if len(runs) == 1 else (
+        lambda export_type, currency: f" ({export_type}{' ' + currency if currency else ''})"
+    )
+    for run_index, (export_type, currency, run_data) in enumerate(runs):
+        processes = indicator_processes(
+            run_data, input_file_path, run_timestamp, export_type, zip_buffer,
+            entity if export_type == "GRAN" else None, currency, indicator if export_type == "GRAN" else None,
+            render_workers,
+        )
+        label = run_label(export_type, currency)
+        done_before = run_index * len(selected_processes)
+        files_before = stats["files"]
+        if run_in_parallel:
+            # Les indicateurs envoient leurs fichiers au ZipSink, seul écrivain du buffer ZIP
+            parallel_processes = []
+            for process_name in selected_processes:
+                process_info = processes.get(process_name)
+                if process_info:
+                    parallel_processes.append((process_info["func"], process_info["args"]))
+                else:
+                    print(f"Processus '{process_name}' non reconnu.")
+
+            def update_progress(func_name, done, total):
+                # Fichiers déjà reçus par le ZipSink (ceux des indicateurs encore en cours compris)
+                count(indicators_done=done_before + done, files=files_before + len(zip_sink.written_files))
+                report(f"Processus terminé : {func_name}{label} ({done}/{total})",
+                       step_progress + int(30 * (done_before + done) / step_count))
+
+            report(f"Exécution des processus en parallèle{label}...")
+            with ZipSink(zip_buffer, use_processes=True) as zip_sink:
+                for _, args in parallel_processes:
+                    args[:] = [zip_sink.writer if arg is zip_buffer else arg for arg in args]
+                _, run_errors = execute_processes_in_parallel(
+                    parallel_processes, use_processes=True, max_workers=max_workers, progress_callback=update_progress
+                )
+            for func_name, error in run_errors.items():
+                process_errors[f"{func_name}{label}"] = error
+                print(f"Erreur dans {func_name}{label} : {error}")
+        else:
+            for i, process_name in enumerate(selected_processes, start=1):
+                report(f"Exécution du processus {process_name}{label}...")
+                process_info = processes.get(process_name)
+                if process_info:
+                    # Comme en parallèle, l'erreur d'un indicateur n'interrompt pas les autres exports
+                    try:
+                        process_info["func"](*process_info["args"])
+                    except Exception as e:
+                        func_name = process_info["func"].__name__
+                        process_errors[f"{func_name}{label}"] = str(e)
+                        print(f"Erreur dans {func_name}{label} : {e}")
+                else:
+                    print(f"Processus '{process_name}' non reconnu.")
+                count(indicators_done=done_before + i, files=count_zip_files(zip_buffer))
+                report(percent=step_progress + int(30 * (done_before + i) / step_count))
+
+    report("Génération des fichiers de hiérarchie...")
+    hierarchy_file_path = os.path.join(temp_dir, "hierarchy_all.xlsx")
+    hierarchy_df = extract_hierarchy_from_zip(zip_buffer)
+    hierarchy_df = replace_duplicates_with_nan(hierarchy_df)
+
+    hierarchy_df.to_excel(hierarchy_file_path, index=False)
+
+    # Fichier des occurrences (pas pour ALL). Avec plusieurs types d'export, les occurrences de BILAN et
+    # CONSO sont comptées sur la hiérarchie qu'aurait leur export seul (dossier d'import et leur dossier
+    # RUN) et le fichier porte le type.
+    kpi_files = []
+    for export_type in export_types:
+        if export_type == "GRAN":
+            kpi_files.append((export_type, hierarchy_df, "KPI_GRAN.xlsx"))
+        elif export_type != "ALL" and len(export_types) == 1:
+            kpi_files.append((export_type, hierarchy_df, "KPI.xlsx"))
+        elif export_type != "ALL":
+            run_hierarchy_df = replace_duplicates_with_nan(extract_hierarchy_from_zip(
+                zip_buffer, prefix=(f"{import_folder}/", f"RUN_{run_timestamp}_{export_type}/")
+            ))
+            kpi_files.append((export_type, run_hierarchy_df, f"KPI_{export_type}.xlsx"))
+
+    report("Ajout des fichiers au ZIP final...")
+    with zipfile.ZipFile(zip_buffer, "a") as zipf:
+
+        # Ajouter le fichier de hiérarchie
+        zipf.write(hierarchy_file_path, arcname="hierarchy_all.xlsx")
+
+        for export_type, kpi_hierarchy_df, arcname in kpi_files:
+            write_kpi_file(zipf, temp_dir, export_type, kpi_hierarchy_df, arcname, entity, selected_processes)
+
+    count(files=count_zip_files(zip_buffer))
+    return process_errors
+
+
+def reference_fingerprint(ref_dirs=("./Ref 2", "./Livrable/Templates")) -> str:
+    """
+    Empreinte de l'ensemble des fichiers de référence et des templates des rapports : un résultat
+    conservé n'est réutilisé que si aucune référence ni aucun template n'a changé depuis son calcul.
+
+    :param ref_dirs: Dossiers des références et des templates.
+    :return: Empreinte hexadécimale.
+    """
+    digest = hashlib.sha256()
+    for ref_dir in ref_dirs:
+        digest.update(ref_dir.encode())
+        for file_name in sorted(os.listdir(ref_dir)):
+            if file_name.endswith(".xlsx"):
+                digest.update(file_name.encode())
+                digest.update(REF_CATALOG.fingerprint(os.path.join(ref_dir, file_name)).encode())
+    return digest.hexdigest()
+
+
+def upload_fingerprint(uploaded_file) -> str:
+    """
+    Empreinte (hash SHA-256 du contenu) du fichier téléversé.
+    """
+    return hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+
+
+def run_key(uploaded_file, export_types, currencies, entity, indicator, selected_processes,
+            categorical_mode, streaming_mode) -> tuple:
+    """
+    Clé d'un traitement dans RUN_CACHE : fichier téléversé, références, templates et paramètres qui
+    changent le contenu du ZIP. L'exécution parallèle et le nombre de workers de rendu n'en font pas partie.
+
+    :return: Tuple hashable.
+    """
+    return (
+        upload_fingerprint(uploaded_file), reference_fingerprint(), tuple(export_types), tuple(currencies),
+        tuple(entity_list(entity)), indicator, tuple(entity_list(selected_processes)),
+        bool(categorical_mode), bool(streaming_mode),
+    )
+
+
+def export_job(job, source_bytes, file_name, key, export_types, run_timestamp, export_label, **run_options):
+    """
+    Traitement complet soumis à JOB_RUNNER par l'application : lecture et validation du fichier, puis
+    run_matrix avec la progression et les compteurs publiés sur le Job. L'archive est retournée à la page
+    et conservée dans RUN_CACHE sous `key` pour les traitements suivants (si le cache l'accepte).
+
+    :param job: Job du traitement (voir job_runner).
+    :param source_bytes: Contenu du fichier téléversé (copié : le fichier Streamlit ne survit pas à la session).
+    :param file_name: Nom du fichier téléversé (son extension donne le format).
+    :param key: Clé du traitement dans RUN_CACHE (voir run_key).
+    :param export_types: Types d'export à produire.
+    :param run_timestamp: Timestamp du traitement.
+    :param export_label: Type d'export choisi, repris dans le nom du ZIP.
+    :param run_options: Autres arguments de run_matrix.
+    :return: {"run": résultat {"zip", "errors", "file_name"}}, ou {"missing_columns": colonnes manquantes}
+        si le fichier n'est pas conforme.
+    """
+    source = io.BytesIO(source_bytes)
+    source.name = file_name
+
+    job.progress("Lecture du fichier...", 0)
+    if run_options.get("streaming_mode"):
+        # Le fichier sera lu par blocs : seule la ligne d'en-têtes est lue pour la validation
+        uploaded_data, uploaded_columns = None, read_input_columns(source)
+    else:
+        # Lecture unique du fichier : validation, fichiers d'import et prétraitement partagent ce DataFrame
+        uploaded_data = ingest_data(source)
+        uploaded_columns = uploaded_data.columns
+    missing_columns = missing_input_columns(uploaded_columns)
+    if missing_columns:
+        return {"missing_columns": missing_columns}
+
+    zip_buffer = io.BytesIO()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        process_errors = run_matrix(
+            source, export_types, zip_buffer, temp_dir, run_timestamp, uploaded_data=uploaded_data,
+            progress_callback=job.progress, stats_callback=job.update_stats, **run_options,
+        )
+    run = RUN_CACHE.put(key, zip_buffer.getvalue(), process_errors, file_name=f"RUN_{run_timestamp}_{export_label}.zip")
+    job.progress("Traitement terminé avec succès !", 100)
+    return {"run": run}
+
+
+def show_missing_columns(missing_columns):
+    """
+    Affiche le tableau des colonnes attendues absentes du fichier téléversé.
+    """
+    st.error("Certaines colonnes attendues sont manquantes dans le fichier :")
+
+    # Affichage des colonnes manquantes dans un tableau
+    missing_df = pd.DataFrame(
+        {"Colonnes manquantes": missing_columns}
+    )
+    st.markdown(
+        """
+        <style>
+            .missing-table {
+                border-radius: 5px;
+                padding: 10px;
+                margin-top: 10px;
+                margin-bottom: 10px;
+                box-shadow: 2px 2px 5px rgba(0, 0, 0, 0.1);
+            }
+            .missing-table h3 {
+                color: lightgrey;
+                margin-bottom: 10px;
+            }
+        </style>
+        """,
+        unsafe_allow_html=True,
+    )
+
+    # Convertir le tableau en HTML et l'afficher
+    st.markdown(
+        f"""
+        <div class="missing-table">
+            <h3>Colonnes manquantes :</h3>
+            {missing_df.to_html(index=False, escape=False, justify="center")}
+        </div>
+        """,
+        unsafe_allow_html=True
+    )
+
+
+def job_status_text(job) -> str:
+    """
+    Libellé d'un traitement qui n'a pas encore publié d'étape : rang dans la file de JOB_RUNNER s'il attend
+    qu'un worker se libère.
+
+    :param job: État du traitement (voir JobRunner.get).
+    """
+    if job["status"] == PENDING and job["position"]:
+        return f"{job['label']} en attente : position {job['position']} dans la file."
+    return f"{job['label']} {job['status']}..."
+
+
+@st.fragment(run_every=1)
+def show_job_progress():
+    """
+    Suivi du traitement de la session, relu chaque seconde sans réexécuter le reste de la page : étape,
+    pourcentage et compteurs publiés par run_matrix. À la fin, la page est réexécutée pour afficher le résultat.
+    """
+    job = JOB_RUNNER.get(st.session_state.get("job_id"))
+    if job is None:
+        # Traitement oublié par JOB_RUNNER (trop de traitements soumis depuis) : son résultat est perdu
+        st.session_state.pop("job_id", None)
+        st.session_state["job_error"] = "Le traitement n'est plus suivi : relancez le traitement."
+        st.rerun()
+
+    if job["status"] in (PENDING, RUNNING):
+        stats = job["stats"]
+        st.progress(job["percent"], text=job["stage"] or job_status_text(job))
+        st.caption(
+            f"Lignes lues : {stats.get('rows', 0):,} · "
+            f"Indicateurs exécutés : {stats.get('indicators_done', 0)}/{stats.get('indicators_total', 0)} · "
+            f"Fichiers écrits : {stats.get('files', 0)} · "
+            f"Durée : {job['elapsed']:.0f} s".replace(",", " ")
+        )
+        return
+
+    # Le résultat passe dans la session : il reste téléchargeable même si RUN_CACHE ne l'a pas gardé
+    JOB_RUNNER.release(st.session_state.pop("job_id"))
+    if job["status"] == FAILED:
+        st.session_state["job_error"] = job["error"]
+    elif "missing_columns" in job["result"]:
+        st.session_state["missing_columns"] = job["result"]["missing_columns"]
+    else:
+        st.session_state["last_run"] = job["result"]["run"]
+    st.rerun()
+
+
+def gran_cube_job(job, source_bytes, file_name, run_timestamp, indicators, categorical_mode=False, cube=None):
+    """
+    Préparation de la consultation GRAN soumise à JOB_RUNNER : lecture et validation du fichier, ResultCube,
+    puis calcul des résultats des indicateurs demandés (toutes vues et devises).
+
+    :param job: Job du traitement (voir job_runner).
+    :param source_bytes: Contenu du fichier téléversé (inutilisé si `cube` est fourni).
+    :param file_name: Nom du fichier téléversé (son extension donne le format).
+    :param run_timestamp: Timestamp du traitement.
+    :param indicators: Indicateurs à calculer.
+    :param categorical_mode: Encodage catégoriel des dimensions.
+    :param cube: ResultCube déjà construit pour ce fichier : seuls les indicateurs demandés y sont ajoutés.
+    :return: {"cube": ResultCube}, ou {"missing_columns": colonnes manquantes} si le fichier n'est pas conforme.
+    """
+    if cube is None:
+        source = io.BytesIO(source_bytes)
+        source.name = file_name
+
+        job.progress("Lecture du fichier...", 0)
+        uploaded_data = ingest_data(source)
+        missing_columns = missing_input_columns(uploaded_data.columns)
+        if missing_columns:
+            return {"missing_columns": missing_columns}
+
+        job.progress("Prétraitement des données...", 10)
+        cube = build_result_cube(uploaded_data, run_timestamp, categorical_mode)
+
+    def report(done, total):
+        job.progress(f"Calcul des résultats GRAN ({done}/{total})...", 10 + 90 * done // total)
+
+    cube.build(indicators, progress_callback=report)
+    return {"cube": cube}
+
+
+@st.fragment(run_every=1)
+def show_gran_progress():
+    """
+    Suivi de la préparation de la consultation GRAN, relu chaque seconde ; la page est réexécutée à la fin.
+    """
+    state = st.session_state.get("gran_result_cube") or {}
+    job = JOB_RUNNER.get(state.get("job_id"))
+    if job is not None and job["status"] in (PENDING, RUNNING):
+        st.progress(job["percent"], text=job["stage"] or job_status_text(job))
+        return
+    st.rerun()
+
+
+def gran_result_cube(uploaded_file, indicators, categorical_mode, run_timestamp):
+    """
+    ResultCube du fichier téléversé, conservé dans la session Streamlit et construit en tâche de fond
+    (JOB_RUNNER) : seuls les indicateurs sélectionnés sont calculés, les autres le sont lorsqu'ils sont
+    sélectionnés à leur tour. Le résultat, y compris un fichier non conforme, est conservé sous la même
+    clé (fichier, références et encodage) : les réexécutions du script ne relisent pas le fichier.
+
+    :param uploaded_file: Fichier téléversé (Streamlit).
+    :param indicators: Indicateurs sélectionnés.
+    :param categorical_mode: Encodage catégoriel des dimensions.
+    :param run_timestamp: Timestamp du traitement.
+    :return: ResultCube prêt pour les indicateurs sélectionnés, ou None (calcul en cours, fichier non
+        conforme ou erreur, affichés par cette fonction).
+    """
+    cache_key = (upload_fingerprint(uploaded_file), reference_fingerprint(), bool(categorical_mode))
+    state = st.session_state.get("gran_result_cube")
+    if state is not None and state["key"] == cache_key and state["job_id"] is not None:
+        job = JOB_RUNNER.get(state["job_id"])
+        if job is None:
+            # Calcul oublié par JOB_RUNNER : la préparation est relancée
+            state = None
+        elif job["status"] not in (PENDING, RUNNING):
+            JOB_RUNNER.release(state["job_id"])
+            state["job_id"] = None
+            if job["status"] == FAILED:
+                state["error"] = job["error"]
+            elif "missing_columns" in job["result"]:
+                state["missing_columns"] = job["result"]["missing_columns"]
+            else:
+                state["cube"] = job["result"]["cube"]
+    if state is None or state["key"] != cache_key:
+        state = {
+            "key": cache_key, "job_id": None, "cube": None, "indicators": set(),
+            "missing_columns": None, "error": None,
+        }
+        st.session_state["gran_result_cube"] = state
+
+    if state["missing_columns"]:
+        show_missing_columns(state["missing_columns"])
+        return None
+    if state["error"]:
+        st.error("Une erreur est survenue lors de la préparation de la consultation GRAN :")
+        st.text(state["error"])
+        return None
+
+    pending = [name for name in indicators if name not in state["indicators"]]
+    if state["job_id"] is None and pending:
+        state["job_id"] = JOB_RUNNER.submit(
+            gran_cube_job, None if state["cube"] is not None else uploaded_file.getvalue(), uploaded_file.name,
+            run_timestamp, pending, categorical_mode, cube=state["cube"],
+            label=f"GRAN_{run_timestamp}",
+        )
+        state["indicators"].update(pending)
+    if state["job_id"] is not None:
+        show_gran_progress()
+        return None
+    return state["cube"]
+
+
+def show_gran_explorer(uploaded_file, view, entity, currency, selected_processes, categorical_mode, run_timestamp):
+    """
+    Consultation GRAN : affiche le résultat de chaque indicateur sélectionné pour la vue, la devise et les
+    entités choisies, lu dans le ResultCube de la session. Le rapport Excel n'est rendu que sur demande.
+
+    :param uploaded_file: Fichier téléversé (Streamlit).
+    :param view: Vue (ALL, BILAN, CONSO).
+    :param entity: Entité ou liste d'entités ("ALL" pour toutes).
+    :param currency: Devise.
+    :param selected_processes: "ALL" ou liste des indicateurs.
+    :param categorical_mode: Encodage catégoriel des dimensions.
+    :param run_timestamp: Timestamp du traitement.
+    """
+    if "ALL" in selected_processes:
+        selected_processes = list(INDICATOR_CLASSES)
+    st.subheader("Consultation GRAN :")
+    cube = gran_result_cube(uploaded_file, selected_processes, categorical_mode, run_timestamp)
+    if cube is None:
+        return
+
+    entities = entity_list(entity)
+    entity_label = "All_Entities" if "ALL" in entities else "_".join(entities)
+
+    for name in selected_processes:
+        try:
+            result = cube.query(name, view, currency, entities)
+        except ValueError as e:
+            st.warning(f"{name} : {e}")
+            continue
+
+        with st.expander(f"{name} ({len(result)} lignes)", expanded=len(selected_processes) == 1):
+            st.dataframe(result)
+
+            query_key = (name, view, currency, tuple(entities))
+            file_name = f"{name}_GRAN_{currency}_{entity_label}.xlsx"
+            if st.button(f"Générer le rapport {name}", key=f"gran_render_{name}"):
+                (_, content), = render_reports([(file_name, result, GRAN_TEMPLATES[name])], 1)
+                st.session_state[f"gran_report_{name}"] = {"key": query_key, "content": content}
+
+            # Rapport déjà rendu pour la même requête : téléchargeable sans nouveau rendu
+            report = st.session_state.get(f"gran_report_{name}")
+            if report is not None and report["key"] == query_key:
+                st.download_button(
+                    label=f"Télécharger {file_name}",
+                    data=report["content"],
+                    file_name=file_name,
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    key=f"gran_download_{name}",
+                )
+
+
 if __name__ == "__main__":
     st.title("HIBISCUS Generator.")
     custom_css = """
@@ -1476,287 +2160,107 @@ if __name__ == "__main__":
             """, unsafe_allow_html=True)
                 
         # Téléchargement du fichier
-        uploaded_file = st.sidebar.file_uploader("Téléchargez votre fichier Excel hiérarchique", type=["xlsx"])
-        export_type = st.sidebar.selectbox("Choisissez le type d'export :", ["ALL", "BILAN", "CONSO", "GRAN"])
+        uploaded_file = st.sidebar.file_uploader(
+            "Téléchargez votre fichier hiérarchique (Excel, CSV, Parquet ou Arrow)",
+            type=[extension.lstrip(".") for extension in INPUT_FORMATS],
+        )
+        export_type = st.sidebar.selectbox("Choisissez le type d'export :", EXPORT_TYPES + ["MATRICE"])
+        export_types = [export_type]
+        if export_type == "MATRICE":
+            # Plusieurs types d'export produits dans le même ZIP, à partir d'un seul prétraitement
+            export_types = st.sidebar.multiselect("Types d'export à produire :", EXPORT_TYPES, default=EXPORT_TYPES)
         run_timestamp = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
         
         # Paramètres pour GRAN
         entity, currency, indicator, selected_processes = None, None, None, "ALL"
-        if export_type == "GRAN":
+        currencies = ["ALL"]
+        if "GRAN" in export_types:
             # Indicateur, Entité et Devise pour le GRAN
             indicator = st.sidebar.selectbox("Choisissez la vue :", ["ALL", "BILAN", "CONSO"])
-            entity = st.sidebar.selectbox("Choisissez l'entité spécifique :", ["ALL"] + Entity_List)
-            currency = st.sidebar.selectbox("Devise spécifique :", ["ALL","EUR", "USD"])
+            # Plusieurs entités possibles : chaque indicateur n'est calculé qu'une fois par devise et par vue
+            entity = st.sidebar.multiselect(
+                "Choisissez les entités :", ["ALL"] + list(dict.fromkeys(Entity_List)), default=["ALL"]
+            )
+            if export_type == "MATRICE":
+                currencies = st.sidebar.multiselect("Devises GRAN :", ["ALL", "EUR", "USD"], default=["ALL"])
+            else:
+                currency = st.sidebar.selectbox("Devise spécifique :", ["ALL","EUR", "USD"])
+                currencies = [currency]
             selected_processes = st.sidebar.multiselect(
                 "Sélectionnez les processus à exécuter :",
                 ["ALL", "NSFR", "LCR", "QIS", "ALMM", "AER"],
                 default="ALL"
             )
 
+        # Exécution parallèle des indicateurs (un processus par indicateur, écriture ZIP centralisée)
+        run_in_parallel = st.sidebar.checkbox("Exécuter les indicateurs en parallèle", value=False)
+        # Encodage catégoriel des dimensions (jointures et regroupements sur des codes entiers)
+        categorical_mode = st.sidebar.checkbox("Encodage catégoriel des dimensions", value=False)
+        # Mode streaming : lecture du fichier par blocs, pour les fichiers trop volumineux pour la mémoire
+        streaming_mode = st.sidebar.checkbox("Mode streaming (fichiers volumineux)", value=False)
+        # Nombre de workers pour le rendu des rapports par entité
+        render_workers = st.sidebar.number_input(
+            "Workers pour le rendu des rapports par entité :", min_value=1, max_value=DEFAULT_RENDER_WORKERS,
+            value=DEFAULT_RENDER_WORKERS, step=1
+        )
+
+        # Consultation GRAN interactive : résultats calculés une fois par fichier, puis lus à chaque changement de filtre
+        if uploaded_file and export_type == "GRAN" and not streaming_mode:
+            show_gran_explorer(
+                uploaded_file, indicator, entity, currency, selected_processes, categorical_mode, run_timestamp
+            )
+
         # Lancer le traitement
         if st.sidebar.button("Lancer le traitement"):
             if uploaded_file:
-                uploaded_data = pd.read_excel(uploaded_file)
-                missing_columns = [col for col in expected_columns if col not in uploaded_data.columns]
-                if missing_columns:
-                    st.error("Certaines colonnes attendues sont manquantes dans le fichier :")
-
-                    # Affichage des colonnes manquantes dans un tableau
-                    missing_df = pd.DataFrame(
-                        {"Colonnes manquantes": missing_columns}
-                    )
-                    st.markdown(
-                        """
-                        <style>
-                            .missing-table {
-                                border-radius: 5px;
-                                padding: 10px;
-                                margin-top: 10px;
-                                margin-bottom: 10px;
-                                box-shadow: 2px 2px 5px rgba(0, 0, 0, 0.1);
-                            }
-                            .missing-table h3 {
-                                color: lightgrey;
-                                margin-bottom: 10px;
-                            }
-                        </style>
-                        """,
-                        unsafe_allow_html=True,
-                    )
-
-                    # Convertir le tableau en HTML et l'afficher
-                    st.markdown(
-                        f"""
-                        <div class="missing-table">
-                            <h3>Colonnes manquantes :</h3>
-                            {missing_df.to_html(index=False, escape=False, justify="center")}
-                        </div>
-                        """,
-                        unsafe_allow_html=True
-                    )
-                else:
-                    try:
-                        # Initialiser le buffer ZIP
-                        zip_buffer = io.BytesIO()
-                        
-                        import_folder = f"import_{run_timestamp}"
-
-                        with tempfile.TemporaryDirectory() as temp_dir:
-                            # Sauvegarder le fichier téléchargé
-                            input_file_path = os.path.join(temp_dir, "uploaded_hierarchy.xlsx")
-                            with open(input_file_path, "wb") as f:
-                                f.write(uploaded_file.getbuffer())
-
-                            # Barre de progression et état actuel
-                            progress_bar = st.progress(0)
-                            current_task_placeholder = st.empty()
-
-                            # Étape 1 : Prétraitement des données
-                            current_task_placeholder.text("Prétraitement des données...")
-                            generate_import_files(uploaded_data, run_timestamp, zip_buffer,import_folder)
-                            preprocessed_data = preprocess_all_data(
-                                data_path=input_file_path,
-                                ref_entite_path="./Ref 2/ref_entite.xlsx",
-                                ref_transfo_path="./Ref 2/ref_transfo_l1.xlsx",
-                                ref_lcr_path="./Ref 2/ref_lcr.xlsx",
-                                ref_adf_lcr_path="./Ref 2/ref_lcr_adf.xlsx",
-                                input_excel_path="./Livrable/Templates/LCR_Template.xlsx",
-                                run_timestamp=run_timestamp,
-                                export_type=export_type,
-                                currency=currency,
-                            )
-                            progress_bar.progress(20)
-                            
-                            # Vérification du type de données retournées
-                            if export_type == "GRAN":
-                                if "filtered_data" in preprocessed_data:
-                                    gran_data = preprocessed_data["filtered_data"]
-                                    generated_import_files = gran_data  # Le résultat contient les chemins des fichiers générés
-                                    
-                                else:
-                                    st.write("Les données filtrées pour GRAN sont absentes.")
-                            else:
-                                # Pour les autres types d'export
-                                generated_import_files = preprocessed_data  # Le résultat contient les chemins des fichiers générés
-                                
-                            progress_bar.progress(40)
-
-                            # Étape 2 : Exécution des processus
-                            current_task_placeholder.text("Exécution des processus...")
-                            processes = {
-                                "NSFR": {
-                                    "func": process_nsfr,
-                                    "args": [
-                                        preprocessed_data, input_file_path, "./Ref 2/ref_entite.xlsx",
-                                        "./Ref 2/ref_transfo_l1.xlsx", "./Ref 2/ref_nsfr.xlsx",
-                                        "./Ref 2/ref_nsfr_adf.xlsx", "./Ref 2/ref_dzone_nsfr.xlsx",
-                                        "./Livrable/Templates/NSFR_Template.xlsx", run_timestamp,
-                                        export_type, zip_buffer, entity, currency, indicator
-                                    ],
-                                },
-                                "LCR": {
-                                    "func": process_lcr,
-                                    "args": [
-                                        preprocessed_data, input_file_path, "./Ref 2/ref_entite.xlsx",
-                                        "./Ref 2/ref_transfo_l1.xlsx", "./Ref 2/ref_lcr.xlsx",
-                                        "./Ref 2/ref_lcr_adf.xlsx", "./Livrable/Templates/LCR_Template.xlsx",
-                                        run_timestamp, export_type, zip_buffer, entity, currency, indicator
-                                    ],
-                                },
-                                "QIS": {
-                                    "func": process_qis,
-                                    "args": [
-                                        preprocessed_data, input_file_path, "./Ref 2/ref_entite.xlsx",
-                                        "./Ref 2/ref_transfo_l1.xlsx", "./Ref 2/Ref_QIS.xlsx",
-                                        "./Ref 2/ref_nsfr_adf.xlsx", "./Ref 2/ref_dzone_nsfr.xlsx",
-                                        "./Livrable/Templates/QIS_Template.xlsx", run_timestamp,
-                                        export_type, zip_buffer, entity, currency, indicator
-                                    ],
-                                },
-                                "ALMM": {
-                                    "func": process_almm,
-                                    "args": [
-                                        preprocessed_data, input_file_path, "./Ref 2/ref_entite.xlsx",
-                                        "./Ref 2/ref_transfo_l1.xlsx", "./Ref 2/ref_nsfr.xlsx",
-                                        "./Ref 2/ref_nsfr_adf.xlsx", "./Ref 2/ref_dzone_nsfr.xlsx",
-                                        "./Livrable/Templates/ALMM_Template.xlsx", run_timestamp,
-                                        export_type, zip_buffer, entity, currency, indicator
-                                    ],
-                                },
-                                "AER": {
-                                    "func": process_aer,
-                                    "args": [
-                                        preprocessed_data, input_file_path, "./Ref 2/ref_entite.xlsx",
-                                        "./Ref 2/ref_transfo_l1.xlsx", "./Ref 2/ref_aer.xlsx",
-                                        "./Ref 2/ref_aer_adf.xlsx", "./Livrable/Templates/AER_Template.xlsx",
-                                        run_timestamp, export_type, zip_buffer, entity, currency, indicator
-                                    ],
-                                },
-                            }
-
-                            if selected_processes == "ALL":
-                                selected_processes = list(processes.keys())
-
-                            step_progress = 40
-                            for i, process_name in enumerate(selected_processes, start=1):
-                                current_task_placeholder.text(f"Exécution du processus {process_name}...")
-                                process_info = processes.get(process_name)
-                                if process_info:
-                                    process_info["func"](*process_info["args"])
-                                else:
-                                    print(f"Processus '{process_name}' non reconnu.")
-                                progress_bar.progress(step_progress + (i * int(30 / len(selected_processes))))
-
-                            current_task_placeholder.text("Génération des fichiers de hiérarchie...")
-                            hierarchy_file_path = os.path.join(temp_dir, "hierarchy_all.xlsx")
-                            hierarchy_df = extract_hierarchy_from_zip(zip_buffer)
-                            hierarchy_df = replace_duplicates_with_nan(hierarchy_df)
-
-                            hierarchy_df.to_excel(hierarchy_file_path, index=False)
-
-                            current_task_placeholder.text("Ajout des fichiers au ZIP final...")
-                            with zipfile.ZipFile(zip_buffer, "a") as zipf:
-
-                                # Ajouter le fichier de hiérarchie
-                                zipf.write(hierarchy_file_path, arcname="hierarchy_all.xlsx")
-                                
-                                # Ajouter le fichier des occurrences uniquement si ce n'est pas GRAN
-                                if export_type == 'GRAN':
-                                    if entity == "ALL":
-                                        chosen_entities = Entity_List
-                                    else:
-                                        chosen_entities = [entity]
-
-                                    if "ALL" in selected_processes:
-                                        chosen_indicator = "ALL"
-                                    else:
-                                        # Concaténer les processus sélectionnés pour l'indicateur
-                                        chosen_indicator = ", ".join(selected_processes)
-
-                                    # Appel de la fonction pour GRAN
-                                    grouped_count_df, indicators_df = count_entity_occurrences_from_df(
-                                        export_type="GRAN",
-                                        hierarchy_df=hierarchy_df,
-                                        chosen_entities=chosen_entities,
-                                        chosen_indicator=chosen_indicator
-                                    )
-
-                                    # Ajouter les entités manquantes avec 0 occurrences au DataFrame des entités
-                                    all_entities = set(Entity_List)
-                                    existing_entities = set(grouped_count_df["Entités"])
-                                    missing_entities = all_entities - existing_entities
-
-                                    # Ajouter les entités manquantes au DataFrame
-                                    missing_df = pd.DataFrame({
-                                        "Entités": list(missing_entities),
-                                        "Nombre d'occurrences": [0] * len(missing_entities)
-                                    })
-                                    grouped_count_df = pd.concat([grouped_count_df, missing_df], ignore_index=True)
-
-                                    # Générer le fichier Excel avec les résultats
-                                    count_file_path = os.path.join(temp_dir, "count_gran.xlsx")
-                                    with pd.ExcelWriter(count_file_path, engine='openpyxl') as writer:
-                                        # Écrire le DataFrame des entités
-                                        grouped_count_df.to_excel(writer, index=False, sheet_name="Résultats", startrow=0)
-
-                                        # Ajouter 5 lignes vides avant le DataFrame des indicateurs
-                                        start_row = len(grouped_count_df) + 6  # 1 ligne pour l'en-tête + 5 lignes vides
-                                        indicators_df.to_excel(writer, index=False, sheet_name="Résultats", startrow=start_row)
-
-                                    # Ajouter le fichier Excel dans le ZIP
-                                    zipf.write(count_file_path, arcname="KPI_GRAN.xlsx")
-                                
-                                if export_type != "GRAN" and export_type != "ALL":
-                                    count_file_path = os.path.join(temp_dir, "count_all.xlsx")
-                                                                            
-                                    grouped_count_df, indicators_df = count_entity_occurrences_from_df(export_type, hierarchy_df)
-                                    
-                                    # Ajouter les entités manquantes avec 0 occurrences au DataFrame des entités
-                                    all_entities = set(Entity_List)
-                                    existing_entities = set(grouped_count_df["Entités"])
-                                    missing_entities = all_entities - existing_entities
-
-                                    # Ajouter les entités manquantes au DataFrame
-                                    missing_df = pd.DataFrame({
-                                        "Entités": list(missing_entities),
-                                        "Nombre d'occurrences": [0] * len(missing_entities)
-                                    })
-                                    grouped_count_df = pd.concat([grouped_count_df, missing_df], ignore_index=True)
-
-                                    # Écrire les deux DataFrames dans un fichier Excel
-                                    with pd.ExcelWriter(count_file_path, engine='openpyxl') as writer:
-                                        # Écrire le premier DataFrame
-                                        grouped_count_df.to_excel(writer, index=False, sheet_name="Résultats", startrow=0)
-                                        
-                                        # Ajouter 5 lignes vides avant le second DataFrame
-                                        start_row = len(grouped_count_df) + 6  # 1 ligne pour l'en-tête + 5 lignes vides
-                                        indicators_df.to_excel(writer, index=False, sheet_name="Résultats", startrow=start_row)
-                                    
-                                    # Ajouter le fichier Excel dans le ZIP
-                                    zipf.write(count_file_path, arcname="KPI.xlsx")
-
-                            progress_bar.progress(90)
-
-                            # Proposer le téléchargement
-                            zip_buffer.seek(0)
-                            st.download_button(
-                                label="Télécharger les résultats (ZIP)",
-                                data=zip_buffer.getvalue(),
-                                file_name=f"RUN_{run_timestamp}_{export_type}.zip",
-                                mime="application/zip",
-                            )
-                            progress_bar.progress(100)
-                            current_task_placeholder.success("Traitement terminé avec succès !")
-
-                    except Exception as e:
-                        import traceback
-                        current_task_placeholder.text(f"Une erreur est survenue : {e}")
-                        st.text("Traceback détaillé :")
-                        st.text(traceback.format_exc())
+                # Même fichier, mêmes références et mêmes paramètres : l'archive déjà produite est reprise
+                key = run_key(
+                    uploaded_file, export_types, currencies, entity, indicator, selected_processes,
+                    categorical_mode, streaming_mode,
+                )
+            if uploaded_file and RUN_CACHE.get(key) is not None:
+                st.info("Résultats déjà calculés pour ce fichier et ces paramètres : l'archive existante est réutilisée.")
+                st.session_state["last_run"] = RUN_CACHE.get(key)
+            elif uploaded_file and JOB_RUNNER.get(st.session_state.get("job_id")) is not None:
+                st.warning("Un traitement est déjà en cours pour cette session.")
+            elif uploaded_file:
+                # Traitement en tâche de fond : la session reste disponible et suit sa progression
+                for state_key in ["job_error", "missing_columns"]:
+                    st.session_state.pop(state_key, None)
+                st.session_state["job_id"] = JOB_RUNNER.submit(
+                    export_job, uploaded_file.getvalue(), uploaded_file.name, key, export_types, run_timestamp,
+                    export_type,
+                    label=f"RUN_{run_timestamp}_{export_type}",
+                    currencies=currencies, entity=entity, indicator=indicator,
+                    selected_processes=selected_processes, run_in_parallel=run_in_parallel,
+                    categorical_mode=categorical_mode, streaming_mode=streaming_mode,
+                    render_workers=render_workers,
+                )
 
-        else:
+        elif "job_id" not in st.session_state and "last_run" not in st.session_state:
             st.markdown('<div class="feature-description bold">Importez un fichier et choisissez la méthode pour exporter et autres filtres si nécessaire.</div>', unsafe_allow_html=True)
 
+        # Traitement en cours : progression relue en continu
+        if "job_id" in st.session_state:
+            show_job_progress()
+        if "missing_columns" in st.session_state:
+            show_missing_columns(st.session_state["missing_columns"])
+        if "job_error" in st.session_state:
+            st.error("Une erreur est survenue :")
+            st.text(st.session_state["job_error"])
+
+        # Dernier traitement de la session : erreurs et téléchargement restent affichés à chaque réexécution
+        last_run = st.session_state.get("last_run")
+        if last_run is not None:
+            for func_name, error in last_run["errors"].items():
+                st.error(f"Erreur dans {func_name} : {error}")
+            st.download_button(
+                label="Télécharger les résultats (ZIP)",
+                data=last_run["zip"],
+                file_name=last_run["file_name"],
+                mime="application/zip",
+            )
+
 
     elif st.session_state.menu_choice == "Fonctionnalités":
         st.subheader("Fonctionnalités de l'application")
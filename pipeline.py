@@ -0,0 +1,881 @@
+import os
+from functools import partial
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+from ref_catalog import REF_CATALOG
+
+# Types des colonnes du fichier importé, appliqués une seule fois à l'ingestion
+COLUMN_TYPES = {
+    "D_CA": "string",
+    "D_DP": "float64",
+    "D_ZTFTR": "object",
+    "D_PE": "float64",
+    "D_RU": "string",
+    "D_ORU": "string",
+    "D_AC": "string",
+    "D_FL": "string",
+    "D_AU": "string",
+    "D_T1": "object",
+    "D_T2": "object",
+    "D_CU": "string",
+    "D_TO": "string",
+    "D_GO": "string",
+    "D_LE": "object",
+    "D_NU": "object",
+    "D_DEST": "object",
+    "D_ZONE": "string",
+    "D_MONNAIE": "string",
+    "D_ENTITE": "object",
+    "D_RESTIT": "object",
+    "D_TYPCLI": "object",
+    "D_SURFI": "object",
+    "D_MU": "object",
+    "D_PMU": "object",
+    "D_ACTIVITE": "object",
+    "D_ANALYSIS": "object",
+    "D_PDT": "object",
+    "P_AMOUNT": "Int64",
+    "P_COMMENT": "object",
+}
+
+# Mode catégoriel : dimensions encodées sur un vocabulaire commun, avec les clés des références
+# partagées qui sont jointes sur ces dimensions
+CATEGORICAL_DIMENSIONS = {
+    "D_RU": ["Ref_Entite.d_ru"],
+    "D_AC": ["Ref_Transfo_L1.Transfo_aggregate_L1"],
+    "D_ZONE": [],
+    "D_CU": [],
+    "D_FL": [],
+}
+
+# Dimensions utilisées par les indicateurs : clés de jointure (D_RU, D_AC, D_ZONE)
+# et colonnes de filtre (D_FL, D_CU, D_T1).
+CUBE_DIMENSIONS = ["D_RU", "D_AC", "D_ZONE", "D_FL", "D_CU", "D_T1"]
+CUBE_MEASURE = "P_AMOUNT"
+
+# Colonnes lues dans le fichier importé : dimensions du cube et montant. Les autres colonnes
+# (P_COMMENT, D_ANALYSIS, D_PDT, ...) ne servent qu'aux fichiers d'import.
+INPUT_COLUMNS = CUBE_DIMENSIONS + [CUBE_MEASURE]
+
+# Tranches de maturité des indicateurs NSFR, QIS et ALMM, dans l'ordre des colonnes des rapports
+NSFR_BUCKETS = ["0-6M", "6-12M", ">1Y"]
+
+# Mode streaming : nombre de lignes lues par bloc dans le fichier importé
+DEFAULT_CHUNK_ROWS = 20000
+
+# Formats acceptés pour le fichier importé, selon l'extension
+INPUT_FORMATS = {
+    ".xlsx": "excel",
+    ".csv": "csv",
+    ".parquet": "parquet",
+    ".arrow": "arrow",
+    ".feather": "arrow",
+}
+
+# Colonnes de filtre appliquées par les process_* après le préfixe commun (vue et devise pour GRAN)
+FILTER_COLUMNS = ["D_CU", "D_T1"]
+
+
+def _blank_cells(column: pd.Series) -> pd.Series:
+    # Cellule vide : valeur manquante, ou texte vide / composé uniquement d'espaces
+    blank = column.isna()
+    if pd.api.types.is_numeric_dtype(column.dtype) or pd.api.types.is_bool_dtype(column.dtype):
+        return blank
+    return blank | column.astype("string").str.strip().eq("").fillna(False)
+
+
+def remove_blank_rows(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Supprime les lignes totalement vides : toutes les cellules manquantes, vides ou ne contenant que des
+    espaces. Le test se fait colonne par colonne (pas de Series construite par ligne) et s'arrête dès
+    qu'aucune ligne candidate ne reste. Rien n'est affiché (la fonction tourne aussi dans les tâches de
+    fond) : l'appelant déduit le nombre de lignes supprimées des longueurs, comme stream_cubes.
+
+    :param data: Données brutes.
+    :return: Données sans lignes vides.
+    """
+    blank_rows = pd.Series(True, index=data.index)
+    for col in data.columns:
+        blank_rows &= _blank_cells(data[col])
+        if not blank_rows.any():
+            break
+
+    if not blank_rows.any():
+        return data
+    return data[~blank_rows]
+
+
+def apply_column_types(data: pd.DataFrame, column_types: dict = None) -> pd.DataFrame:
+    """
+    Convertit les colonnes présentes selon COLUMN_TYPES (P_AMOUNT en Int64, valeurs non numériques à NA).
+
+    :param data: Données nettoyées.
+    :param column_types: Types à appliquer (par défaut : COLUMN_TYPES).
+    :return: Données typées.
+    """
+    data = data.copy(deep=False)
+    for col, dtype in (column_types or COLUMN_TYPES).items():
+        if col in data.columns:
+            try:
+                if dtype == "Int64":
+                    data[col] = pd.to_numeric(data[col], errors='coerce').astype("Int64")
+                else:
+                    data[col] = data[col].astype(dtype)
+            except Exception as e:
+                print(f"Erreur lors de la conversion de la colonne {col} en {dtype}: {e}")
+    return data
+
+
+def input_format(source) -> str:
+    """
+    Détermine le format du fichier importé d'après son extension (INPUT_FORMATS).
+
+    :param source: Chemin ou fichier téléversé (attribut `name`).
+    :return: "excel", "csv", "parquet" ou "arrow".
+    """
+    name = source if isinstance(source, (str, os.PathLike)) else getattr(source, "name", "")
+    extension = os.path.splitext(str(name))[1].lower()
+    if extension not in INPUT_FORMATS:
+        raise ValueError(
+            f"Format de fichier non pris en charge : '{extension}'. Formats acceptés : {', '.join(INPUT_FORMATS)}"
+        )
+    return INPUT_FORMATS[extension]
+
+
+def _rewind(source):
+    # Un fichier téléversé peut avoir déjà été lu (validation des colonnes) : relecture depuis le début
+    if hasattr(source, "seek"):
+        source.seek(0)
+    return source
+
+
+def _string_types() -> dict:
+    # Colonnes texte lues comme texte dès la lecture : les codes (D_AC, D_RU, D_ZONE, ...) gardent leurs
+    # zéros initiaux, et un bloc dont un code est numérique avec des cellules vides ne devient pas un
+    # flottant ("12345.0" une fois converti en texte)
+    return {col: "string" for col, dtype in COLUMN_TYPES.items() if dtype == "string"}
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError("La lecture des fichiers Parquet et Arrow nécessite le paquet pyarrow.")
+    return pyarrow
+
+
+def _arrow_source(source):
+    # Fichier sur disque : projection en mémoire (mmap), les colonnes ne sont pas copiées à la lecture
+    if isinstance(source, (str, os.PathLike)):
+        return _pyarrow().memory_map(str(source), "r")
+    return _rewind(source)
+
+
+def _arrow_to_pandas(table, dtype: dict = None) -> pd.DataFrame:
+    # Colonnes de `dtype` ("string") converties en texte côté Arrow, avant le passage en pandas
+    pyarrow = _pyarrow()
+    for name in dtype or {}:
+        index = table.schema.get_field_index(name)
+        if index >= 0 and not pyarrow.types.is_string(table.schema.field(index).type):
+            table = table.set_column(index, name, table.column(index).cast(pyarrow.string()))
+    # split_blocks / self_destruct : pas de consolidation en blocs 2D, la table Arrow est libérée au fil de
+    # la conversion (pas de double occupation mémoire)
+    data = table.to_pandas(split_blocks=True, self_destruct=True)
+    # Valeurs manquantes des colonnes objet : None côté Arrow, NaN comme pd.read_excel
+    for col in data.columns:
+        if data[col].dtype == object and data[col].isna().any():
+            data[col] = data[col].where(data[col].notna(), np.nan)
+    return data
+
+
+def read_input(source, columns=None) -> pd.DataFrame:
+    """
+    Lit le fichier importé brut (Excel, CSV, Parquet ou Arrow/Feather), sans nettoyage ni typage.
+
+    :param source: Chemin ou fichier téléversé.
+    :param columns: Colonnes à lire (toutes par défaut). Pour Parquet et Arrow, seules ces colonnes sont
+        lues dans le fichier.
+    :return: DataFrame brut.
+    """
+    file_format = input_format(source)
+    wanted = None if columns is None else set(columns)
+    try:
+        if file_format == "excel":
+            return pd.read_excel(
+                _rewind(source), engine="openpyxl", dtype=_string_types(),
+                usecols=None if wanted is None else wanted.__contains__,
+            )
+        if file_format == "csv":
+            return pd.read_csv(
+                _rewind(source), dtype=_string_types(), usecols=None if wanted is None else wanted.__contains__,
+                low_memory=False,
+            )
+
+        pyarrow = _pyarrow()
+        if file_format == "parquet":
+            schema = pyarrow.parquet.read_schema(_arrow_source(source))
+            selected = None if wanted is None else [name for name in schema.names if name in wanted]
+            return _arrow_to_pandas(
+                pyarrow.parquet.read_table(_arrow_source(source), columns=selected, memory_map=True),
+                _string_types(),
+            )
+        table = pyarrow.ipc.open_file(_arrow_source(source)).read_all()
+        if wanted is not None:
+            table = table.select([name for name in table.column_names if name in wanted])
+        return _arrow_to_pandas(table, _string_types())
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError(f"Erreur lors du chargement des données principales : {e}")
+
+
+def ingest_data(source, columns=None) -> pd.DataFrame:
+    """
+    Étape d'ingestion unique : lit le fichier importé une seule fois, supprime les lignes vides et
+    applique les types. Le DataFrame obtenu sert ensuite à la validation des colonnes, aux fichiers
+    d'import et au prétraitement, sans nouvelle lecture du fichier. Tous les formats de INPUT_FORMATS
+    aboutissent aux mêmes types (COLUMN_TYPES).
+
+    :param source: Chemin ou fichier (par exemple le fichier téléversé dans Streamlit).
+    :param columns: Colonnes à lire (toutes par défaut), voir read_input.
+    :return: DataFrame nettoyé et typé.
+    """
+    return apply_column_types(remove_blank_rows(read_input(source, columns)))
+
+
+def _excel_value(value):
+    # Même conversion que pd.read_excel : nombres entiers stockés en flottant ramenés à des entiers
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _excel_frame(rows: list, columns: list, dtype: dict = None) -> pd.DataFrame:
+    # Types inférés comme par le constructeur de DataFrame, sauf pour les colonnes de `dtype`, converties
+    # à partir des valeurs lues (un code entier avec des cellules vides ne passe pas par un flottant)
+    if not dtype:
+        return pd.DataFrame(rows, columns=columns)
+    frame = pd.DataFrame(rows, columns=columns, dtype=object)
+    return frame.astype({col: dtype[col] for col in frame.columns if col in dtype}).infer_objects()
+
+
+def iter_excel_chunks(source, chunk_rows: int = DEFAULT_CHUNK_ROWS, dtype: dict = None):
+    """
+    Lit la première feuille du fichier importé par blocs de `chunk_rows` lignes, en lecture seule
+    (openpyxl read_only) : le classeur n'est jamais chargé entièrement en mémoire.
+
+    :param source: Chemin ou fichier.
+    :param chunk_rows: Nombre de lignes par bloc.
+    :param dtype: Types imposés à la construction de chaque bloc {colonne: type}, comme pour pd.read_excel.
+    :return: Itérateur de DataFrames bruts (un bloc vide portant les en-têtes si le fichier n'a aucune ligne).
+    """
+    try:
+        workbook = load_workbook(source, read_only=True, data_only=True)
+    except Exception as e:
+        raise ValueError(f"Erreur lors du chargement des données principales : {e}")
+
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, ())
+        columns = [f"Unnamed: {i}" if name is None else name for i, name in enumerate(header)]
+
+        batch, emitted = [], False
+        for row in rows:
+            batch.append([_excel_value(value) for value in row[:len(columns)]])
+            if len(batch) == chunk_rows:
+                yield _excel_frame(batch, columns, dtype)
+                batch, emitted = [], True
+        if batch or not emitted:
+            yield _excel_frame(batch, columns, dtype)
+    finally:
+        workbook.close()
+
+
+def read_excel_columns(source) -> list:
+    """
+    Lit uniquement la ligne d'en-têtes de la première feuille (validation des colonnes en mode streaming).
+
+    :param source: Chemin ou fichier.
+    :return: Liste des noms de colonnes.
+    """
+    return list(next(iter_excel_chunks(source, chunk_rows=1)).columns)
+
+
+def iter_input_chunks(source, chunk_rows: int = DEFAULT_CHUNK_ROWS):
+    """
+    Lit le fichier importé par blocs, quel que soit son format : openpyxl en lecture seule pour Excel,
+    read_csv par blocs pour CSV, groupes de lignes pour Parquet et lots d'enregistrements pour Arrow.
+
+    :param source: Chemin ou fichier téléversé.
+    :param chunk_rows: Nombre de lignes par bloc (Excel, CSV et Parquet ; les lots Arrow gardent la
+        taille choisie à l'écriture du fichier).
+    :return: Itérateur de DataFrames bruts (un bloc vide portant les en-têtes si le fichier n'a aucune ligne).
+    """
+    file_format = input_format(source)
+    if file_format == "excel":
+        yield from iter_excel_chunks(_rewind(source), chunk_rows, _string_types())
+        return
+
+    empty = None
+    try:
+        if file_format == "csv":
+            chunks = pd.read_csv(_rewind(source), dtype=_string_types(), chunksize=chunk_rows)
+        else:
+            pyarrow = _pyarrow()
+            if file_format == "parquet":
+                parquet_file = pyarrow.parquet.ParquetFile(_arrow_source(source), memory_map=True)
+                empty = parquet_file.schema_arrow.empty_table()
+                batches = parquet_file.iter_batches(batch_size=chunk_rows)
+            else:
+                reader = pyarrow.ipc.open_file(_arrow_source(source))
+                empty = reader.schema.empty_table()
+                batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+            chunks = (_arrow_to_pandas(pyarrow.Table.from_batches([batch]), _string_types()) for batch in batches)
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError(f"Erreur lors du chargement des données principales : {e}")
+
+    emitted = False
+    for chunk in chunks:
+        emitted = True
+        yield chunk
+    if not emitted and empty is not None:
+        yield _arrow_to_pandas(empty, _string_types())
+
+
+def read_input_columns(source) -> list:
+    """
+    Lit uniquement les noms de colonnes du fichier importé (validation des colonnes en mode streaming) :
+    ligne d'en-têtes pour Excel et CSV, schéma pour Parquet et Arrow.
+
+    :param source: Chemin ou fichier téléversé.
+    :return: Liste des noms de colonnes.
+    """
+    file_format = input_format(source)
+    try:
+        if file_format == "excel":
+            return read_excel_columns(_rewind(source))
+        if file_format == "csv":
+            return list(pd.read_csv(_rewind(source), nrows=0).columns)
+        pyarrow = _pyarrow()
+        if file_format == "parquet":
+            return list(pyarrow.parquet.read_schema(_arrow_source(source)).names)
+        return list(pyarrow.ipc.open_file(_arrow_source(source)).schema.names)
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError(f"Erreur lors du chargement des données principales : {e}")
+    finally:
+        _rewind(source)
+
+
+def stream_cubes(source, export_type: str, currency: str = "ALL", chunk_rows: int = DEFAULT_CHUNK_ROWS,
+                 on_chunk=None) -> dict:
+    """
+    Mode streaming : équivalent de build_cubes(preprocess_all_data(...)) sans charger le fichier en entier.
+    Chaque bloc est nettoyé et typé comme à l'ingestion, transmis à `on_chunk`, réduit à INPUT_COLUMNS,
+    agrégé en cube partiel puis fusionné dans le cube courant. La mémoire dépend du nombre de
+    combinaisons de dimensions distinctes, plus du nombre de lignes.
+
+    :param source: Chemin ou fichier importé (formats de INPUT_FORMATS).
+    :param export_type: Type d'export (ALL, BILAN, CONSO, GRAN).
+    :param currency: Devise (GRAN uniquement).
+    :param chunk_rows: Nombre de lignes par bloc.
+    :param on_chunk: Fonction appelée avec chaque bloc nettoyé et typé (toutes colonnes), par exemple
+        pour écrire les fichiers d'import au fil de la lecture.
+    :return: Cubes {(vue, devise): DataFrame}, ou {"filtered_data": DataFrame} pour GRAN.
+    """
+    cube, total_rows, blank_rows = None, 0, 0
+    for chunk in iter_input_chunks(source, chunk_rows):
+        raw_rows = len(chunk)
+        chunk = apply_column_types(remove_blank_rows(chunk))
+        blank_rows += raw_rows - len(chunk)
+        if on_chunk is not None:
+            on_chunk(chunk)
+        total_rows += len(chunk)
+
+        partial_cube = _sum_by_dimensions(project_columns(chunk, INPUT_COLUMNS))
+        cube = partial_cube if cube is None else _sum_by_dimensions(pd.concat([cube, partial_cube], ignore_index=True))
+
+    if blank_rows:
+        print(f"Lignes vides supprimées : {blank_rows}")
+    print(f"Cube construit en streaming : {total_rows} lignes -> {len(cube)} lignes.")
+    # Les fusions successives peuvent inférer d'autres types pour les clés : retour aux types d'ingestion
+    cube = apply_column_types(cube)
+
+    # Chaque partition est réagrégée (quelques lignes) pour obtenir exactement le cube de la partition,
+    # types compris, comme build_cubes sur les partitions complètes
+    if export_type == "GRAN":
+        return {"filtered_data": _sum_by_dimensions(cube if currency == "ALL" else cube[cube["D_CU"] == currency])}
+    return {key: _sum_by_dimensions(partition) for key, partition in partition_data(cube).items()}
+
+
+def partition_data(data: pd.DataFrame) -> dict:
+    """
+    Découpe les données en partitions par vue (ALL, BILAN = D_T1 "INTER", CONSO = le reste) et par
+    devise (ALL, EUR, USD). Les partitions vides sont omises.
+
+    :param data: Données typées (ou cube).
+    :return: Partitions {(vue, devise): DataFrame}.
+    """
+    views = {
+        "ALL": data,
+        "BILAN": data[data["D_T1"] == "INTER"],
+        "CONSO": data[data["D_T1"] != "INTER"],
+    }
+    partitions = {}
+    for view, view_data in views.items():
+        for partition_currency in ["ALL", "EUR", "USD"]:
+            if partition_currency == "ALL":
+                partition = view_data
+            else:
+                partition = view_data[view_data["D_CU"] == partition_currency]
+
+            if partition.empty:
+                print(f"Aucune donnée trouvée pour la devise {partition_currency} dans {view}.")
+                continue
+            partitions[(view, partition_currency)] = partition
+    return partitions
+
+
+def project_columns(data: pd.DataFrame, columns) -> pd.DataFrame:
+    """
+    Ne garde que les colonnes demandées présentes dans les données, dans leur ordre d'origine.
+
+    :param data: DataFrame à réduire.
+    :param columns: Colonnes à conserver.
+    :return: DataFrame réduit (les données elles-mêmes ne sont pas copiées).
+    """
+    columns = set(columns)
+    return data[[col for col in data.columns if col in columns]]
+
+
+def required_columns(indicators) -> list:
+    """
+    Colonnes à conserver après le préfixe commun : colonnes de filtre et union des REQUIRED_COLUMNS
+    déclarées par les indicateurs sélectionnés.
+
+    :param indicators: Classes d'indicateurs (LCR, NSFR, QIS, ALMM, AER).
+    :return: Liste de colonnes sans doublon.
+    """
+    columns = list(FILTER_COLUMNS)
+    for indicator in indicators:
+        columns += [col for col in indicator.REQUIRED_COLUMNS if col not in columns]
+    return columns
+
+
+def build_vocabularies(frames, ref_frames=()) -> dict:
+    """
+    Construit, pour chaque dimension de CATEGORICAL_DIMENSIONS, un vocabulaire trié commun aux données
+    et aux clés des références (les valeurs de référence absentes des données y figurent aussi, pour
+    qu'aucune clé ne devienne manquante à l'encodage).
+
+    :param frames: DataFrames de données (partitions).
+    :param ref_frames: Références prétraitées portant les clés de CATEGORICAL_DIMENSIONS.
+    :return: Dictionnaire {dimension: CategoricalDtype}.
+    """
+    frames, ref_frames = list(frames), list(ref_frames)
+    vocabularies = {}
+    for dimension, ref_keys in CATEGORICAL_DIMENSIONS.items():
+        values = set()
+        for frame in frames:
+            if dimension in frame.columns:
+                values.update(frame[dimension].dropna().unique())
+        for ref in ref_frames:
+            for key in ref_keys:
+                if key in ref.columns:
+                    values.update(ref[key].dropna().unique())
+        try:
+            categories = sorted(values)
+        except TypeError:
+            # Types mélangés (nombres et textes) : ordre du texte
+            categories = sorted(values, key=str)
+        vocabularies[dimension] = pd.CategoricalDtype(pd.Index(categories))
+    return vocabularies
+
+
+def encode_dimensions(preprocessed_data: dict, ref_entite_path: str, ref_transfo_path: str) -> dict:
+    """
+    Mode catégoriel : encode D_RU, D_AC, D_ZONE, D_CU et D_FL en catégories partagées par toutes les
+    partitions. Les jointures et regroupements suivants travaillent alors sur des codes entiers au lieu
+    de chaînes ; les clés des références sont alignées sur le même vocabulaire au moment des jointures
+    (voir merge_on_keys). Le vocabulaire est trié, l'ordre des regroupements reste donc inchangé.
+
+    :param preprocessed_data: Partitions {(vue, devise): DataFrame}, ou {"filtered_data": DataFrame} pour GRAN.
+    :param ref_entite_path: Chemin du fichier Ref_Entite.
+    :param ref_transfo_path: Chemin du fichier Ref_Transfo_L1.
+    :return: Dictionnaire de même structure avec les dimensions encodées.
+    """
+    from LCR import LCR  # import local : LCR importe ce module
+
+    ref_frames = [
+        REF_CATALOG.get(ref_entite_path, LCR.preprocess_ref_entite),
+        REF_CATALOG.get(ref_transfo_path, LCR.preprocess_ref_transfo),
+    ]
+    vocabularies = build_vocabularies(preprocessed_data.values(), ref_frames)
+
+    encoded_data = {}
+    for key, data in preprocessed_data.items():
+        data = data.copy(deep=False)
+        for dimension, dtype in vocabularies.items():
+            if dimension in data.columns:
+                data[dimension] = data[dimension].astype(dtype)
+        encoded_data[key] = data
+    print(f"Dimensions encodées : {', '.join(f'{d} ({len(v.categories)})' for d, v in vocabularies.items())}")
+    return encoded_data
+
+
+def merge_on_keys(left: pd.DataFrame, right: pd.DataFrame, left_on, right_on, how: str = "left", columns=None) -> pd.DataFrame:
+    """
+    pd.merge sur des clés explicites. Lorsqu'une clé de gauche est catégorielle (mode catégoriel), la clé de
+    droite est convertie vers le même vocabulaire (étendu et retrié si la référence contient d'autres
+    valeurs) pour que la jointure se fasse sur les codes. Sans catégories, équivaut à pd.merge.
+
+    :param left: Table principale.
+    :param right: Référence.
+    :param left_on: Colonne(s) de jointure de la table principale.
+    :param right_on: Colonne(s) de jointure de la référence.
+    :param how: Type de jointure.
+    :param columns: Colonnes de la référence à conserver en plus des clés (toutes si None).
+    :return: Données jointes.
+    """
+    left_keys = [left_on] if isinstance(left_on, str) else list(left_on)
+    right_keys = [right_on] if isinstance(right_on, str) else list(right_on)
+
+    if columns is not None:
+        right = right[right_keys + [col for col in columns if col not in right_keys]]
+
+    for left_key, right_key in zip(left_keys, right_keys):
+        dtype = left[left_key].dtype
+        if not isinstance(dtype, pd.CategoricalDtype) or right[right_key].dtype == dtype:
+            continue
+        missing = pd.Index(right[right_key].dropna().unique()).difference(dtype.categories)
+        if len(missing):
+            dtype = pd.CategoricalDtype(dtype.categories.union(missing))
+            left = left.assign(**{left_key: left[left_key].cat.set_categories(dtype.categories)})
+        right = right.assign(**{right_key: right[right_key].astype(dtype)})
+
+    return pd.merge(left, right, left_on=left_on, right_on=right_on, how=how)
+
+
+def _sum_by_dimensions(data: pd.DataFrame) -> pd.DataFrame:
+    # Combinaisons dans l'ordre de première apparition ; les cubes partiels se refusionnent ainsi sans changer l'ordre
+    return data.groupby(CUBE_DIMENSIONS, dropna=False, sort=False, observed=True, as_index=False).agg(
+        **{CUBE_MEASURE: (CUBE_MEASURE, "sum")}
+    )
+
+
+def build_cube(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Agrège les données ligne à ligne en un cube (une ligne par combinaison de dimensions)
+    avant toute jointure avec les références.
+
+    Tous les indicateurs ne font que sommer P_AMOUNT par entité, compte, ligne et tranche :
+    sommer d'abord par dimension donne le même résultat (les montants sont entiers, et les
+    pourcentages LCR sont appliqués de façon distributive). Les valeurs manquantes des
+    dimensions sont conservées (dropna=False) pour que les filtres en aval restent identiques.
+
+    :param data: DataFrame prétraité contenant au moins les dimensions et P_AMOUNT.
+    :return: Cube agrégé avec les colonnes CUBE_DIMENSIONS + P_AMOUNT.
+    """
+    missing_columns = [col for col in CUBE_DIMENSIONS + [CUBE_MEASURE] if col not in data.columns]
+    if missing_columns:
+        raise ValueError(f"Les colonnes suivantes sont manquantes pour construire le cube : {', '.join(missing_columns)}")
+
+    cube = _sum_by_dimensions(data)
+    print(f"Cube construit : {len(data)} lignes -> {len(cube)} lignes.")
+    return cube
+
+
+def build_cubes(preprocessed_data: dict) -> dict:
+    """
+    Construit le cube de chaque partition retournée par preprocess_all_data.
+
+    :param preprocessed_data: Partitions {(vue, devise): DataFrame}, ou {"filtered_data": DataFrame} pour GRAN.
+    :return: Dictionnaire de même structure contenant les cubes.
+    """
+    return {key: build_cube(data) for key, data in preprocessed_data.items()}
+
+
+def filter_and_join_ref_entite(data: pd.DataFrame, ref_entite: pd.DataFrame) -> pd.DataFrame:
+    """
+    Exclut les flux T99 et les lignes sans D_ZONE, puis joint les données avec Ref_Entite sur D_RU.
+
+    :param data: Données prétraitées (ou cube).
+    :param ref_entite: Référence Ref_Entite prétraitée.
+    :return: Données filtrées et jointes.
+    """
+    # D_FL manquant : la ligne est conservée (comportement historique sur des colonnes object)
+    filtered_data = data[(data["D_FL"] != "T99").fillna(True) & (data["D_ZONE"].notna())]
+
+    return merge_on_keys(
+        filtered_data,
+        ref_entite,
+        left_on="D_RU",
+        right_on="Ref_Entite.d_ru",
+        how="left",
+        columns=["Ref_Entite.entité"],
+    )
+
+
+def join_with_ref_transfo(data: pd.DataFrame, ref_transfo: pd.DataFrame) -> pd.DataFrame:
+    """
+    Joint les données avec Ref_Transfo_L1 sur D_AC et ne garde que les comptes présents dans la référence.
+
+    :param data: Données déjà jointes avec Ref_Entite.
+    :param ref_transfo: Référence Ref_Transfo_L1 prétraitée.
+    :return: Données jointes et filtrées.
+    """
+    joined_data = merge_on_keys(
+        data,
+        ref_transfo,
+        left_on="D_AC",
+        right_on="Ref_Transfo_L1.Transfo_aggregate_L1",
+        how="left",
+        columns=[],
+    )
+    return joined_data[joined_data["Ref_Transfo_L1.Transfo_aggregate_L1"].notna()]
+
+
+def build_account_lookup(ref_transfo: pd.DataFrame, ref_indicator: pd.DataFrame, account_key: str,
+                         line_column: str, columns=()) -> pd.DataFrame:
+    """
+    Table de correspondance par compte d'un indicateur : comptes présents dans Ref_Transfo_L1, joints aux
+    lignes de la référence de l'indicateur. Une seule jointure sur D_AC remplace ainsi la jointure
+    Ref_Transfo_L1 suivie de la jointure avec la référence de l'indicateur.
+
+    Un compte a autant de lignes que le produit de ses occurrences dans les deux références, comme avec
+    les deux jointures successives. Les comptes sans ligne d'indicateur sont exclus.
+
+    :param ref_transfo: Référence Ref_Transfo_L1 prétraitée.
+    :param ref_indicator: Référence de l'indicateur prétraitée (Ref_LCR, Ref_NSFR, ...).
+    :param account_key: Colonne du compte dans la référence de l'indicateur.
+    :param line_column: Colonne de la ligne d'indicateur.
+    :param columns: Autres colonnes de la référence utilisées en aval.
+    :return: Table [account_key, line_column, *columns].
+    """
+    transfo_key = "Ref_Transfo_L1.Transfo_aggregate_L1"
+    lookup = pd.merge(
+        ref_transfo[[transfo_key]].dropna(),
+        ref_indicator[[account_key, line_column, *columns]],
+        left_on=transfo_key,
+        right_on=account_key,
+        how="inner",
+    )
+    lookup = lookup[lookup[line_column].notna()]
+    return lookup.drop(columns=transfo_key).reset_index(drop=True)
+
+
+def get_account_lookup(ref_transfo_source, ref_indicator_source, account_key: str, line_column: str, columns=()) -> pd.DataFrame:
+    """
+    Retourne la table de correspondance par compte d'un indicateur, construite une seule fois dans le
+    catalogue des références (voir build_account_lookup).
+
+    :param ref_transfo_source: Couple (chemin, fonction de prétraitement) de Ref_Transfo_L1.
+    :param ref_indicator_source: Couple (chemin, fonction de prétraitement) de la référence de l'indicateur.
+    :param account_key: Colonne du compte dans la référence de l'indicateur.
+    :param line_column: Colonne de la ligne d'indicateur.
+    :param columns: Autres colonnes de la référence utilisées en aval.
+    :return: Table de correspondance en lecture seule.
+    """
+    columns = tuple(columns)
+    return REF_CATALOG.derive(
+        f"Correspondance {account_key} -> {', '.join((line_column,) + columns)}",
+        partial(build_account_lookup, account_key=account_key, line_column=line_column, columns=columns),
+        ref_transfo_source,
+        ref_indicator_source,
+    )
+
+
+def join_with_account_lookup(data: pd.DataFrame, lookup: pd.DataFrame, account_key: str) -> pd.DataFrame:
+    """
+    Joint les données avec la table de correspondance d'un indicateur sur D_AC. Seuls les comptes présents
+    dans Ref_Transfo_L1 et dans la référence de l'indicateur sont conservés.
+
+    :param data: Données après le préfixe commun.
+    :param lookup: Table de correspondance (voir get_account_lookup).
+    :param account_key: Colonne du compte dans la table de correspondance.
+    :return: Données jointes.
+    """
+    return merge_on_keys(data, lookup, left_on="D_AC", right_on=account_key, how="inner")
+
+
+def build_bucket_weights(ref_dzone: pd.DataFrame, zone_key: str = "Ref_DZONE_NSFR.D_ZONE",
+                         bucket_column: str = "Ref_DZONE_NSFR.NSFR_Bucket", buckets=NSFR_BUCKETS) -> pd.DataFrame:
+    """
+    Précalcule la répartition de chaque D_ZONE dans les tranches de maturité : nombre de lignes de la
+    référence par (zone, tranche), comme le ferait la jointure avec Ref_DZONE_NSFR. La colonne "Autres"
+    compte les lignes dont la tranche n'est pas une colonne des rapports.
+
+    :param ref_dzone: Référence Ref_DZONE_NSFR prétraitée.
+    :param zone_key: Colonne de la zone dans la référence.
+    :param bucket_column: Colonne de la tranche dans la référence.
+    :param buckets: Tranches conservées dans les rapports.
+    :return: DataFrame indexé par zone, colonnes `buckets` + "Autres" (entiers).
+    """
+    ref = ref_dzone[[zone_key, bucket_column]].dropna()
+    bucket = ref[bucket_column].where(ref[bucket_column].isin(buckets), "Autres")
+    weights = pd.crosstab(ref[zone_key], bucket)
+    return weights.reindex(columns=list(buckets) + ["Autres"], fill_value=0).astype("int64")
+
+
+def get_bucket_weights(ref_dzone_source) -> pd.DataFrame:
+    """
+    Retourne la répartition des zones en tranches (voir build_bucket_weights), construite une seule fois
+    dans le catalogue des références.
+
+    :param ref_dzone_source: Couple (chemin, fonction de prétraitement) de Ref_DZONE_NSFR.
+    :return: Répartition en lecture seule.
+    """
+    return REF_CATALOG.derive("Répartition D_ZONE -> NSFR_Bucket", build_bucket_weights, ref_dzone_source)
+
+
+def aggregate_by_bucket(data: pd.DataFrame, index_columns, bucket_weights: pd.DataFrame,
+                        amount_column: str = "P_AMOUNT", bucket_column: str = "Ref_DZONE_NSFR.NSFR_Bucket",
+                        fill_missing_buckets: bool = False) -> pd.DataFrame:
+    """
+    Remplace la jointure Ref_DZONE_NSFR, le regroupement et le pivot_table des indicateurs NSFR, QIS et
+    ALMM : chaque D_ZONE est associé à sa ligne de répartition par un tableau précalculé, et les montants
+    sont cumulés directement dans une matrice à une colonne par tranche, une ligne par clé `index_columns`.
+
+    Le résultat a la même forme que pivot_and_reorder : clés triées, une colonne par tranche (0 si
+    aucun montant), index 0..n-1. Comme avec le pivot, une clé n'apparaît que si l'une de ses zones a
+    une tranche. Une tranche absente de toutes les données lève une ValueError (NSFR, ALMM), ou est
+    ajoutée avec des valeurs 0 si `fill_missing_buckets` est vrai (QIS).
+
+    :param data: Données jointes avec la référence de l'indicateur (colonnes index_columns, D_ZONE et montant).
+    :param index_columns: Clés du résultat (entité, compte, ligne d'indicateur).
+    :param bucket_weights: Répartition des zones (voir get_bucket_weights).
+    :param amount_column: Colonne du montant à cumuler.
+    :param bucket_column: Nom porté par l'index des colonnes, comme après le pivot.
+    :param fill_missing_buckets: Ajoute les tranches absentes avec des 0 au lieu de lever une erreur.
+    :return: DataFrame index_columns + tranches.
+    """
+    index_columns = list(index_columns)
+    for col in index_columns + ["D_ZONE", amount_column]:
+        if col not in data.columns:
+            raise ValueError(f"La colonne '{col}' est manquante dans le DataFrame.")
+
+    buckets = [col for col in bucket_weights.columns if col != "Autres"]
+
+    # Ligne de répartition de chaque donnée ; zone inconnue : dernière ligne, vide
+    weights = np.vstack([bucket_weights.to_numpy(dtype="int64"), np.zeros((1, len(bucket_weights.columns)), dtype="int64")])
+    zone_rows = bucket_weights.index.get_indexer(data["D_ZONE"])
+    row_weights = weights[zone_rows]
+
+    # Lignes conservées : une tranche au moins pour la zone, et des clés renseignées
+    keep = (row_weights.sum(axis=1) > 0) & data[index_columns].notna().all(axis=1).to_numpy()
+    selected = data[keep]
+    row_weights = row_weights[keep][:, :len(buckets)]
+
+    present = row_weights.any(axis=0)
+    if not fill_missing_buckets:
+        for i, bucket in enumerate(buckets):
+            if not present[i]:
+                raise ValueError(f"La colonne '{bucket}' est manquante dans le DataFrame pivoté.")
+
+    grouper = selected.groupby(index_columns, sort=True, observed=True)
+    group_rows = grouper.ngroup().to_numpy()
+    result = grouper.size().index.to_frame(index=False)
+
+    # Cumul des montants dans la matrice (clé x tranche)
+    amounts = selected[amount_column]
+    integer_amounts = pd.api.types.is_integer_dtype(amounts.dtype)
+    amounts = amounts.to_numpy(dtype="int64" if integer_amounts else "float64", na_value=0)
+    matrix = np.zeros((len(result), len(buckets)), dtype=amounts.dtype)
+    np.add.at(matrix, group_rows, amounts[:, None] * row_weights)
+
+    for i, bucket in enumerate(buckets):
+        if not present[i]:
+            print(f"Ajout de la colonne manquante '{bucket}' avec des valeurs 0.")
+            result[bucket] = 0
+        elif integer_amounts:
+            result[bucket] = pd.array(matrix[:, i], dtype="Int64")
+        else:
+            result[bucket] = matrix[:, i]
+    result.columns.name = bucket_column
+    return result
+
+
+def build_shared_prefix(data: pd.DataFrame, ref_entite: pd.DataFrame, columns=None) -> pd.DataFrame:
+    """
+    Étapes communes aux cinq indicateurs : filtre T99/D_ZONE puis jointure Ref_Entite. Le filtre sur les
+    comptes de Ref_Transfo_L1 est porté par la table de correspondance de chaque indicateur.
+    Si `columns` est fourni (voir required_columns), le résultat est réduit à ces colonnes.
+    """
+    prefix = filter_and_join_ref_entite(data, ref_entite)
+    return prefix if columns is None else project_columns(prefix, columns)
+
+
+def build_shared_prefixes(preprocessed_data: dict, ref_entite_path: str, columns=None) -> dict:
+    """
+    Calcule une seule fois par partition le préfixe commun, transmis ensuite à chaque indicateur
+    sélectionné qui n'exécute plus que ses étapes spécifiques : les process_* reçoivent ces données et
+    commencent directement par la jointure avec la table de correspondance de l'indicateur.
+
+    :param preprocessed_data: Partitions (ou cubes) {(vue, devise): DataFrame}, ou {"filtered_data": DataFrame} pour GRAN.
+    :param ref_entite_path: Chemin du fichier Ref_Entite.
+    :param columns: Colonnes à conserver après le préfixe (toutes si None).
+    :return: Dictionnaire de même structure contenant les données après le préfixe commun.
+    """
+    from LCR import LCR  # import local : LCR importe ce module
+
+    ref_entite = REF_CATALOG.get(ref_entite_path, LCR.preprocess_ref_entite)
+
+    return {
+        key: build_shared_prefix(data, ref_entite, columns)
+        for key, data in preprocessed_data.items()
+    }
+
+
+def split_by_entity(data: pd.DataFrame, entity_column: str = "Ref_Entite.entité"):
+    """
+    Découpe un résultat par entité en un seul passage (groupby) au lieu d'un filtre booléen par entité.
+    Les entités sont parcourues dans leur ordre d'apparition et les lignes gardent leur ordre d'origine ;
+    les lignes sans entité sont ignorées.
+
+    :param data: Résultat final d'un indicateur.
+    :param entity_column: Colonne portant l'entité.
+    :return: Itérateur de tuples (entité, DataFrame de l'entité).
+    """
+    return iter(data.groupby(entity_column, sort=False, dropna=True, observed=True))
+
+
+def entity_list(entities) -> list:
+    """
+    Normalise le paramètre entité des exports GRAN : une entité, une liste d'entités ou "ALL".
+
+    :param entities: Nom d'entité ou liste de noms.
+    :return: Liste sans doublon, dans l'ordre demandé.
+    """
+    if not entities:
+        return []
+    if isinstance(entities, str):
+        return [entities]
+    return list(dict.fromkeys(entities))
+
+
+def select_entities(data: pd.DataFrame, entities, entity_column: str = "Ref_Entite.entité"):
+    """
+    GRAN : découpe le résultat d'un indicateur, calculé une seule fois pour la devise et la vue, entre les
+    entités demandées (un seul groupby, voir split_by_entity). Avec "ALL", toutes les entités présentes
+    dans le résultat sont retournées ; une entité demandée absente du résultat reçoit un DataFrame vide.
+
+    :param data: Résultat final d'un indicateur.
+    :param entities: Entité, liste d'entités ou "ALL".
+    :param entity_column: Colonne portant l'entité.
+    :return: Itérateur de tuples (entité, DataFrame de l'entité).
+    """
+    entities = entity_list(entities)
+    if "ALL" in entities:
+        yield from split_by_entity(data, entity_column)
+        return
+
+    groups = dict(split_by_entity(data, entity_column))
+    for entity in entities:
+        yield entity, groups.get(entity, data.iloc[:0])
@@ -0,0 +1,138 @@
+import os
+import hashlib
+import threading
+import pandas as pd
+
+
+class RefCatalog:
+    """
+    Catalogue des fichiers de référence partagé par tous les moteurs d'indicateurs (LCR, NSFR, QIS, ALMM, AER).
+
+    Chaque fichier est lu et prétraité une seule fois par couple (chemin, fonction de prétraitement),
+    puis conservé en mémoire pour toute la durée du processus. Les méthodes `preprocess_ref_*` copiées
+    à l'identique d'une classe à l'autre partagent la même entrée. Le fichier n'est relu que si son
+    contenu change : la date de modification et la taille servent de contrôle rapide, le hash
+    SHA-256 du contenu sert d'empreinte.
+
+    Le catalogue conserve aussi des tables dérivées de plusieurs références (voir `derive`), reconstruites
+    uniquement lorsque l'une de leurs références sources change.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._derived = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _stat(file_path: str) -> tuple:
+        stat = os.stat(file_path)
+        return stat.st_mtime_ns, stat.st_size
+
+    @staticmethod
+    def _hash_file(file_path: str) -> str:
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _code_fingerprint(code, digest):
+        # Bytecode, constantes et noms utilisés (sans les numéros de ligne), fonctions imbriquées comprises
+        digest.update(code.co_code)
+        digest.update(repr(code.co_names).encode())
+        for const in code.co_consts:
+            if hasattr(const, "co_code"):
+                RefCatalog._code_fingerprint(const, digest)
+            else:
+                digest.update(repr(const).encode())
+
+    @staticmethod
+    def _key(file_path: str, preprocess) -> tuple:
+        digest = hashlib.sha256()
+        RefCatalog._code_fingerprint(preprocess.__code__, digest)
+        return os.path.abspath(file_path), digest.hexdigest()
+
+    def _refresh(self, file_path: str, preprocess) -> dict:
+        """
+        Retourne l'entrée à jour pour (file_path, preprocess), en rechargeant le fichier si nécessaire.
+        Doit être appelée avec le verrou acquis.
+        """
+        key = self._key(file_path, preprocess)
+        stat = self._stat(file_path)
+        entry = self._entries.get(key)
+
+        if entry is not None and entry["stat"] == stat:
+            return entry
+
+        file_hash = self._hash_file(file_path)
+        if entry is not None and entry["hash"] == file_hash:
+            # Fichier touché mais contenu identique : pas de nouvelle lecture
+            entry["stat"] = stat
+            return entry
+
+        print(f"Chargement de la référence : {file_path} ({preprocess.__qualname__})")
+        entry = {"stat": stat, "hash": file_hash, "frame": preprocess(file_path)}
+        self._entries[key] = entry
+        return entry
+
+    def get(self, file_path: str, preprocess) -> pd.DataFrame:
+        """
+        Retourne la référence prétraitée par `preprocess` (une des méthodes statiques `preprocess_ref_*`).
+
+        Le DataFrame retourné est une copie superficielle de la version en cache : ajouter, renommer ou
+        supprimer des colonnes est sans effet sur le catalogue, mais les valeurs ne doivent pas être
+        modifiées en place.
+
+        :param file_path: Chemin du fichier de référence.
+        :param preprocess: Fonction de prétraitement prenant le chemin du fichier.
+        :return: DataFrame prétraité en lecture seule.
+        """
+        with self._lock:
+            entry = self._refresh(file_path, preprocess)
+        return entry["frame"].copy(deep=False)
+
+    def derive(self, name: str, build, *sources) -> pd.DataFrame:
+        """
+        Retourne une table dérivée de plusieurs références (par exemple la table de correspondance par
+        compte d'un indicateur), construite une seule fois tant que les références sources ne changent pas.
+
+        :param name: Nom de la table dérivée (identifie la construction, avec les sources).
+        :param build: Fonction recevant les références prétraitées, dans l'ordre de `sources`.
+        :param sources: Couples (chemin, fonction de prétraitement) des références utilisées.
+        :return: DataFrame dérivé en lecture seule (copie superficielle, comme pour get).
+        """
+        with self._lock:
+            entries = [self._refresh(file_path, preprocess) for file_path, preprocess in sources]
+            key = (name,) + tuple(self._key(file_path, preprocess) for file_path, preprocess in sources)
+            hashes = tuple(entry["hash"] for entry in entries)
+            derived = self._derived.get(key)
+
+            if derived is None or derived["hashes"] != hashes:
+                print(f"Construction de la table dérivée : {name}")
+                frames = [entry["frame"].copy(deep=False) for entry in entries]
+                derived = {"hashes": hashes, "frame": build(*frames)}
+                self._derived[key] = derived
+        return derived["frame"].copy(deep=False)
+
+    def fingerprint(self, file_path: str) -> str:
+        """
+        Retourne l'empreinte (hash SHA-256 du contenu) d'un fichier de référence.
+        """
+        with self._lock:
+            for (path, _), entry in self._entries.items():
+                if path == os.path.abspath(file_path) and entry["stat"] == self._stat(file_path):
+                    return entry["hash"]
+        return self._hash_file(file_path)
+
+    def clear(self):
+        """
+        Vide le catalogue (les références seront relues au prochain accès).
+        """
+        with self._lock:
+            self._entries.clear()
+            self._derived.clear()
+
+
+# Catalogue unique pour tout le processus
+REF_CATALOG = RefCatalog()
@@ -0,0 +1,140 @@
+import threading
+
+import pandas as pd
+
+from pipeline import split_by_entity, entity_list
+
+# Vues d'un export GRAN (BILAN = D_T1 "INTER", CONSO = le reste)
+GRAN_VIEWS = ["ALL", "BILAN", "CONSO"]
+
+
+def filter_view(data: pd.DataFrame, view: str) -> pd.DataFrame:
+    """
+    Restreint des données GRAN à une vue, comme le font les process_* pour un export GRAN.
+
+    :param data: Données d'une devise après le préfixe commun.
+    :param view: Vue (ALL, BILAN ou CONSO).
+    :return: Données de la vue.
+    """
+    if view == "BILAN":
+        return data[data["D_T1"] == "INTER"]
+    if view == "CONSO":
+        return data[data["D_T1"] != "INTER"]
+    if view == "ALL":
+        return data
+    raise ValueError("Indicateur non pris en charge. Choisissez parmi ALL, BILAN, ou CONSO.")
+
+
+class ResultCube:
+    """
+    Résultats finaux des indicateurs (jointures, agrégation et montants ajustés), calculés une seule fois
+    par indicateur, vue et devise pour un fichier importé, et déjà découpés par entité.
+
+    Une requête GRAN (indicateur, vue, devise, entités) n'est plus qu'une lecture dans ce cube : aucune
+    référence n'est relue et aucune étape n'est recalculée. Le rendu des rapports reste à la charge de
+    l'appelant, uniquement lorsqu'il est demandé.
+    """
+
+    def __init__(self, partitions: dict, compute):
+        """
+        :param partitions: Données après le préfixe commun par devise {devise: DataFrame} (vue ALL).
+        :param compute: Fonction (indicateur, données) -> résultat final de l'indicateur.
+        """
+        self._partitions = partitions
+        self._compute = compute
+        self._results = {}
+        self._errors = {}
+        self._lock = threading.Lock()
+
+    @property
+    def currencies(self) -> list:
+        """
+        Devises présentes dans les données importées.
+        """
+        return list(self._partitions)
+
+    @property
+    def errors(self) -> dict:
+        """
+        Erreurs de calcul {(indicateur, vue, devise): message}.
+        """
+        with self._lock:
+            return dict(self._errors)
+
+    def _entry(self, indicator: str, view: str, currency: str) -> dict:
+        key = (indicator, view, currency)
+        with self._lock:
+            if key in self._results:
+                return self._results[key]
+            if key in self._errors:
+                raise ValueError(self._errors[key])
+
+        if currency not in self._partitions:
+            raise ValueError(f"Aucune donnée trouvée pour la devise '{currency}' dans l'export GRAN.")
+        data = filter_view(self._partitions[currency], view)
+        if data.empty:
+            raise ValueError(f"Aucune donnée trouvée pour l'indicateur '{view}'.")
+
+        try:
+            result = self._compute(indicator, data)
+        except Exception as e:
+            with self._lock:
+                self._errors[key] = str(e)
+            raise ValueError(str(e)) from e
+
+        entry = {"result": result, "entities": dict(split_by_entity(result))}
+        with self._lock:
+            self._results[key] = entry
+        return entry
+
+    def build(self, indicators, views=GRAN_VIEWS, progress_callback=None) -> dict:
+        """
+        Calcule tous les résultats (indicateurs x vues x devises) en une fois, après le téléversement.
+        Une erreur n'interrompt pas les autres calculs.
+
+        :param indicators: Noms des indicateurs.
+        :param views: Vues à calculer.
+        :param progress_callback: Fonction appelée avec (fait, total) après chaque calcul.
+        :return: Erreurs {(indicateur, vue, devise): message}.
+        """
+        keys = [
+            (indicator, view, currency)
+            for currency in self._partitions for view in views for indicator in indicators
+        ]
+        for done, key in enumerate(keys, start=1):
+            try:
+                self._entry(*key)
+            except ValueError as e:
+                with self._lock:
+                    self._errors.setdefault(key, str(e))
+            if progress_callback:
+                progress_callback(done, len(keys))
+        return self.errors
+
+    def entities(self, indicator: str, view: str, currency: str) -> list:
+        """
+        Entités présentes dans le résultat d'un indicateur, dans leur ordre d'apparition.
+        """
+        return list(self._entry(indicator, view, currency)["entities"])
+
+    def query(self, indicator: str, view: str, currency: str, entities="ALL") -> pd.DataFrame:
+        """
+        Résultat GRAN d'un indicateur pour une vue, une devise et une ou plusieurs entités.
+
+        :param indicator: Nom de l'indicateur.
+        :param view: Vue (ALL, BILAN ou CONSO).
+        :param currency: Devise.
+        :param entities: Entité, liste d'entités ou "ALL".
+        :return: Lignes du résultat final des entités demandées (vide si aucune n'est présente).
+        """
+        entry = self._entry(indicator, view, currency)
+        entities = entity_list(entities)
+        if "ALL" in entities:
+            return entry["result"]
+
+        frames = [entry["entities"][entity] for entity in entities if entity in entry["entities"]]
+        if len(frames) == 1:
+            return frames[0]
+        if not frames:
+            return entry["result"].iloc[:0]
+        return pd.concat(frames)
@@ -0,0 +1,76 @@
+import threading
+from collections import OrderedDict
+
+
+class RunCache:
+    """
+    Résultats des traitements terminés (ZIP et erreurs), partagés par toutes les sessions de l'application.
+
+    Un résultat est identifié par l'empreinte du fichier importé, celle des références et les paramètres
+    du traitement : relancer le même traitement, télécharger à nouveau ou réexécuter le script Streamlit
+    (changement d'un widget) réutilise l'archive déjà produite. Le cache est borné en nombre d'entrées et
+    en taille totale des archives ; les moins récemment utilisées sont oubliées.
+    """
+
+    def __init__(self, max_entries: int = 8, max_bytes: int = 512 * 1024 * 1024):
+        """
+        :param max_entries: Nombre maximal de résultats conservés.
+        :param max_bytes: Taille totale maximale des archives conservées (en octets).
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Retourne le résultat conservé pour `key`, ou None.
+
+        :param key: Clé du traitement (tuple hashable).
+        :return: Dictionnaire {"zip", "errors", "file_name"} ou None.
+        """
+        if key is None:
+            return None
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+            return result
+
+    def put(self, key, zip_bytes: bytes, errors: dict, file_name: str) -> dict:
+        """
+        Conserve le résultat d'un traitement terminé. Une archive plus grande que `max_bytes` n'est pas conservée.
+
+        :param key: Clé du traitement (tuple hashable).
+        :param zip_bytes: Contenu du ZIP de résultats.
+        :param errors: Erreurs des indicateurs {nom: message}.
+        :param file_name: Nom du fichier proposé au téléchargement.
+        :return: Le résultat conservé.
+        """
+        result = {"zip": zip_bytes, "errors": dict(errors), "file_name": file_name}
+        if len(zip_bytes) > self.max_bytes:
+            return result
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous["zip"])
+            self._entries[key] = result
+            self._size += len(zip_bytes)
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted["zip"])
+        return result
+
+    def clear(self):
+        """
+        Vide le cache des résultats.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+# Cache unique pour tout le processus (toutes les sessions Streamlit)
+RUN_CACHE = RunCache()
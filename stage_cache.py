@@ -0,0 +1,172 @@
+import functools
+import hashlib
+import multiprocessing
+import threading
+import weakref
+from collections import OrderedDict
+
+import pandas as pd
+
+from ref_catalog import RefCatalog
+
+
+class StageCache:
+    """
+    Mémoïsation des étapes de calcul des indicateurs, partagée par tous les moteurs.
+
+    Une étape est identifiée par son nom, l'empreinte de ses données d'entrée et celle des références
+    utilisées : lorsque deux indicateurs atteignent le même résultat intermédiaire (NSFR et ALMM
+    exécutent la même chaîne sur les mêmes références), il n'est calculé qu'une fois.
+
+    L'empreinte d'un DataFrame est le hash de son contenu (colonnes, types, index et valeurs). Elle est
+    retenue tant que l'objet existe ; le résultat d'une étape reçoit directement une empreinte dérivée
+    de la clé de l'étape, sans nouveau hash, pour que la chaîne d'étapes suivante reste peu coûteuse.
+
+    Le cache est borné en nombre de résultats et en taille totale (comme RunCache) : le serveur Streamlit
+    le garde pour toutes ses sessions. Dans un processus worker (exécution parallèle des indicateurs),
+    chaque indicateur a son propre processus : rien ne peut être partagé, l'étape est exécutée directement.
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 256 * 1024 * 1024):
+        """
+        :param max_entries: Nombre maximal de résultats conservés (les moins récemment utilisés sont oubliés).
+        :param max_bytes: Taille totale maximale des résultats conservés (en octets).
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._fingerprints = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _hash_frame(frame: pd.DataFrame) -> str:
+        digest = hashlib.sha256()
+        digest.update(repr(list(frame.columns)).encode())
+        digest.update(repr([str(dtype) for dtype in frame.dtypes]).encode())
+        for column, dtype in frame.dtypes.items():
+            # Le vocabulaire d'une colonne catégorielle change l'ordre des regroupements
+            if isinstance(dtype, pd.CategoricalDtype):
+                digest.update(repr(column).encode())
+                digest.update(pd.util.hash_pandas_object(pd.Series(dtype.categories), index=False).to_numpy().tobytes())
+        digest.update(pd.util.hash_pandas_object(frame, index=True).to_numpy().tobytes())
+        return digest.hexdigest()
+
+    def _remember(self, frame: pd.DataFrame, fingerprint: str):
+        # Empreinte retenue tant que l'objet existe (les DataFrames ne sont pas hashables)
+        key = id(frame)
+        self._fingerprints[key] = (weakref.ref(frame, lambda _: self._fingerprints.pop(key, None)), fingerprint)
+
+    def fingerprint(self, frame: pd.DataFrame) -> str:
+        """
+        Retourne l'empreinte d'un DataFrame, calculée une seule fois par objet.
+
+        :param frame: DataFrame (données ou référence).
+        :return: Empreinte hexadécimale.
+        """
+        with self._lock:
+            known = self._fingerprints.get(id(frame))
+            if known is not None and known[0]() is frame:
+                return known[1]
+
+        fingerprint = self._hash_frame(frame)
+        with self._lock:
+            self._remember(frame, fingerprint)
+        return fingerprint
+
+    def run(self, stage: str, func, data: pd.DataFrame, refs=(), code: str = "") -> pd.DataFrame:
+        """
+        Exécute `func(data)` ou retourne le résultat déjà calculé pour la même étape, les mêmes données
+        et les mêmes références.
+
+        Le DataFrame retourné est une copie superficielle du résultat en cache : ajouter, renommer ou
+        supprimer des colonnes est sans effet sur le cache, mais les valeurs ne doivent pas être
+        modifiées en place.
+
+        :param stage: Nom de l'étape (identique pour les indicateurs qui partagent la même étape).
+        :param func: Fonction de l'étape, appelée avec `data`.
+        :param data: Données d'entrée.
+        :param refs: Références (DataFrames) lues par l'étape.
+        :param code: Empreinte du code de l'étape (voir shared_stage).
+        :return: Résultat de l'étape.
+        """
+        if multiprocessing.parent_process() is not None:
+            # Processus worker : aucun autre indicateur avec qui partager, pas d'empreinte à calculer
+            return func(data)
+        try:
+            parts = [stage, code, self.fingerprint(data)] + [self.fingerprint(ref) for ref in refs]
+        except TypeError:
+            # Valeurs non hashables : l'étape est exécutée sans mémoïsation
+            return func(data)
+        key = hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        result = entry[0] if entry is not None else None
+
+        if result is None:
+            result = func(data)
+            self._store(key, result)
+        else:
+            print(f"Étape réutilisée : {stage}")
+
+        result = result.copy(deep=False)
+        with self._lock:
+            self._remember(result, key)
+        return result
+
+    def _store(self, key: str, result: pd.DataFrame):
+        # Un résultat plus grand que max_bytes n'est pas conservé
+        size = int(result.memory_usage(index=True, deep=True).sum())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= previous[1]
+            self._entries[key] = (result, size)
+            self._size += size
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._size -= evicted
+
+    def clear(self):
+        """
+        Vide le cache des étapes.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self._fingerprints.clear()
+
+
+# Cache unique pour tout le processus
+STAGE_CACHE = StageCache()
+
+
+def _code_fingerprint(func) -> str:
+    digest = hashlib.sha256()
+    RefCatalog._code_fingerprint(func.__code__, digest)
+    return digest.hexdigest()
+
+
+def shared_stage(stage: str):
+    """
+    Décorateur des fonctions d'étape partagées par plusieurs moteurs, appelées `func(data, *refs)` avec
+    les références lues par l'étape (DataFrames). Les moteurs qui appellent la même fonction sur les
+    mêmes données et les mêmes références partagent le résultat. La clé comprend l'empreinte du code de la fonction (comme
+    RefCatalog pour les fonctions de prétraitement) : un résultat n'est réutilisé que tant que la
+    fonction qui l'a produit est inchangée.
+
+    :param stage: Nom de l'étape.
+    """
+    def decorator(func):
+        code = _code_fingerprint(func)
+
+        @functools.wraps(func)
+        def wrapper(data, *refs):
+            return STAGE_CACHE.run(stage, lambda frame: func(frame, *refs), data, refs, code=code)
+        return wrapper
+    return decorator
@@ -0,0 +1,419 @@
+import os
+import re
+import math
+import multiprocessing
+import datetime
+import threading
+import zipfile
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from types import SimpleNamespace
+import pandas as pd
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import Cell
+from openpyxl.cell._writer import etree_write_cell
+from openpyxl.utils import get_column_letter, range_boundaries
+from openpyxl.worksheet._writer import WorksheetWriter
+from openpyxl.xml.functions import Element, tostring
+
+# Balise <dimension> de la feuille, à mettre à jour selon le nombre de lignes écrites
+_DIMENSION_PATTERN = re.compile(rb'<dimension ref="([^"]*)"\s*/>')
+
+
+class _NotStreamable(Exception):
+    """
+    Valeur qui nécessiterait un style de cellule (dates) : le rendu passe alors par le classeur openpyxl.
+    """
+
+
+def _split_sheet_xml(sheet_xml: bytes) -> dict:
+    """
+    Découpe le XML d'une feuille vierge autour de la balise <dimension> et de la fin de <sheetData>,
+    pour y insérer des lignes en flux.
+
+    :param sheet_xml: XML de la feuille contenant uniquement les lignes d'en-tête.
+    :return: Dictionnaire {"head", "middle", "tail", "bounds"}.
+    """
+    dimension = _DIMENSION_PATTERN.search(sheet_xml)
+    if dimension is None:
+        raise ValueError("La feuille ne contient pas de balise <dimension>.")
+
+    end = sheet_xml.find(b"</sheetData>")
+    if end == -1:
+        # <sheetData /> vide : on l'ouvre pour pouvoir y ajouter des lignes
+        empty = re.search(rb"<sheetData\s*/>", sheet_xml)
+        middle = sheet_xml[dimension.end():empty.start()] + b"<sheetData>"
+        tail = b"</sheetData>" + sheet_xml[empty.end():]
+    else:
+        middle = sheet_xml[dimension.end():end]
+        tail = sheet_xml[end:]
+
+    return {
+        "head": sheet_xml[:dimension.start()],
+        "middle": middle,
+        "tail": tail,
+        "bounds": range_boundaries(dimension.group(1).decode()),
+    }
+
+
+def _dimension_xml(bounds: tuple, n_rows: int, n_cols: int) -> bytes:
+    min_col, min_row, max_col, max_row = bounds
+    if n_rows and n_cols:
+        min_row, max_row = min(min_row, 2), max(max_row, n_rows + 1)
+        max_col = max(max_col, n_cols)
+    ref = f"{get_column_letter(min_col)}{min_row}:{get_column_letter(max_col)}{max_row}"
+    return f'<dimension ref="{ref}" />'.encode()
+
+
+def _iter_row_xml(sheet, values, skip_missing: bool = False):
+    """
+    Génère le XML de chaque ligne de données (à partir de la 2e ligne), une ligne à la fois,
+    avec le même encodage des cellules qu'openpyxl.
+
+    :param sheet: Feuille openpyxl utilisée pour typer les valeurs.
+    :param values: Itérable de lignes (séquences de valeurs).
+    :param skip_missing: Si True, les valeurs manquantes (NaN, None) sont omises et les infinis
+        écrits en texte, comme le fait pandas.to_excel.
+    """
+    cell = Cell(sheet, row=1, column=1)
+    for i, row in enumerate(values, start=2):
+        row_element = Element("row", {"r": f"{i}"})
+        writer = SimpleNamespace(write=row_element.append)
+        for j, value in enumerate(row, start=1):
+            if skip_missing:
+                if value is None or (isinstance(value, float) and math.isnan(value)):
+                    continue
+                if isinstance(value, float) and math.isinf(value):
+                    value = "inf" if value > 0 else "-inf"
+            elif value is None:
+                # Cellule vide sans style : openpyxl ne l'écrit pas
+                continue
+            cell.row, cell.column = i, j
+            cell.value = value
+            if cell.has_style:
+                raise _NotStreamable(value)
+            etree_write_cell(writer, sheet, cell)
+        yield tostring(row_element)
+
+
+def _write_package(parts: list, sheet_part: str, sheet_chunks, replacements: dict = None) -> BytesIO:
+    """
+    Écrit un paquet xlsx en recopiant les parties en cache ; la feuille de données est écrite
+    en flux, morceau par morceau, directement dans l'archive.
+    """
+    replacements = replacements or {}
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED, allowZip64=True) as zipf:
+        for name, data in parts:
+            if name == sheet_part:
+                with zipf.open(name, "w", force_zip64=True) as stream:
+                    for chunk in sheet_chunks:
+                        stream.write(chunk)
+            else:
+                zipf.writestr(name, replacements.get(name, data))
+    buffer.seek(0)
+    return buffer
+
+
+class TemplateRenderer:
+    """
+    Moteur de rendu des templates de rapports (LCR, NSFR, QIS, ALMM, AER).
+
+    Chaque template est lu une seule fois : sa première feuille est vidée à partir de la 2e ligne,
+    puis le classeur est sauvegardé une fois pour obtenir le paquet xlsx « vierge ». À chaque rendu,
+    seule la feuille de données est régénérée ; les autres parties du paquet (styles, feuilles de
+    calcul, thème...) sont recopiées telles quelles, ce qui donne un résultat identique octet pour
+    octet à un chargement complet du template (hors date de modification dans docProps/core.xml).
+    Le template est rechargé si le fichier change sur le disque.
+    """
+
+    def __init__(self):
+        self._templates = {}
+        self._header_packages = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _stat(template_path: str) -> tuple:
+        stat = os.stat(template_path)
+        return stat.st_mtime_ns, stat.st_size
+
+    @staticmethod
+    def _prepare(template_path: str) -> dict:
+        """
+        Charge le template, vide la feuille de données et met en cache le paquet xlsx vierge.
+        """
+        workbook = load_workbook(template_path)
+        sheet = workbook.active  # Utiliser la première feuille
+
+        # Effacer les données existantes dans la feuille (à partir de la 2e ligne)
+        for row in sheet.iter_rows(min_row=2, max_row=sheet.max_row, min_col=1, max_col=sheet.max_column):
+            for cell in row:
+                cell.value = None
+
+        # L'écriture d'une feuille met à jour le niveau de plan des colonnes : on conserve l'état initial
+        outline_level_col = sheet.sheet_format.outlineLevelCol
+        max_outline = sheet.column_dimensions.max_outline
+        buffer = BytesIO()
+        workbook.save(buffer)
+        sheet.sheet_format.outlineLevelCol = outline_level_col
+        sheet.column_dimensions.max_outline = max_outline
+
+        with zipfile.ZipFile(buffer) as zipf:
+            parts = [(name, zipf.read(name)) for name in zipf.namelist()]
+
+        sheet_part = sheet.path[1:]
+        template_cells = set(sheet._cells)
+        # Écriture en flux possible seulement si le template n'a pas de cellules sous l'en-tête
+        streamable = all(row < 2 for row, _ in template_cells)
+
+        return {
+            "workbook": workbook,
+            "sheet": sheet,
+            "sheet_part": sheet_part,
+            "outline_level_col": outline_level_col,
+            "max_outline": max_outline,
+            "template_cells": template_cells,
+            "parts": parts,
+            "sheet_xml": _split_sheet_xml(dict(parts)[sheet_part]) if streamable else None,
+            "lock": threading.Lock(),
+        }
+
+    def _entry(self, template_path: str) -> dict:
+        key = os.path.abspath(template_path)
+        stat = self._stat(template_path)
+        with self._lock:
+            entry = self._templates.get(key)
+            if entry is None or entry["stat"] != stat:
+                entry = self._prepare(template_path)
+                entry["stat"] = stat
+                self._templates[key] = entry
+        return entry
+
+    @staticmethod
+    def _write_rows(sheet, dataframe: pd.DataFrame):
+        # Écriture en bloc dans le dictionnaire de cellules de la feuille (équivalent à sheet.cell(...))
+        cells = sheet._cells
+        for i, row in enumerate(dataframe.values, start=2):  # Commence à la ligne 2
+            for j, value in enumerate(row, start=1):  # Commence à la colonne 1
+                cell = cells.get((i, j))
+                if cell is None:
+                    cells[(i, j)] = Cell(sheet, row=i, column=j, value=value)
+                else:
+                    cell.value = value
+
+    @staticmethod
+    def _reset_rows(entry: dict):
+        # Remet la feuille de données dans l'état du template vidé
+        sheet = entry["sheet"]
+        template_cells = entry["template_cells"]
+        for key in [key for key in sheet._cells if key not in template_cells]:
+            del sheet._cells[key]
+        for key in template_cells:
+            if key[0] >= 2:
+                sheet._cells[key].value = None
+        sheet.sheet_format.outlineLevelCol = entry["outline_level_col"]
+        sheet.column_dimensions.max_outline = entry["max_outline"]
+
+    def render(self, dataframe: pd.DataFrame, template_path: str) -> BytesIO:
+        """
+        Applique les données d'un DataFrame dans le template, à partir de la 2e ligne de la première feuille.
+
+        :param dataframe: DataFrame contenant les données à insérer (colonnes dans l'ordre du template).
+        :param template_path: Chemin du fichier Excel template.
+        :return: Un buffer contenant le fichier Excel généré.
+        """
+        entry = self._entry(template_path)
+        workbook, sheet = entry["workbook"], entry["sheet"]
+
+        with entry["lock"]:
+            try:
+                self._write_rows(sheet, dataframe)
+                writer = WorksheetWriter(sheet, out=BytesIO())
+                writer.write()
+                sheet_xml = writer.read()
+            finally:
+                self._reset_rows(entry)
+
+            workbook.properties.modified = datetime.datetime.now(tz=datetime.timezone.utc).replace(tzinfo=None)
+            core_xml = tostring(workbook.properties.to_tree())
+
+        buffer = BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED, allowZip64=True) as zipf:
+            for name, data in entry["parts"]:
+                if name == entry["sheet_part"]:
+                    data = sheet_xml
+                elif name == "docProps/core.xml":
+                    data = core_xml
+                zipf.writestr(name, data)
+        buffer.seek(0)
+        return buffer
+
+    def stream(self, dataframe: pd.DataFrame, template_path: str) -> BytesIO:
+        """
+        Variante de `render` pour les gros rapports (All_Entities) : les lignes de données sont écrites
+        en flux dans le XML de la feuille, à l'intérieur de l'archive xlsx, sans construire de cellules
+        openpyxl. La mémoire utilisée ne dépend que de la ligne en cours (plus l'archive produite).
+        Les styles, largeurs de colonnes et lignes d'en-tête du template sont conservés ; le résultat est
+        identique à celui de `render`.
+
+        :param dataframe: DataFrame contenant les données à insérer (colonnes dans l'ordre du template).
+        :param template_path: Chemin du fichier Excel template.
+        :return: Un buffer contenant le fichier Excel généré.
+        """
+        entry = self._entry(template_path)
+        sheet_xml = entry["sheet_xml"]
+        if sheet_xml is None:
+            return self.render(dataframe, template_path)
+
+        workbook = entry["workbook"]
+        with entry["lock"]:
+            workbook.properties.modified = datetime.datetime.now(tz=datetime.timezone.utc).replace(tzinfo=None)
+            core_xml = tostring(workbook.properties.to_tree())
+
+        n_rows, n_cols = dataframe.shape
+        chunks = [
+            sheet_xml["head"],
+            _dimension_xml(sheet_xml["bounds"], n_rows, n_cols),
+            sheet_xml["middle"],
+        ]
+        try:
+            return _write_package(
+                entry["parts"],
+                entry["sheet_part"],
+                chain(chunks, _iter_row_xml(entry["sheet"], dataframe.values), [sheet_xml["tail"]]),
+                {"docProps/core.xml": core_xml},
+            )
+        except _NotStreamable:
+            return self.render(dataframe, template_path)
+
+    def _header_package(self, columns: tuple) -> dict:
+        """
+        Paquet xlsx contenant uniquement la ligne d'en-tête, tel que produit par pandas.to_excel,
+        mis en cache par liste de colonnes.
+        """
+        with self._lock:
+            package = self._header_packages.get(columns)
+            if package is None:
+                buffer = BytesIO()
+                pd.DataFrame(columns=list(columns)).to_excel(buffer, index=False, engine="xlsxwriter")
+                with zipfile.ZipFile(buffer) as zipf:
+                    parts = [(name, zipf.read(name)) for name in zipf.namelist()]
+                sheet_part = "xl/worksheets/sheet1.xml"
+                package = {
+                    "parts": parts,
+                    "sheet_part": sheet_part,
+                    "sheet_xml": _split_sheet_xml(dict(parts)[sheet_part]),
+                    "sheet": Workbook().active,
+                }
+                self._header_packages[columns] = package
+        return package
+
+    def stream_dataframe(self, dataframe: pd.DataFrame) -> BytesIO:
+        """
+        Équivalent en flux de `dataframe.to_excel(..., index=False, engine="xlsxwriter")` pour les rapports
+        sans template (ALMM) : l'en-tête est celui de pandas, les lignes sont écrites en flux et les
+        valeurs manquantes laissées vides.
+
+        :param dataframe: DataFrame à exporter.
+        :return: Un buffer contenant le fichier Excel généré.
+        """
+        package = self._header_package(tuple(dataframe.columns))
+        sheet_xml = package["sheet_xml"]
+        n_rows, n_cols = dataframe.shape
+        chunks = [
+            sheet_xml["head"],
+            _dimension_xml(sheet_xml["bounds"], n_rows, n_cols),
+            sheet_xml["middle"],
+        ]
+        try:
+            return _write_package(
+                package["parts"],
+                package["sheet_part"],
+                chain(chunks, _iter_row_xml(package["sheet"], dataframe.values, skip_missing=True), [sheet_xml["tail"]]),
+            )
+        except _NotStreamable:
+            buffer = BytesIO()
+            dataframe.to_excel(buffer, index=False, engine="xlsxwriter")
+            buffer.seek(0)
+            return buffer
+
+    def clear(self):
+        """
+        Vide le cache (les templates seront relus au prochain rendu).
+        """
+        with self._lock:
+            self._templates.clear()
+            self._header_packages.clear()
+
+
+# Moteur unique pour tout le processus
+TEMPLATE_RENDERER = TemplateRenderer()
+
+
+# Nombre de workers par défaut pour le rendu des rapports par entité
+DEFAULT_RENDER_WORKERS = os.cpu_count() or 1
+
+# Pool de rendu unique (taille, pool), conservé d'un appel à l'autre pour garder les templates en cache
+# dans les workers ; remplacé (et l'ancien arrêté) lorsque le nombre de workers demandé change
+_RENDER_POOL = None
+_RENDER_POOL_LOCK = threading.Lock()
+
+
+def _render_job(arcname: str, dataframe: pd.DataFrame, template_path: str) -> tuple:
+    """
+    Rend un rapport et retourne (chemin dans le ZIP, contenu du fichier).
+    Sans template, le fichier est produit par pandas.to_excel (rapports ALMM).
+    """
+    if template_path is None:
+        buffer = BytesIO()
+        dataframe.to_excel(buffer, index=False, engine="xlsxwriter")
+    else:
+        buffer = TEMPLATE_RENDERER.render(dataframe, template_path)
+    return arcname, buffer.getvalue()
+
+
+def _render_context():
+    # Le processus appelant a d'autres threads (session Streamlit, JobRunner, ZipSink) : pas de fork
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return multiprocessing.get_context(method)
+
+
+def _submit_render_jobs(jobs, max_workers: int) -> list:
+    """
+    Soumet les jobs au pool de rendu, créé ou remplacé si sa taille diffère. La soumission se fait sous
+    verrou : un pool remplacé par un autre appel ne reçoit plus de job, et termine ceux déjà soumis.
+    """
+    global _RENDER_POOL
+    with _RENDER_POOL_LOCK:
+        if _RENDER_POOL is None or _RENDER_POOL[0] != max_workers:
+            if _RENDER_POOL is not None:
+                _RENDER_POOL[1].shutdown(wait=False)
+            _RENDER_POOL = (max_workers, ProcessPoolExecutor(max_workers=max_workers, mp_context=_render_context()))
+        pool = _RENDER_POOL[1]
+        return [pool.submit(_render_job, *job) for job in jobs]
+
+
+def render_reports(jobs, max_workers: int = None):
+    """
+    Rend une série de rapports (un par entité) sur un pool borné de processus : la sérialisation openpyxl
+    et la compression sont du travail CPU. Chaque worker retourne (chemin dans le ZIP, contenu), que
+    l'appelant écrit dans le ZIP ; les résultats sont restitués dans l'ordre des jobs.
+
+    :param jobs: Liste de tuples (chemin dans le ZIP, DataFrame, chemin du template ou None).
+    :param max_workers: Nombre maximal de workers (par défaut et au plus : DEFAULT_RENDER_WORKERS). Avec
+        1 worker, ou depuis un processus enfant (indicateur exécuté en parallèle), le rendu se fait dans
+        le processus courant : les pools ne sont jamais imbriqués.
+    :return: Itérateur de tuples (chemin dans le ZIP, contenu du fichier).
+    """
+    jobs = list(jobs)
+    max_workers = min(max_workers or DEFAULT_RENDER_WORKERS, DEFAULT_RENDER_WORKERS)
+    if multiprocessing.parent_process() is not None:
+        max_workers = 1
+    if max_workers <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            yield _render_job(*job)
+        return
+
+    for future in _submit_render_jobs(jobs, max_workers):
+        yield future.result()
@@ -0,0 +1,114 @@
+import importlib
+import multiprocessing
+import queue
+import threading
+import zipfile
+
+
+class QueueZipWriter:
+    """
+    Remplaçant de zipfile.ZipFile pour les process_* exécutés en parallèle : les fichiers rendus
+    sont envoyés dans une file au lieu d'être écrits directement dans le ZIP partagé.
+    Sérialisable (pickle) lorsque la file provient d'un multiprocessing.Manager.
+    """
+
+    def __init__(self, file_queue):
+        self.file_queue = file_queue
+
+    def writestr(self, arcname, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.file_queue.put((arcname, data))
+
+    def write(self, filename, arcname=None):
+        with open(filename, "rb") as f:
+            self.writestr(arcname or filename, f.read())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+def open_zip_writer(zip_target):
+    """
+    Ouvre la cible d'écriture des process_* : un ZipFile en ajout sur un buffer,
+    ou directement le QueueZipWriter fourni par un ZipSink.
+
+    :param zip_target: Buffer ZIP (BytesIO) ou QueueZipWriter.
+    :return: Objet utilisable comme context manager et exposant writestr / write.
+    """
+    if isinstance(zip_target, QueueZipWriter):
+        return zip_target
+    return zipfile.ZipFile(zip_target, "a")
+
+
+class ZipSink:
+    """
+    Écrivain unique du ZIP de sortie : les fichiers rendus par les indicateurs arrivent par une file
+    et un seul thread les ajoute au buffer ZIP, ce qui permet d'exécuter les process_* en parallèle.
+    """
+
+    def __init__(self, zip_buffer, use_processes: bool = False):
+        """
+        :param zip_buffer: Buffer ZIP en mémoire (BytesIO).
+        :param use_processes: True si les producteurs tournent dans un pool de processus
+            (la file est alors gérée par un multiprocessing.Manager).
+        """
+        self.zip_buffer = zip_buffer
+        self._manager = multiprocessing.Manager() if use_processes else None
+        self.file_queue = self._manager.Queue() if self._manager else queue.Queue()
+        self.writer = QueueZipWriter(self.file_queue)
+        self.written_files = []
+        self._thread = None
+        self._error = None
+
+    def _drain(self):
+        try:
+            with zipfile.ZipFile(self.zip_buffer, "a") as zipf:
+                while True:
+                    item = self.file_queue.get()
+                    if item is None:
+                        break
+                    arcname, data = item
+                    zipf.writestr(arcname, data)
+                    self.written_files.append(arcname)
+        except Exception as e:
+            self._error = e
+
+    def start(self):
+        self._thread = threading.Thread(target=self._drain, name="zip-sink", daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        """
+        Attend l'écriture de tous les fichiers en file puis ferme le ZIP.
+        """
+        if self._thread is not None:
+            self.file_queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+        if self._error is not None:
+            raise RuntimeError(f"Erreur lors de l'écriture du ZIP : {self._error}")
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def run_named_process(module_name: str, func_name: str, args):
+    """
+    Point d'entrée des workers du pool de processus : retrouve la fonction par son nom plutôt que
+    par référence, car sous `streamlit run` les process_* sont définis dans un module __main__
+    synthétique que les workers ne savent pas dépickler.
+    """
+    func = getattr(importlib.import_module(module_name), func_name)
+    return func(*args)